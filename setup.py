@@ -12,9 +12,11 @@ setup(
     install_requires=[
         'nltk',
         'beautifulsoup4',
+        'lxml',
         'watson_developer_cloud',
         'solrpy',
         'numpy',
+        'scipy',
         'matplotlib',
         'requests',
         'pandas >= 0.17.0',
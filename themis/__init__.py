@@ -39,16 +39,18 @@ def print_csv(dataframe, **kwargs):
 class CsvFileType(object):
     """Pandas CSV file type used with argparse
 
-    This allows you to specify the columns you wish to use and optionally rename them.
+    This allows you to specify the columns you wish to use, optionally the types to read them as, and optionally rename
+    them.
     """
 
-    def __init__(self, columns=None, rename=None):
+    def __init__(self, columns=None, rename=None, dtype=None):
         self.columns = columns
         self.rename = rename
+        self.dtype = dtype
 
     def __call__(self, filename):
         try:
-            csv = from_csv(filename, usecols=self.columns)
+            csv = from_csv(filename, usecols=self.columns, dtype=self.dtype)
             if self.rename is not None:
                 csv = csv.rename(columns=self.rename)
             csv.filename = filename
@@ -58,6 +60,23 @@ class CsvFileType(object):
             raise e
 
 
+def nullable_boolean(values):
+    """
+    Store a column of booleans that may contain missing values in a single byte per row.
+
+    A column without missing values is stored as a plain boolean. Otherwise it is stored as a categorical with False and
+    True categories, which keeps missing values as NaN.
+
+    :param values: booleans and missing values
+    :type values: pandas.Series
+    :return: boolean or categorical column
+    :rtype: pandas.Series
+    """
+    if not values.isnull().any():
+        return values.astype("bool")
+    return pandas.Series(pandas.Categorical(values, categories=[False, True]), index=values.index, name=values.name)
+
+
 def percent_complete_message(msg, n, total):
     return "%s %d of %d (%0.3f%%)" % (msg, n, total, 100.0 * n / total)
 
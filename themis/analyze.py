@@ -1,52 +1,133 @@
-import functools
+import hashlib
 import itertools
 import json
-import math
+import multiprocessing
 import os
 import os.path
 import tempfile
 import textwrap
+import warnings
+from multiprocessing.pool import ThreadPool
 
+import lxml.etree
+import lxml.html
 import numpy as np
 import pandas
-from bs4 import BeautifulSoup
-from nltk import FreqDist, word_tokenize
+from nltk import word_tokenize
 from watson_developer_cloud import \
     NaturalLanguageClassifierV1 as NaturalLanguageClassifier
 
 from themis import (ANSWER, ANSWER_ID, CONFIDENCE, CORRECT, FREQUENCY,
                     IN_PURVIEW, QUESTION, CsvFileType, ensure_directory_exists,
-                    logger, percent_complete_message, pretty_print_json,
-                    to_csv)
+                    from_csv, logger, nullable_boolean,
+                    percent_complete_message, pretty_print_json, to_csv)
+from themis.answer import close, prefetch
 from themis.checkpoint import DataFrameCheckpoint
-from themis.metrics import (__standardize_confidence, confidence_thresholds,
-                            precision, questions_attempted)
-from themis.nlc import NLC, classifier_status
+from themis.classifier import FEATURES, LogisticClassifier
+from themis.dictionary import ANSWER_KEY, MISSING, AnswerDictionary
+from themis.judge import keyed_judgments
+from themis.metrics import (__standardize_confidence, attempted_frequencies,
+                            precision)
+from themis.nlc import (NLC, STATUS_RETRIES, classifier_status,
+                        wait_for_classifiers)
 
 SYSTEM = "System"
 ANSWERING_SYSTEM = "Answering System"
+THRESHOLD = "Threshold"
+PRECISION = "Precision"
 NLC_ROUTER_FOLDS = 8
+ANSWER_HASH = "Answer Hash"
+TOKENS = "Tokens"
 
 
-def corpus_statistics(corpus):
+def corpus_statistics(corpus, token_counts=None, processes=None):
     """
     Generate statistics for the corpus.
 
     :param corpus: corpus generated by 'xmgr corpus' command
     :type corpus: pandas.DataFrame
-    :return: answers in corpus, tokens in the corpus, histogram of answer length in tokens
-    :rtype: (int, int, dict(int, int))
+    :param token_counts: previously counted answer tokens, see answer_token_counts
+    :type token_counts: pandas.DataFrame
+    :param processes: number of worker processes used to count tokens, by default the number of CPUs
+    :type processes: int
+    :return: answers in corpus, tokens in the corpus, histogram of answer length in tokens, and the token counts with
+        those of any new answers added
+    :rtype: (int, int, dict(int, int), pandas.DataFrame)
     """
     answers = len(corpus)
-    token_frequency = FreqDist([len(word_tokenize(BeautifulSoup(answer, "lxml").text)) for answer in corpus[ANSWER]])
-    histogram = {}
-    for frequency, count in token_frequency.items():
-        histogram[frequency] = histogram.get(frequency, 0) + count
-    tokens = sum(token_frequency.keys())
+    hashes = corpus[ANSWER].fillna("").map(_answer_hash)
+    token_counts = answer_token_counts(corpus[ANSWER], token_counts, processes, hashes)
+    lengths = hashes.map(token_counts.set_index(ANSWER_HASH)[TOKENS])
+    histogram = dict((int(length), int(count)) for length, count in lengths.value_counts().items())
+    tokens = int(lengths.sum())
     n = sum(corpus.duplicated(ANSWER_ID))
     if n:
         logger.warning("%d duplicated answer IDs (%0.3f%%)" % (n, 100.0 * n / answers))
-    return answers, tokens, histogram
+    return answers, tokens, histogram, token_counts
+
+
+def answer_token_counts(answers, token_counts=None, processes=None, hashes=None, chunk_size=1000):
+    """
+    Count the tokens in the text of HTML answers.
+
+    Answers are identified by a hash of their text. Only answers whose hashes are not already in token_counts are
+    tokenized, so a corpus that has been counted before only needs its new and changed answers counted. These are
+    split into chunks that are tokenized in a process pool.
+
+    :param answers: answer HTML
+    :type answers: pandas.Series
+    :param token_counts: previously counted answer tokens
+    :type token_counts: pandas.DataFrame
+    :param processes: number of worker processes, by default the number of CPUs
+    :type processes: int
+    :param hashes: answer hashes, if they have already been computed
+    :type hashes: pandas.Series
+    :param chunk_size: number of answers tokenized by a worker at a time
+    :type chunk_size: int
+    :return: the previously counted answer tokens with the counts of any new answers added
+    :rtype: pandas.DataFrame
+    """
+    answers = answers.fillna("")
+    if hashes is None:
+        hashes = answers.map(_answer_hash)
+    if token_counts is None:
+        token_counts = pandas.DataFrame(columns=TokenCountsFileType.columns)
+    new = ~hashes.isin(token_counts[ANSWER_HASH]) & ~hashes.duplicated()
+    if new.any():
+        logger.info("Count tokens in %d of %d answers" % (new.sum(), len(answers)))
+        new_answers = answers[new].values
+        pool = multiprocessing.Pool(processes)
+        try:
+            counts = pool.map(_count_tokens, np.array_split(new_answers, -(-len(new_answers) // chunk_size)))
+        finally:
+            pool.close()
+            pool.join()
+        token_counts = pandas.concat([token_counts,
+                                      pandas.DataFrame({ANSWER_HASH: hashes[new].values,
+                                                        TOKENS: np.concatenate(counts)},
+                                                       columns=TokenCountsFileType.columns)],
+                                     ignore_index=True)
+    token_counts[TOKENS] = token_counts[TOKENS].astype(np.int64)
+    return token_counts
+
+
+def _answer_hash(answer):
+    return hashlib.sha1(answer.encode("utf-8")).hexdigest()
+
+
+def _count_tokens(answers):
+    return np.array([len(word_tokenize(_html_text(answer))) for answer in answers], dtype=np.int64)
+
+
+def _html_text(html):
+    """
+    The text content of an HTML fragment, leaving out scripts and style sheets.
+    """
+    if not html.strip():
+        return ""
+    fragment = lxml.html.fragment_fromstring(html, create_parent="div")
+    lxml.etree.strip_elements(fragment, "script", "style", with_tail=False)
+    return fragment.text_content()
 
 
 def truth_statistics(truth):
@@ -66,33 +147,74 @@ def truth_statistics(truth):
     return pairs, questions, answers, question_histogram
 
 
-def system_similarity(systems_data):
+def system_similarity(systems_data, matrix=False):
     """
     For each system pair, return the number of questions they answered the same.
 
     :param systems_data: collated results for all systems
-    :type systems_data: pandas.DataFrame
-    :return: table of pairs of systems and their similarity statistics
+    :type systems_data: pandas.DataFrame or EvaluationMatrix
+    :param matrix: also return the square matrix of same answer percentages, sharing a single comparison of the answers
+    :type matrix: bool
+    :return: table of pairs of systems and their similarity statistics, and the similarity matrix if requested
+    :rtype: pandas.DataFrame or (pandas.DataFrame, pandas.DataFrame)
+    """
+    agreement = _answer_agreement(systems_data)
+    similarity = _similarity_table(*agreement)
+    if matrix:
+        return similarity, _similarity_matrix(*agreement)
+    return similarity
+
+
+def system_similarity_matrix(systems_data):
+    """
+    Percentage of the questions answered by both systems that each pair of systems answered the same.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: pandas.DataFrame or EvaluationMatrix
+    :return: square matrix of same answer percentages indexed by system in both dimensions
     :rtype: pandas.DataFrame
     """
-    systems_data = drop_missing(systems_data)
-    systems = systems_data[SYSTEM].drop_duplicates().sort_values()
-    columns = ["System 1", "System 2", "Same Answer", "Same Answer %"]
-    results = pandas.DataFrame(columns=columns)
-    for x, y in itertools.combinations(systems, 2):
-        data_x = systems_data[systems_data[SYSTEM] == x]
-        data_y = systems_data[systems_data[SYSTEM] == y]
-        m = pandas.merge(data_x, data_y, on=QUESTION)
-        n = len(m)
-        logger.info("%d question/answer pairs in common for %s and %s" % (n, x, y))
-        same_answer = sum(m["%s_x" % ANSWER] == m["%s_y" % ANSWER])
-        same_answer_pct = 100.0 * same_answer / n
-        results = results.append(
-            pandas.DataFrame([[x, y, same_answer, same_answer_pct]], columns=columns))
+    return _similarity_matrix(*_answer_agreement(systems_data))
+
+
+def _similarity_table(systems, same_answer, in_common):
+    rows = []
+    for i, j in itertools.combinations(range(len(systems)), 2):
+        n = in_common[i, j]
+        logger.info("%d question/answer pairs in common for %s and %s" % (n, systems[i], systems[j]))
+        rows.append([systems[i], systems[j], same_answer[i, j], 100.0 * same_answer[i, j] / n])
+    results = pandas.DataFrame(rows, columns=["System 1", "System 2", "Same Answer", "Same Answer %"])
     results["Same Answer"] = results["Same Answer"].astype("int64")
     return results.set_index(["System 1", "System 2"])
 
 
+def _similarity_matrix(systems, same_answer, in_common):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        matrix = 100.0 * same_answer / in_common
+    return pandas.DataFrame(matrix, index=pandas.Index(systems, name=SYSTEM), columns=systems)
+
+
+def _answer_agreement(systems_data):
+    """
+    Count the questions each pair of systems answered the same and the questions they both answered.
+
+    Each system's column of answer ids in the evaluation matrix is compared against all the others at once.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: pandas.DataFrame or EvaluationMatrix
+    :return: sorted system names, square matrix of same answer counts, square matrix of questions in common
+    :rtype: (list of str, numpy.array, numpy.array)
+    """
+    matrix = evaluation_matrix(systems_data)
+    answered = matrix.judged()
+    answers = np.where(answered, matrix.answers, MISSING)
+    systems = matrix.systems
+    in_common = np.dot(answered.T.astype(np.int64), answered.astype(np.int64))
+    same_answer = np.array([((answers == answers[:, [i]]) & answered).sum(axis=0) for i in range(len(systems))],
+                           dtype=np.int64).reshape(len(systems), len(systems))
+    return systems, same_answer, in_common
+
+
 def compare_systems(systems_data, x, y, comparison_type):
     """
     On which questions did system x do better or worse than system y?
@@ -100,7 +222,7 @@ def compare_systems(systems_data, x, y, comparison_type):
     System x did better than system y if it correctly answered a question when system y did not, and vice versa.
 
     :param systems_data: collated results for all systems
-    :type systems_data: pandas.DataFrame
+    :type systems_data: pandas.DataFrame or EvaluationMatrix
     :param x: system name
     :type x: str
     :param y: system name
@@ -110,36 +232,236 @@ def compare_systems(systems_data, x, y, comparison_type):
     :return: all question/answer pairs from system x that were either better or worse than system y
     :rtype: pandas.DataFrame
     """
-
-    def col_name(type, system):
-        return type + " " + system
-
-    systems_data = drop_missing(systems_data)
-    systems_data = systems_data[systems_data[IN_PURVIEW]]
-    data_x = systems_data[systems_data[SYSTEM] == x]
-    data_y = systems_data[systems_data[SYSTEM] == y][[QUESTION, ANSWER, CONFIDENCE, CORRECT]]
-    questions = pandas.merge(data_x, data_y, on=QUESTION, how="left", suffixes=(" " + x, " " + y)).dropna()
-    n = len(questions)
+    matrix, correct, _ = _in_purview_correctness(systems_data)
+    i, j = matrix.system_index(x), matrix.system_index(y)
+    n = np.count_nonzero((correct[:, i] != MISSING) & (correct[:, j] != MISSING))
     logger.info("%d shared question/answer pairs between %s and %s" % (n, x, y))
-    x_correct = col_name(CORRECT, x)
-    y_correct = col_name(CORRECT, y)
     if comparison_type == "better":
-        a = questions[x_correct] == True
-        b = questions[y_correct] == False
+        rows = (correct[:, i] == 1) & (correct[:, j] == 0)
     elif comparison_type == "worse":
-        a = questions[x_correct] == False
-        b = questions[y_correct] == True
+        rows = (correct[:, i] == 0) & (correct[:, j] == 1)
     else:
         raise ValueError("Invalid comparison type %s" % comparison_type)
-    d = questions[a & b]
-    m = len(d)
+    m = np.count_nonzero(rows)
     logger.info("%d %s (%0.3f%%)" % (m, comparison_type, 100.0 * m / n))
-    d = d[[QUESTION, FREQUENCY,
-           col_name(ANSWER, x), col_name(CONFIDENCE, x), col_name(ANSWER, y), col_name(CONFIDENCE, y)]]
-    d = d.sort_values([col_name(CONFIDENCE, x), FREQUENCY, QUESTION], ascending=(False, False, True))
+    return _comparison_questions(matrix, rows, i, j)
+
+
+def _comparison_questions(matrix, rows, i, j):
+    """
+    Questions from a comparison of two systems in the format returned by compare_systems.
+
+    :param matrix: evaluation matrix
+    :type matrix: EvaluationMatrix
+    :param rows: boolean mask of the questions to include
+    :type rows: numpy.array
+    :param i: index of system x
+    :type i: int
+    :param j: index of system y
+    :type j: int
+    :return: questions with the answers and confidences of both systems
+    :rtype: pandas.DataFrame
+    """
+    data_x = matrix.system_frame(i, rows)
+    data_y = matrix.system_frame(j, rows)
+    x, y = matrix.systems[i], matrix.systems[j]
+    columns = [QUESTION, FREQUENCY,
+               "%s %s" % (ANSWER, x), "%s %s" % (CONFIDENCE, x), "%s %s" % (ANSWER, y), "%s %s" % (CONFIDENCE, y)]
+    d = pandas.DataFrame(dict(zip(columns, [data_x[QUESTION], data_x[FREQUENCY], data_x[ANSWER], data_x[CONFIDENCE],
+                                            data_y[ANSWER], data_y[CONFIDENCE]])), columns=columns)
+    d = d.sort_values([columns[3], FREQUENCY, QUESTION], ascending=(False, False, True))
     return d.set_index(QUESTION)
 
 
+def compare_all_systems(systems_data):
+    """
+    How often did each system do better or worse than each of the other systems?
+
+    The frequency weighted counts for all pairs of systems are computed with matrix products of the in-purview
+    correctness of every system in the evaluation matrix.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: pandas.DataFrame or EvaluationMatrix
+    :return: frequency of the in-purview questions both systems answered, and of those on which the first system did
+        better than, worse than, or the same as the second, for every ordered pair of systems
+    :rtype: pandas.DataFrame
+    """
+    matrix, correct, frequency = _in_purview_correctness(systems_data)
+    right = (correct == 1).astype(np.int64)
+    wrong = (correct == 0).astype(np.int64)
+    better = np.dot((right * frequency).T, wrong)
+    worse = np.dot((wrong * frequency).T, right)
+    same = np.dot((right * frequency).T, right) + np.dot((wrong * frequency).T, wrong)
+    rows = [[x, y, better[i, j] + worse[i, j] + same[i, j], better[i, j], worse[i, j], same[i, j]]
+            for (i, x), (j, y) in itertools.permutations(enumerate(matrix.systems), 2)]
+    comparison = pandas.DataFrame(rows, columns=["System 1", "System 2", "Shared", "Better", "Worse", "Same"])
+    return comparison.set_index(["System 1", "System 2"])
+
+
+def compare_all_systems_questions(systems_data):
+    """
+    The questions on which each system did better than each of the other systems.
+
+    Worse questions are not listed separately because system x did worse than system y on exactly the questions where
+    system y did better than system x.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: pandas.DataFrame or EvaluationMatrix
+    :return: generator of system x, system y, and the questions on which x did better than y in the format returned by
+        compare_systems
+    :rtype: generator of (str, str, pandas.DataFrame)
+    """
+    matrix, correct, _ = _in_purview_correctness(systems_data)
+    for (i, x), (j, y) in itertools.permutations(enumerate(matrix.systems), 2):
+        yield x, y, _comparison_questions(matrix, (correct[:, i] == 1) & (correct[:, j] == 0), i, j)
+
+
+def system_significance(systems_data, permutations=10000, bootstrap=1000, processes=None, seed=None, batch_size=100):
+    """
+    Significance of the difference in accuracy between every pair of systems.
+
+    Accuracy is the frequency of correctly answered questions divided by the frequency of in-purview questions, over
+    the in-purview questions both systems answered.
+
+    The paired permutation test randomly swaps the two systems' judgments for each question. Only questions on which
+    the systems disagree change the difference, so each permutation is a vector of random signs over those questions
+    and a batch of permutations for all pairs of systems is a single matrix product. The p-value is the fraction of
+    permutations with a difference at least as large as the observed one.
+
+    The paired bootstrap test resamples the questions with replacement, weighting each by its frequency, and gives a 95%
+    percentile interval for the difference. Its p-value is twice the fraction of replicates on the far side
+    of zero from the observed difference. The bootstrap bands of precision and ROC curves resample the same way.
+
+    Batches of permutations and bootstrap replicates are spread across a process pool.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: pandas.DataFrame or EvaluationMatrix
+    :param permutations: number of permutations
+    :type permutations: int
+    :param bootstrap: number of bootstrap replicates
+    :type bootstrap: int
+    :param processes: number of worker processes, by default the number of CPUs
+    :type processes: int
+    :param seed: random seed
+    :type seed: int
+    :param batch_size: number of permutations or replicates in each batch
+    :type batch_size: int
+    :return: accuracies, their difference, and significance for every pair of systems
+    :rtype: pandas.DataFrame
+    """
+    matrix, correct, frequency = _in_purview_correctness(systems_data)
+    pairs = list(itertools.combinations(range(len(matrix.systems)), 2))
+    first = np.array([i for i, _ in pairs], dtype=int)
+    second = np.array([j for _, j in pairs], dtype=int)
+    # Question by pair matrices of the questions both systems answered in purview and the differences in correctness.
+    shared = ((correct[:, first] != MISSING) & (correct[:, second] != MISSING)).astype(np.int64)
+    differences = ((correct[:, first] == 1).astype(np.int64) - (correct[:, second] == 1)) * shared
+    question_frequency = frequency.max(axis=1)
+    total = np.dot(question_frequency, shared)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        accuracy_1 = np.dot(question_frequency, (correct[:, first] == 1) * shared) / total.astype(float)
+        observed = np.dot(question_frequency, differences) / total.astype(float)
+    # Only questions that some pair of systems shares can be resampled, and only those on which some pair of systems
+    # disagrees can change the permuted differences.
+    rows = shared.any(axis=1) & (question_frequency > 0)
+    question_frequency, shared, differences = question_frequency[rows], shared[rows], differences[rows]
+    discordant = (differences != 0).any(axis=1)
+    # Pad the discordant questions to a whole number of bytes of random sign bits.
+    weighted_differences = np.zeros(((discordant.sum() + 7) // 8 * 8, len(pairs)))
+    weighted_differences[:discordant.sum()] = question_frequency[discordant][:, np.newaxis] * differences[discordant]
+    batches = [("permutation", size) for size in _batch_sizes(permutations, batch_size)] + \
+              [("bootstrap", size) for size in _batch_sizes(bootstrap, batch_size)]
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, size=len(batches))
+    batches = [(test, size, batch_seed) for (test, size), batch_seed in zip(batches, seeds)]
+    logger.info("%d permutations and %d bootstrap replicates of %d questions for %d pairs of systems" %
+                (permutations, bootstrap, len(question_frequency), len(pairs)))
+    pool = multiprocessing.Pool(processes, initializer=_initialize_significance,
+                                initargs=(weighted_differences, question_frequency.astype(float),
+                                          differences.astype(float), shared.astype(float)))
+    try:
+        results = pool.map(_significance_batch, batches)
+    finally:
+        pool.close()
+        pool.join()
+    extreme = sum(result for (test, _, _), result in zip(batches, results) if test == "permutation")
+    replicates = [result for (test, _, _), result in zip(batches, results) if test == "bootstrap"]
+    replicates = np.vstack(replicates) if replicates else np.full((1, len(pairs)), np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        lower, upper = np.nanpercentile(replicates, [2.5, 97.5], axis=0)
+        far_side = np.where(observed >= 0, (replicates <= 0).mean(axis=0), (replicates >= 0).mean(axis=0))
+    permutation_p = np.where((total == 0) | (permutations == 0), np.nan, (1.0 + extreme) / (1.0 + permutations))
+    bootstrap_p = np.where((total == 0) | (bootstrap == 0), np.nan, np.minimum(1.0, 2 * far_side))
+    significance = pandas.DataFrame({"System 1": [matrix.systems[i] for i, _ in pairs],
+                                     "System 2": [matrix.systems[j] for _, j in pairs],
+                                     "Shared": total,
+                                     "Accuracy 1": accuracy_1,
+                                     "Accuracy 2": accuracy_1 - observed,
+                                     "Difference": observed,
+                                     "Permutation p": permutation_p,
+                                     "Bootstrap p": bootstrap_p,
+                                     "Difference Lower": lower,
+                                     "Difference Upper": upper},
+                                    columns=["System 1", "System 2", "Shared", "Accuracy 1", "Accuracy 2", "Difference",
+                                             "Permutation p", "Bootstrap p", "Difference Lower", "Difference Upper"])
+    return significance.set_index(["System 1", "System 2"])
+
+
+def _batch_sizes(n, batch_size):
+    return [min(batch_size, n - start) for start in range(0, n, batch_size)]
+
+
+# Data shared by the significance test worker processes
+_significance_data = None
+
+
+def _initialize_significance(*data):
+    global _significance_data
+    _significance_data = data
+
+
+def _significance_batch(batch):
+    """
+    Run a batch of permutations or bootstrap replicates.
+
+    :return: for permutations, the number in which the absolute difference for each pair of systems is at least the
+        observed one; for bootstrap replicates, the difference for each replicate and pair of systems
+    :rtype: numpy.array
+    """
+    test, size, seed = batch
+    weighted_differences, question_frequency, differences, shared = _significance_data
+    random = np.random.RandomState(seed)
+    if test == "permutation":
+        # Flipping the sign of a question's difference subtracts it twice from the observed total. All the values are
+        # integers, so the totals are exact.
+        observed = weighted_differences.sum(axis=0)
+        bits = np.unpackbits(np.frombuffer(random.bytes(size * len(weighted_differences) // 8), np.uint8))
+        permuted = observed - 2 * np.dot(bits.reshape(size, -1).astype(float), weighted_differences)
+        return (np.abs(permuted) >= np.abs(observed)).sum(axis=0)
+    else:
+        n = len(question_frequency)
+        # Number of times each question is drawn in each replicate
+        draws = random.randint(0, n, size=(size, n)) + n * np.arange(size)[:, np.newaxis]
+        weights = np.bincount(draws.ravel(), minlength=size * n).reshape(size, n) * question_frequency
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.dot(weights, differences) / np.dot(weights, shared)
+
+
+def _in_purview_correctness(systems_data):
+    """
+    The correctness of in-purview answers in the evaluation matrix.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: pandas.DataFrame or EvaluationMatrix
+    :return: evaluation matrix, and question by system matrices of correctness (1 for correct, 0 for incorrect,
+        MISSING where there is no in-purview answer) and frequency (0 where there is no in-purview answer)
+    :rtype: (EvaluationMatrix, numpy.array, numpy.array)
+    """
+    matrix = evaluation_matrix(systems_data)
+    in_purview = matrix.judged() & (matrix.in_purview == 1)
+    return matrix, np.where(in_purview, matrix.correct, MISSING), np.where(in_purview, matrix.frequency, 0)
+
+
 def analyze_answers(systems_data, freq_le, freq_gr):
     """
     Statistics about all the answered questions in a test set broken down by system.
@@ -157,7 +479,7 @@ def analyze_answers(systems_data, freq_le, freq_gr):
     in_purview_percent = IN_PURVIEW + " %"
     correct_percent = CORRECT + " %"
     unique = "Unique"
-    systems_data = pandas.concat(systems_data).dropna()
+    systems_data = judged(concat_collated(systems_data).dropna())
     if freq_le is not None:
         systems_data = systems_data[systems_data[FREQUENCY] <= freq_le]
     if freq_gr is not None:
@@ -173,7 +495,7 @@ def analyze_answers(systems_data, freq_le, freq_gr):
         [total, unique, IN_PURVIEW, in_purview_percent, CORRECT, correct_percent]]
 
 
-def truth_coverage(corpus, truth, systems_data):
+def truth_coverage(corpus, truth, systems_data, answer_dictionary=None):
     """
     Statistics about which answers came from the truth set broken down by system.
 
@@ -183,22 +505,27 @@ def truth_coverage(corpus, truth, systems_data):
     :type truth: pandas.DataFrame
     :param systems_data: collated results for all systems
     :type systems_data: pandas.DataFrame
+    :param answer_dictionary: dictionary used to match answers by key instead of by text
+    :type answer_dictionary: AnswerDictionary
     :return: truth coverage summary statistics
     :rtype: pandas.DataFrame
     """
-    truth_answers = pandas.merge(corpus, truth, on=ANSWER_ID)[ANSWER].drop_duplicates()
+    if answer_dictionary is None:
+        answer_dictionary = AnswerDictionary()
+    truth_answers = np.unique(answer_dictionary.keys(pandas.merge(corpus, truth, on=ANSWER_ID)[ANSWER]))
     n = len(corpus)
     m = len(truth_answers)
     logger.info("%d answers out of %d possible answers in truth (%0.3f%%)" % (m, n, 100.0 * m / n))
-    systems_data = pandas.concat(systems_data).dropna()
+    systems_data = judged(concat_collated(systems_data).dropna())
+    in_truth = np.in1d(answer_dictionary.keys(systems_data[ANSWER]), truth_answers)
     answers = systems_data.groupby(SYSTEM)[[CORRECT]].count()
-    answers_in_truth = systems_data[systems_data[ANSWER].isin(truth_answers)].groupby(SYSTEM)[[ANSWER]]
+    answers_in_truth = systems_data[in_truth].groupby(SYSTEM)[[ANSWER]]
     summary = answers_in_truth.count()
     summary["Answers"] = answers
     summary = summary.rename(columns={ANSWER: "Answers in Truth"})
     summary["Answers in Truth %"] = 100 * summary["Answers in Truth"] / summary["Answers"]
     correct_answers = systems_data[systems_data[CORRECT]]
-    correct_answers_in_truth = correct_answers[correct_answers[ANSWER].isin(truth_answers)]
+    correct_answers_in_truth = systems_data[systems_data[CORRECT] & in_truth]
     summary["Correct Answers"] = correct_answers.groupby(SYSTEM)[CORRECT].count()
     summary["Correct Answers in Truth"] = correct_answers_in_truth.groupby(SYSTEM)[CORRECT].count()
     summary["Correct Answers in Truth %"] = 100 * summary["Correct Answers in Truth"] / summary["Correct Answers"]
@@ -228,6 +555,42 @@ def long_tail_fat_head(frequency_cutoff, systems_data):
     return fat_head, long_tail
 
 
+def long_tail_sweep(systems_data):
+    """
+    Fat head and long tail accuracy statistics at every frequency cutoff.
+
+    This gives the same totals and percentages as long_tail_fat_head for each distinct question frequency, but sorts
+    each system's questions by frequency once and takes the statistics at all the cutoffs from cumulative sums.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: list of pandas.DataFrame
+    :return: fat head and long tail statistics for each system and frequency cutoff
+    :rtype: pandas.DataFrame
+    """
+    systems_data = judged(concat_collated(systems_data).dropna())
+    sweeps = []
+    for system, data in systems_data.groupby(SYSTEM):
+        if data.empty:
+            continue
+        data = data.sort_values(FREQUENCY, kind="mergesort")
+        frequency = data[FREQUENCY].values
+        cutoffs = np.unique(frequency)
+        # Number of questions in the long tail at each cutoff
+        tail = np.searchsorted(frequency, cutoffs, side="right")
+        in_purview = np.append(0, np.cumsum(data[IN_PURVIEW].values))
+        correct = np.append(0, np.cumsum(data[CORRECT].values))
+        sweep = pandas.DataFrame({SYSTEM: system, "Frequency Cutoff": cutoffs}, columns=[SYSTEM, "Frequency Cutoff"])
+        for part, total, part_in_purview, part_correct in [
+            ("Head", len(data) - tail, in_purview[-1] - in_purview[tail], correct[-1] - correct[tail]),
+            ("Tail", tail, in_purview[tail], correct[tail])]:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                sweep[part + " Total"] = total
+                sweep[part + " " + IN_PURVIEW + " %"] = part_in_purview / total.astype(float) * 100.0
+                sweep[part + " " + CORRECT + " %"] = part_correct / part_in_purview.astype(float) * 100.0
+        sweeps.append(sweep)
+    return pandas.concat(sweeps).set_index([SYSTEM, "Frequency Cutoff"])
+
+
 def in_purview_disagreement(systems_data):
     """
     Return collated data where in-purview judgments are not unanimous for a question.
@@ -235,19 +598,64 @@ def in_purview_disagreement(systems_data):
     These questions' purview should be rejudged to make them consistent.
 
     :param systems_data: collated results for all systems
-    :type systems_data: pandas.DataFrame
+    :type systems_data: pandas.DataFrame or EvaluationMatrix
     :return: subset of collated data where the purview judgments are not unanimous for a question
     :rtype: pandas.DataFrame
     """
-    question_groups = systems_data[[QUESTION, IN_PURVIEW]].groupby(QUESTION)
-    index = question_groups.filter(lambda qg: len(qg[IN_PURVIEW].unique()) > 1).index
-    purview_disagreement = systems_data.loc[index]
-    m = len(purview_disagreement[QUESTION].drop_duplicates())
+    matrix = evaluation_matrix(systems_data)
+    # Missing judgments count as a distinct judgment, so take the range of the judgments of the answered cells.
+    in_purview = matrix.in_purview.astype(np.int64)
+    highest = np.where(matrix.answered, in_purview, MISSING - 1).max(axis=1)
+    lowest = np.where(matrix.answered, in_purview, 2).min(axis=1)
+    disagreement = highest > lowest
+    m = np.count_nonzero(disagreement)
     if m:
-        n = len(systems_data[QUESTION].drop_duplicates())
+        n = len(matrix.questions)
         logger.warning("%d out of %d questions have non-unanimous in-purview judgments (%0.3f%%)"
                        % (m, n, 100.0 * m / n))
-    return purview_disagreement
+    return matrix.collated(matrix.answered & disagreement[:, np.newaxis])
+
+
+def in_purview_disagreement_rates(systems_data):
+    """
+    How often each pair of systems' in-purview judgments disagree.
+
+    As in in_purview_disagreement, a missing judgment counts as a distinct judgment. Each of the three judgments is a
+    question by system indicator matrix, so the number of questions on which every pair of systems agrees is a sum of
+    matrix products. The weighted percentage weights each question by its frequency.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: pandas.DataFrame or EvaluationMatrix
+    :return: questions answered by both systems, the number of them with different in-purview judgments, and the
+        unweighted and frequency-weighted disagreement percentages for each pair of systems
+    :rtype: pandas.DataFrame
+    """
+    matrix = evaluation_matrix(systems_data)
+    frequency = np.where(matrix.answered, matrix.frequency, 0).max(axis=1).astype(float)
+    answered = matrix.answered.astype(float)
+    questions = np.dot(answered.T, answered)
+    weighted_questions = np.dot(answered.T * frequency, answered)
+    agreements = np.zeros_like(questions)
+    weighted_agreements = np.zeros_like(questions)
+    for judgment in [0, 1, MISSING]:
+        judged = (matrix.answered & (matrix.in_purview == judgment)).astype(float)
+        agreements += np.dot(judged.T, judged)
+        weighted_agreements += np.dot(judged.T * frequency, judged)
+    first, second = np.triu_indices(len(matrix.systems), 1)
+    systems = np.array(matrix.systems, dtype=object)
+    disagreements = (questions - agreements)[first, second]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates = pandas.DataFrame({"System 1": systems[first],
+                                  "System 2": systems[second],
+                                  "Questions": questions[first, second].astype(np.int64),
+                                  "Disagreements": disagreements.astype(np.int64),
+                                  "Disagreement %": 100.0 * disagreements / questions[first, second],
+                                  "Weighted Disagreement %":
+                                      100.0 * (weighted_questions - weighted_agreements)[first, second] /
+                                      weighted_questions[first, second]},
+                                 columns=["System 1", "System 2", "Questions", "Disagreements", "Disagreement %",
+                                          "Weighted Disagreement %"])
+    return rates.set_index(["System 1", "System 2"])
 
 
 def _get_in_purview_judgment(question):
@@ -267,7 +675,7 @@ def _get_in_purview_judgment(question):
         return _get_in_purview_judgment(question)
 
 
-def _judge_answer(row):
+def _judge_answer(question, answer):
     judgment = raw_input((textwrap.dedent("""
     ******** JUDGE THE ANSWER TO THE FOLLOWING QUESTION ********
     QUESTION:  {0}
@@ -275,42 +683,82 @@ def _judge_answer(row):
     (1) CORRECT
     (2) INCORRECT
 
-    YOUR JUDGMENT: """).format(row[1][QUESTION].encode('ascii', 'ignore'), row[1][ANSWER].encode('ascii', 'ignore'))))
+    YOUR JUDGMENT: """).format(question.encode('ascii', 'ignore'), answer.encode('ascii', 'ignore'))))
 
     if judgment == '1':
         return True
     elif judgment == '2':
         return False
     else:
-        return _judge_answer(row)
-
+        return _judge_answer(question, answer)
 
-def in_purview_disagreement_evaluate(systems_data, output_file):
 
-    purview_disagreement = in_purview_disagreement(systems_data)
-    questions_to_judge = purview_disagreement[QUESTION].unique()
-    for question in questions_to_judge:
+def in_purview_disagreement_evaluate(systems_data, journal_file):
+    """
+    Interactively rejudge the purview of questions whose in-purview judgments are not unanimous.
 
-        purview_judgment = _get_in_purview_judgment(question)
+    When a question goes from out of purview to in purview its answers are also judged for correctness.
 
-        current_question_rows = systems_data[systems_data[QUESTION] == question]
-        for row in current_question_rows.iterrows():
-            index = row[0]
-            original_judgment = row[1]["In Purview"]
+    Judgments are appended to a journal as each question is judged. If the journal already exists its judgments are
+    applied to the collated data first and the questions in it are not judged again, so an interrupted assessment
+    resumes where it left off. The rows for each question are found through an index built once up front.
 
-            if purview_judgment != original_judgment:
-                if purview_judgment:
-                    systems_data.ix[index, IN_PURVIEW] = True
-                    systems_data.ix[index, CORRECT] = _judge_answer(row)
-                else:
-                    systems_data.ix[index, IN_PURVIEW] = False
-                    systems_data.ix[index, CORRECT] = False
-            to_csv(output_file, systems_data, index=False)
-        # break
-    # print systems_data[systems_data[QUESTION] == question
+    :param systems_data: collated results for all systems
+    :type systems_data: pandas.DataFrame
+    :param journal_file: journal of question, system, answer, in purview and correct for each rejudged row
+    :type journal_file: str
+    :return: collated results with the rejudged purviews
+    :rtype: pandas.DataFrame
+    """
+    systems_data = systems_data.reset_index(drop=True)
+    journal = DataFrameCheckpoint(journal_file, [QUESTION, SYSTEM, ANSWER, IN_PURVIEW, CORRECT])
+    try:
+        if journal.recovered:
+            _replay_judgments(systems_data, from_csv(journal_file))
+            logger.info("Recovered judgments of %d questions from %s" % (len(journal.recovered), journal_file))
+        questions = in_purview_disagreement(systems_data)[QUESTION].unique()
+        questions = [question for question in questions if question not in journal.recovered]
+        rows = systems_data.groupby(QUESTION).indices
+        for i, question in enumerate(questions, 1):
+            logger.info(percent_complete_message("Question", i, len(questions)))
+            purview_judgment = _get_in_purview_judgment(question)
+            for row in rows[question]:
+                if purview_judgment != systems_data.at[row, IN_PURVIEW]:
+                    systems_data.at[row, IN_PURVIEW] = purview_judgment
+                    if purview_judgment:
+                        systems_data.at[row, CORRECT] = _judge_answer(question, systems_data.at[row, ANSWER])
+                    else:
+                        systems_data.at[row, CORRECT] = False
+                    journal.write(question, systems_data.at[row, SYSTEM], systems_data.at[row, ANSWER],
+                                  systems_data.at[row, IN_PURVIEW], systems_data.at[row, CORRECT])
+            journal.flush()
+    finally:
+        journal.close()
     return systems_data
 
 
+def _replay_judgments(systems_data, judgments):
+    """
+    Apply journaled judgments to the collated rows with the same question, system and answer.
+
+    :param systems_data: collated results for all systems, modified in place
+    :type systems_data: pandas.DataFrame
+    :param judgments: question, system, answer, in purview, and correct
+    :type judgments: pandas.DataFrame
+    """
+
+    def key(frame):
+        return pandas.MultiIndex.from_arrays([frame[column].astype(object).fillna("")
+                                              for column in [QUESTION, SYSTEM, ANSWER]])
+
+    rows = key(systems_data).get_indexer(key(judgments))
+    m = np.count_nonzero(rows == -1)
+    if m:
+        logger.warning("%d of %d journaled judgments are not in the collated data" % (m, len(judgments)))
+    for column in [IN_PURVIEW, CORRECT]:
+        systems_data.loc[rows[rows != -1], column] = judgments[column].values[rows != -1]
+
+
 def oracle_combination(systems_data, system_names, oracle_name):
     """
     Combine results from multiple systems into a single oracle system. The oracle system gets a question correct if any
@@ -321,7 +769,7 @@ def oracle_combination(systems_data, system_names, oracle_name):
     unanimous. The 'themis analyze purview' command finds when this is not the case.)
 
     :param systems_data: collated results for all systems
-    :type systems_data: pandas.DataFrame
+    :type systems_data: pandas.DataFrame or EvaluationMatrix
     :param system_names: names of systems to combine
     :type system_names: list of str
     :param oracle_name: the name of the combined system
@@ -329,51 +777,128 @@ def oracle_combination(systems_data, system_names, oracle_name):
     :return: oracle results in collated format
     :rtype: pandas.DataFrame
     """
-    def log_correct(system_data, name):
-        n = len(system_data)
-        m = sum(system_data[CORRECT])
-        logger.info("%d of %d correct in %s (%0.3f%%)" % (m, n, name, 100.0 * m / n))
-
-    percentile = "Percentile"
-    systems_data = drop_missing(systems_data)
-    # Extract the systems of interest and map confidences to percentile rank.
-    systems = []
-    for system_name in system_names:
-        system = systems_data[systems_data[SYSTEM] == system_name].set_index(QUESTION)
-        system[percentile] = __standardize_confidence(system)
-        log_correct(system, system_name)
-        systems.append(system)
-    # Get the questions asked to all the systems.
-    questions = functools.reduce(lambda m, i: m.intersection(i), (system.index for system in systems))
-    # Start the oracle with a copy of one of the systems.
-    oracle = systems[0].loc[questions].copy()
-    oracle = oracle.drop([ANSWER, percentile], axis="columns")
+    matrix = evaluation_matrix(systems_data)
+    judged = matrix.judged()
+    columns = [matrix.system_index(system_name) for system_name in system_names]
+    # Map each system's confidences to percentile rank.
+    percentiles = np.full((len(matrix.questions), len(columns)), np.nan)
+    for i, column in enumerate(columns):
+        rows = judged[:, column]
+        percentiles[rows, i] = pandas.Series(matrix.confidence[rows, column]).rank(pct=True).values
+        _log_correct(np.count_nonzero(matrix.correct[rows, column] == 1), np.count_nonzero(rows), system_names[i])
+    # Get the questions asked to all the systems and start the oracle with a copy of one of the systems.
+    questions = np.flatnonzero(judged[:, columns].all(axis=1))
+    oracle = matrix.system_frame(columns[0], questions)
     oracle[SYSTEM] = oracle_name
     # An oracle question is in purview if all systems mark it as in purview. There should be consensus on this.
-    systems_in_purview = [system.loc[questions][[IN_PURVIEW]] for system in systems]
-    oracle[[IN_PURVIEW]] = functools.reduce(lambda m, x: m & x, systems_in_purview)
+    in_purview = (matrix.in_purview[questions][:, columns] == 1).all(axis=1)
+    oracle[IN_PURVIEW] = in_purview
     # An oracle question is correct if any system gets it right.
-    systems_correct = [system.loc[questions][[CORRECT]] for system in systems]
-    oracle[[CORRECT]] = functools.reduce(lambda m, x: m | x, systems_correct)
-    oracle.loc[oracle[IN_PURVIEW] == False, CORRECT] = False
-    # If the oracle answer is correct, use the highest confidence.
-    confidences = [system[[percentile]].rename(columns={percentile: system[SYSTEM][0]}) for system in systems]
-    system_confidences = functools.reduce(lambda m, x: pandas.merge(m, x, left_index=True, right_index=True),
-                                          confidences)
-    correct = oracle[CORRECT].astype("bool")
-    oracle.loc[correct, CONFIDENCE] = system_confidences[correct].max(axis=1)
-    oracle.loc[correct, ANSWERING_SYSTEM] = system_confidences[correct].idxmax(axis=1)
-    # If the question is out of purview or the answer is incorrect, use the lowest confidence.
-    oracle.loc[~correct, CONFIDENCE] = system_confidences[~correct].min(axis=1)
-    oracle.loc[~correct, ANSWERING_SYSTEM] = system_confidences[~correct].idxmin(axis=1)
+    correct = (matrix.correct[questions][:, columns] == 1).any(axis=1) & in_purview
+    oracle[CORRECT] = correct
+    # If the oracle answer is correct, use the highest confidence. If the question is out of purview or the answer is
+    # incorrect, use the lowest confidence.
+    percentiles = percentiles[questions]
+    answering = np.where(correct, percentiles.argmax(axis=1), percentiles.argmin(axis=1))
+    oracle[CONFIDENCE] = percentiles[np.arange(len(questions)), answering]
+    oracle[ANSWERING_SYSTEM] = np.array(system_names, dtype=object)[answering]
     # Use the answer produced by the system incorporated into the oracle.
-    oracle = oracle.reset_index()
-    oracle[ANSWER] = pandas.merge(systems_data, oracle,
-                                  left_on=[QUESTION, SYSTEM], right_on=[QUESTION, ANSWERING_SYSTEM])[ANSWER]
-    log_correct(oracle, oracle_name)
+    oracle[ANSWER] = matrix.answer_text[matrix.answers[questions, np.array(columns, dtype=np.int64)[answering]]]
+    _log_correct(np.count_nonzero(correct), len(oracle), oracle_name)
     return oracle
 
 
+def _log_correct(m, n, name):
+    logger.info("%d of %d correct in %s (%0.3f%%)" % (m, n, name, 100.0 * m / n))
+
+
+def oracle_sweep(systems_data, max_size, system_names=None):
+    """
+    Frequency weighted accuracy of the oracle combination of every subset of systems up to a given size.
+
+    The oracle of a set of systems is defined as in oracle_combination. Each system's answered, in purview and correct
+    questions are packed into bit arrays, so that the oracle of a set of systems is computed with bitwise AND and OR
+    and its frequency weighted counts with a popcount table of 16 bit words. Questions are grouped into words of the
+    same frequency, so every word's count is weighted by a single frequency.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: pandas.DataFrame or EvaluationMatrix
+    :param max_size: largest number of systems to combine
+    :type max_size: int
+    :param system_names: names of systems to combine, by default all of them
+    :type system_names: list of str
+    :return: frequency of the questions answered by all the systems in each set, of those that are in purview, and of
+        those that the oracle gets correct, ordered from most to least accurate
+    :rtype: pandas.DataFrame
+    """
+    matrix = evaluation_matrix(systems_data)
+    columns = range(len(matrix.systems)) if system_names is None else \
+        [matrix.system_index(system_name) for system_name in sorted(system_names)]
+    systems = [matrix.systems[i] for i in columns]
+    answered = matrix.judged()[:, columns]
+    in_purview = answered & (matrix.in_purview[:, columns] == 1)
+    correct = answered & (matrix.correct[:, columns] == 1)
+    frequency = np.where(answered, matrix.frequency[:, columns], 0)
+    word_frequency, (answered, in_purview, correct) = \
+        _pack_questions(frequency.max(axis=1), [answered, in_purview, correct])
+
+    def weighted(bits):
+        return np.dot(POPCOUNT.take(bits), word_frequency)
+
+    rows = []
+
+    def extend(subset, subset_answered, subset_in_purview, subset_correct):
+        for i in range(subset[-1] + 1 if subset else 0, len(systems)):
+            combined = subset + [i]
+            combined_answered = answered[i] if subset_answered is None else subset_answered & answered[i]
+            combined_in_purview = in_purview[i] if subset_in_purview is None else subset_in_purview & in_purview[i]
+            combined_correct = correct[i] if subset_correct is None else subset_correct | correct[i]
+            rows.append(["+".join(systems[j] for j in combined), len(combined), weighted(combined_answered),
+                         weighted(combined_in_purview), weighted(combined_correct & combined_in_purview)])
+            if len(combined) < max_size:
+                extend(combined, combined_answered, combined_in_purview, combined_correct)
+
+    extend([], None, None, None)
+    sweep = pandas.DataFrame(rows, columns=["Systems", "Size", "Questions", IN_PURVIEW, CORRECT])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sweep["Accuracy"] = sweep[CORRECT] / sweep[IN_PURVIEW].astype(np.float64)
+    sweep = sweep.sort_values(["Accuracy", "Size", "Systems"], ascending=(False, True, True))
+    return sweep.set_index("Systems")
+
+
+# Number of set bits in each 16 bit word
+POPCOUNT = np.array([bin(i).count("1") for i in range(1 << 16)], dtype=np.uint8)
+
+
+def _pack_questions(frequency, matrices):
+    """
+    Pack question by system boolean matrices into system by 16 bit word bit arrays.
+
+    Questions are sorted by frequency and each frequency's questions padded to a whole number of words, so that all
+    the questions in a word have the same frequency.
+
+    :param frequency: frequency of each question
+    :type frequency: numpy.array
+    :param matrices: boolean matrices with a row for each question and a column for each system
+    :type matrices: list of numpy.array
+    :return: frequency of the questions in each word, and the packed matrices with a row for each system
+    :rtype: (numpy.array, list of numpy.array)
+    """
+    distinct, counts = np.unique(frequency, return_counts=True)
+    padded = 16 * ((counts + 15) // 16)
+    group_start = np.append(0, np.cumsum(padded)[:-1])
+    order = np.argsort(frequency, kind="mergesort")
+    # Position of each question in the padded layout: its group's start plus its rank within the group
+    rank = np.arange(len(order)) - np.repeat(np.append(0, np.cumsum(counts)[:-1]), counts)
+    position = np.repeat(group_start, counts) + rank
+    packed = []
+    for matrix in matrices:
+        bits = np.zeros((padded.sum(), matrix.shape[1]), dtype=bool)
+        bits[position] = matrix[order]
+        packed.append(np.ascontiguousarray(np.packbits(bits, axis=0).T).view(np.uint16))
+    return np.repeat(distinct, padded // 16), packed
+
+
 def _create_combined_fallback_system_at_threshold(default_systems_data, secondary_system_data, threshold):
     """
     Combine results from two systems into a single fallback system. The default system will answer the question if
@@ -407,38 +932,33 @@ def fallback_combination(systems_data, default_system, secondary_system):
     the confidence is above a certain threshold. This method will find the optimal confidence threshold.
 
     :param systems_data: collated results for the input systems
-    :type systems_data: pandas.DataFrame
+    :type systems_data: pandas.DataFrame or EvaluationMatrix
     :param default_system: the name of the default system (if confidence > t)
     :type default_system: str
     :param secondary_system: the name of the fallback system (if default_confidence < t)
     :type secondary_system: str
-    :return: Fallback results in collated format
-    :rtype: pandas.DataFrame
+    :return: Fallback results in collated format and the precision of the combination at every candidate threshold
+    :rtype: (pandas.DataFrame, pandas.DataFrame)
     """
-    systems_data = drop_missing(systems_data)
-
-    default_system_data = systems_data[systems_data[SYSTEM] == default_system]
-    secondary_system_data = systems_data[systems_data[SYSTEM] == secondary_system]
-
-    intersecting_questions = set(default_system_data[QUESTION]).intersection(set(secondary_system_data[QUESTION]))
-
-    logger.warn("{0} questions in default system".format(len(default_system_data)))
-    logger.warn("{0} questions in secondary system".format(len(secondary_system_data)))
-    logger.warn("{0} questions in overlapping set".format(len(intersecting_questions)))
-
-    default_system_data = default_system_data[default_system_data[QUESTION].isin(intersecting_questions)]
-    secondary_system_data = secondary_system_data[secondary_system_data[QUESTION].isin(intersecting_questions)]
-
-    unique_confidences = default_system_data[CONFIDENCE].unique()
-
-    best_threshold, best_precision = 0, 0
-    for threshold in unique_confidences:
-        combined_system = _create_combined_fallback_system_at_threshold(default_system_data, secondary_system_data, threshold)
-
-        system_precision = precision(combined_system, 0)
-        if system_precision > best_precision:
-            best_precision = system_precision
-            best_threshold = threshold
+    matrix = evaluation_matrix(systems_data)
+    judged = matrix.judged()
+    default_column, secondary_column = matrix.system_index(default_system), matrix.system_index(secondary_system)
+    intersecting_questions = judged[:, default_column] & judged[:, secondary_column]
+
+    logger.warn("{0} questions in default system".format(np.count_nonzero(judged[:, default_column])))
+    logger.warn("{0} questions in secondary system".format(np.count_nonzero(judged[:, secondary_column])))
+    logger.warn("{0} questions in overlapping set".format(np.count_nonzero(intersecting_questions)))
+
+    default_system_data = matrix.system_frame(default_column, intersecting_questions)
+    secondary_system_data = matrix.system_frame(secondary_column, intersecting_questions)
+
+    curve = fallback_precision_curve(default_system_data, secondary_system_data)
+    # Take the first threshold with the highest precision.
+    best = curve[PRECISION].fillna(0).values.argmax() if len(curve) else None
+    if best is not None and curve[PRECISION].iloc[best] > 0:
+        best_threshold, best_precision = curve[THRESHOLD].iloc[best], curve[PRECISION].iloc[best]
+    else:
+        best_threshold, best_precision = 0, 0
 
     logger.info("Default system accuracy:   {0}%".format(str(precision(default_system_data, 0) * 100)[:4]))
     logger.info("Secondary system accuracy: {0}%".format(str(precision(secondary_system_data, 0) * 100)[:4]))
@@ -453,7 +973,42 @@ def fallback_combination(systems_data, default_system, secondary_system):
     logger.info("Questions answered by {0}: {1}%".format(default_system, str(100 * float(len(best_system[best_system[ANSWERING_SYSTEM] == default_system])) / len(best_system))[:4]))
 
     best_system[CONFIDENCE] = __standardize_confidence(best_system)
-    return best_system
+    return best_system, curve
+
+
+def fallback_precision_curve(default_system_data, secondary_system_data):
+    """
+    Precision of the fallback combination of two systems at each unique confidence of the default system.
+
+    Every question is answered by the fallback system, so its precision at threshold t is the correct frequency of the
+    default system's answers with confidence of at least t plus that of the secondary system's answers to the remaining
+    questions, divided by the corresponding in-purview frequencies. Both are computed for all thresholds at once by
+    attempted_frequencies, giving the secondary system's answers the highest default confidence for their question.
+
+    :param default_system_data: collated results for the default system, restricted to the questions both systems answer
+    :type default_system_data: pandas.DataFrame
+    :param secondary_system_data: collated results for the secondary system, restricted to the same questions
+    :type secondary_system_data: pandas.DataFrame
+    :return: precision of the combined system at each threshold, in the order the confidences appear in the default
+        system
+    :rtype: pandas.DataFrame
+    """
+    ts = default_system_data[CONFIDENCE].unique()
+    questions, _ = pandas.factorize(np.concatenate([default_system_data[QUESTION].values.astype(object),
+                                                    secondary_system_data[QUESTION].values.astype(object)]))
+    default_questions, secondary_questions = questions[:len(default_system_data)], questions[len(default_system_data):]
+    default_confidence = pandas.Series(default_system_data[CONFIDENCE].values).groupby(default_questions).max()
+    secondary_system_data = secondary_system_data.assign(
+        **{CONFIDENCE: default_confidence.reindex(secondary_questions).values})
+    default_correct, default_in_purview, _ = attempted_frequencies(default_system_data, ts)
+    replaced_correct, replaced_in_purview, _ = attempted_frequencies(secondary_system_data, ts)
+    frequency = secondary_system_data[FREQUENCY].values.astype(np.int64)
+    correct = default_correct + frequency[(secondary_system_data[CORRECT] == True).values].sum() - replaced_correct
+    in_purview = default_in_purview + frequency[(secondary_system_data[IN_PURVIEW] == True).values].sum() - \
+        replaced_in_purview
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ps = np.where(in_purview > 0, correct / in_purview.astype(np.float64), np.nan)
+    return pandas.DataFrame({THRESHOLD: ts, PRECISION: ps}, columns=[THRESHOLD, PRECISION])
 
 
 def voting_router(systems_data, system_names, voting_name):
@@ -461,7 +1016,7 @@ def voting_router(systems_data, system_names, voting_name):
     Combine results from multiple systems into a single that uses voting to decide which system should answer.
 
     :param systems_data: collated results for all systems.
-    :type systems_data: pandas.DataFrame
+    :type systems_data: pandas.DataFrame or EvaluationMatrix
     :param system_names: names of systems to combine
     :type system_names: list of str
     :param voting_name: the name of the combined system
@@ -469,47 +1024,30 @@ def voting_router(systems_data, system_names, voting_name):
     :return: voting system results in collated format
     :rtype: pandas.DataFrame
     """
-    def log_correct(system_data, name):
-        n = len(system_data)
-        m = sum(system_data[CORRECT])
-        logger.info("%d of %d correct in %s (%0.3f%%)" % (m, n, name, 100.0 * m / n))
-
-    systems_data = drop_missing(systems_data)
-    systems = []
-    for system_name in system_names:
-        system = systems_data[systems_data[SYSTEM] == system_name].set_index(QUESTION)
-        log_correct(system, system_name)
-        systems.append(system)
-
-        # Calculate the precision and question_attempted for each threshold, use it for standardized confidences
-        ts = confidence_thresholds(system, False)
-        ps = [precision(system, t) for t in ts]
-        qas = [questions_attempted(system, t) for t in ts]
-        system['pgc'] = __standardize_confidence(system, method='precision')
-        # system.apply(lambda x: precision_grounded_confidence(ts, ps, qas, x[CONFIDENCE],
-        #                                                                 method='precision_only'), axis=1)
-
-    # Get the questions asked to all the systems.
-    questions = functools.reduce(lambda m, i: m.intersection(i), (system.index for system in systems))
-    # Start the voting results with a copy of one of the systems using only the intersecting questions
-    voting = systems[0].loc[questions].copy()
-    voting = voting.drop([ANSWER, CONFIDENCE, "pgc", CORRECT], axis="columns")
+    matrix = evaluation_matrix(systems_data)
+    judged = matrix.judged()
+    columns = [matrix.system_index(system_name) for system_name in system_names]
+    # Use the precision at each system's confidence thresholds as standardized confidences.
+    pgcs = np.full((len(matrix.questions), len(columns)), np.nan)
+    for i, column in enumerate(columns):
+        system = matrix.system_frame(column, judged[:, column])
+        _log_correct(np.count_nonzero(system[CORRECT]), len(system), system_names[i])
+        pgcs[judged[:, column], i] = __standardize_confidence(system, method='precision').values
+
+    # Get the questions asked to all the systems and start the voting results with a copy of one of the systems.
+    questions = np.flatnonzero(judged[:, columns].all(axis=1))
+    voting = matrix.system_frame(columns[0], questions)
     voting[SYSTEM] = voting_name
 
     # Find the best precision grounded confidences to find the top system.
-    pgcs = [system[['pgc']].rename(columns={'pgc': system[SYSTEM][0]}) for system in systems]
-    system_pgcs = functools.reduce(lambda m, x: pandas.merge(m, x, left_index=True, right_index=True), pgcs)
-    rows = [True for x in range(0, len(voting))]
-    voting.loc[rows, ANSWERING_SYSTEM] = system_pgcs[rows].idxmax(axis=1)
-    voting.loc[rows, CONFIDENCE] = system_pgcs[rows].max(axis=1)
-    #voting.loc[rows, 'PGC'] = system_pgcs[rows].max(axis=1)
-
-    voting = voting.reset_index()
-    voting[ANSWER] = pandas.merge(systems_data, voting,
-                                  left_on=[QUESTION, SYSTEM], right_on=[QUESTION, ANSWERING_SYSTEM])[ANSWER]
-    voting[CORRECT] = pandas.merge(systems_data, voting,
-                                   left_on=[QUESTION, SYSTEM], right_on=[QUESTION, ANSWERING_SYSTEM])[CORRECT]
-    log_correct(voting, voting_name)
+    pgcs = pgcs[questions]
+    answering = np.where(np.isnan(pgcs), -np.inf, pgcs).argmax(axis=1)
+    answering_columns = np.array(columns, dtype=np.int64)[answering]
+    voting[ANSWERING_SYSTEM] = np.array(system_names, dtype=object)[answering]
+    voting[CONFIDENCE] = pgcs[np.arange(len(questions)), answering]
+    voting[ANSWER] = matrix.answer_text[matrix.answers[questions, answering_columns]]
+    voting[CORRECT] = matrix.correct[questions, answering_columns] == 1
+    _log_correct(np.count_nonzero(voting[CORRECT]), len(voting), voting_name)
     return voting
 
 
@@ -526,7 +1064,7 @@ def filter_judged_answers(systems_data, correct, system_names):
     :return: set of in-purview questions with answers judged either correct or incorrect
     :rtype: pandas.DataFrame
     """
-    systems_data = pandas.concat(systems_data).dropna()
+    systems_data = judged(concat_collated(systems_data).dropna())
     if system_names is not None:
         systems_data = systems_data[systems_data[SYSTEM].isin(system_names)]
     filtered = systems_data[(systems_data[IN_PURVIEW] == True) & (systems_data[CORRECT] == correct)]
@@ -537,7 +1075,33 @@ def filter_judged_answers(systems_data, correct, system_names):
     return filtered
 
 
-def add_judgments_and_frequencies_to_qa_pairs(qa_pairs, judgments, question_frequencies, remove_newlines):
+def add_judgments_and_frequencies_to_qa_pairs(qa_pairs, judgments, question_frequencies, remove_newlines,
+                                              answer_dictionary=None):
+    """
+    Collate system answer confidences and annotator judgments by question/answer pair for a single system.
+
+    See collate_systems.
+
+    :param qa_pairs: question, answer, and confidence provided by a Q&A system
+    :type qa_pairs: pandas.DataFrame
+    :param judgments: question, answer or answer key, in purview, and judgement provided by annotators
+    :type judgments: pandas.DataFrame
+    :param question_frequencies: question and question frequency in the test set
+    :type question_frequencies: pandas.DataFrame
+    :param remove_newlines: join judgments on answers with newlines removed
+    :type remove_newlines: bool
+    :param answer_dictionary: dictionary used to join on answer keys instead of answer text
+    :type answer_dictionary: AnswerDictionary
+    :return: question and answer pairs with confidence, in purview, judgement and question frequency
+    :rtype: pandas.DataFrame
+    """
+    collated = collate_systems([(None, qa_pairs)], judgments, question_frequencies, remove_newlines,
+                               answer_dictionary)
+    return collated.drop(SYSTEM, axis="columns")
+
+
+def collate_systems(labeled_qa_pairs, judgments, question_frequencies, remove_newlines, answer_dictionary=None,
+                    judgment_store=None):
     """
     Collate system answer confidences and annotator judgments by question/answer pair.
     Add to each pair the question frequency. Collated system files are used as input to subsequent cross-system
@@ -551,83 +1115,231 @@ def add_judgments_and_frequencies_to_qa_pairs(qa_pairs, judgments, question_freq
     Some versions of Annotation Assist strip newlines from the answers they return in the judgement files, so
     optionally take this into account when joining on question/answer pairs.
 
-    :param qa_pairs: question, answer, and confidence provided by a Q&A system
-    :type qa_pairs: pandas.DataFrame
-    :param judgments: question, answer, in purview, and judgement provided by annotators
+    All the systems are collated together. Questions are numbered by their position in the frequency file and answers
+    by their answer dictionary keys, so the judgments are indexed once by a single integer per question/answer pair and
+    every system's pairs are looked up in that index. Only questions listed in the frequency file are considered.
+    Judgments from files take precedence over those in the judgment store, and earlier judgments of a pair take
+    precedence over later ones.
+
+    :param labeled_qa_pairs: system names and the question, answer, and confidence provided by each system
+    :type labeled_qa_pairs: iterable of (str, pandas.DataFrame)
+    :param judgments: question, answer or answer key, in purview, and judgement provided by annotators
     :type judgments: pandas.DataFrame
     :param question_frequencies: question and question frequency in the test set
     :type question_frequencies: pandas.DataFrame
     :param remove_newlines: join judgments on answers with newlines removed
     :type remove_newlines: bool
-    :return: question and answer pairs with confidence, in purview, judgement and question frequency
+    :param answer_dictionary: dictionary used to join on answer keys instead of answer text
+    :type answer_dictionary: AnswerDictionary
+    :param judgment_store: store from which to look up judgments of the systems' answers
+    :type judgment_store: JudgmentStore
+    :return: question and answer pairs with system, confidence, in purview, judgement and question frequency
     :rtype: pandas.DataFrame
     """
-    qa_pairs = pandas.merge(qa_pairs, question_frequencies, on=QUESTION, how="left")
+    if answer_dictionary is None:
+        answer_dictionary = AnswerDictionary()
+    labeled_qa_pairs = list(labeled_qa_pairs)
+    qa_pairs = pandas.concat([qa_pairs for _, qa_pairs in labeled_qa_pairs], ignore_index=True)
+    systems = np.repeat(np.arange(len(labeled_qa_pairs)), [len(qa_pairs) for _, qa_pairs in labeled_qa_pairs])
+    question_frequencies = question_frequencies.drop_duplicates(QUESTION)
+    questions = pandas.Index(question_frequencies[QUESTION])
+    question_ids = questions.get_indexer(qa_pairs[QUESTION])
+    listed = question_ids != -1
+    qa_pairs, systems, question_ids = qa_pairs[listed].reset_index(drop=True), systems[listed], question_ids[listed]
+    qa_pairs[FREQUENCY] = question_frequencies[FREQUENCY].values[question_ids]
+    answers = qa_pairs[ANSWER]
     if remove_newlines:
-        qa_pairs["Temp"] = qa_pairs[ANSWER].str.replace("\n", "")
-        qa_pairs = qa_pairs.rename(columns={"Temp": ANSWER, ANSWER: "Temp"})
+        answers = answers.str.replace("\n", "")
+    answer_keys = answer_dictionary.keys(answers)
+    if judgments is not None:
+        judgments = keyed_judgments(judgments, answer_dictionary, remove_newlines)
+    if judgment_store is not None:
+        judgments = pandas.concat([j for j in [judgments, judgment_store.lookup(qa_pairs[QUESTION], answers)]
+                                   if j is not None])
+    judgment_ids = questions.get_indexer(judgments[QUESTION])
+    judgments = judgments[judgment_ids != -1]
+    # Number each question/answer pair. Answer keys are offset by one so that missing answers are numbered too.
+    n = len(answer_dictionary) + 1
+    pairs = question_ids * n + answer_keys + 1
+    judged_pairs = judgment_ids[judgment_ids != -1] * n + judgments[ANSWER_KEY].values + 1
+    judgments = judgments.drop([QUESTION, ANSWER_KEY], axis="columns").set_index(judged_pairs)
+    judgments = judgments[~judgments.index.duplicated()].reindex(pairs)
+    for column in judgments.columns:
+        qa_pairs[column] = judgments[column].values
+    qa_pairs[SYSTEM] = np.array([label for label, _ in labeled_qa_pairs], dtype=object)[systems]
+    # Each system gives each question/answer pair once.
+    unique = ~pandas.DataFrame({SYSTEM: systems, ANSWER_KEY: pairs}).duplicated().values
+    return qa_pairs[unique].reset_index(drop=True)
 
-        judgments[ANSWER] = judgments[ANSWER].str.replace("\n", "")
-    qa_pairs = pandas.merge(qa_pairs, judgments, on=(QUESTION, ANSWER), how="left")
-    qa_pairs = qa_pairs.drop_duplicates([QUESTION, ANSWER])
 
-    if remove_newlines:
-        del qa_pairs[ANSWER]
-        qa_pairs = qa_pairs.rename(columns={"Temp": ANSWER})
-    return qa_pairs
+def drop_missing(systems_data):
+    # dropna returns a new frame, so judged does not modify the caller's data.
+    n = len(systems_data)
+    systems_data = systems_data.dropna()
+    m = n - len(systems_data)
+    if m:
+        logger.warning("Dropping %d of %d question/answer pairs missing information (%0.3f%%)" %
+                       (m, n, 100.0 * m / n))
+    return judged(systems_data)
 
 
-def drop_missing(systems_data):
-    if any(systems_data.isnull()):
-        n = len(systems_data)
-        systems_data = systems_data.dropna()
-        m = n - len(systems_data)
-        if m:
-            logger.warning("Dropping %d of %d question/answer pairs missing information (%0.3f%%)" %
-                           (m, n, 100.0 * m / n))
+def judged(systems_data):
+    """
+    Convert the judgment columns of collated data with no missing values to plain booleans in place.
+
+    Compact collated frames store In Purview and Correct as nullable boolean categoricals, which cannot be summed or
+    used as masks. Once the missing judgments have been dropped they can be stored as ordinary booleans. Systems that
+    no longer appear in the data are also dropped from the System categories so that they do not show up in groupby
+    results.
+
+    The frame is modified rather than copied, so pass it a frame the caller owns, such as the one returned by dropna.
+
+    :param systems_data: collated results with no missing values
+    :type systems_data: pandas.DataFrame
+    :return: the same frame, with boolean judgment columns
+    :rtype: pandas.DataFrame
+    """
+    # Pandas flags the frame returned by dropna as a possible view of the one it was taken from, but replacing whole
+    # columns never writes through to that frame.
+    with pandas.option_context("mode.chained_assignment", None):
+        for column in [IN_PURVIEW, CORRECT]:
+            if column in systems_data.columns:
+                systems_data[column] = systems_data[column].astype("bool")
+        if SYSTEM in systems_data.columns and systems_data[SYSTEM].dtype.name == "category":
+            systems_data[SYSTEM] = systems_data[SYSTEM].cat.remove_unused_categories()
+    return systems_data
+
+
+def compact_collated(systems_data):
+    """
+    Store collated data in compact column types in place.
+
+    System and Answer text is interned as categoricals, and In Purview and Correct are stored as boolean categoricals
+    so that they stay one byte per row even when there are missing judgments. Confidence is left at full precision so
+    that it is written out unchanged. The columns of the frame are replaced rather than copying it.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: pandas.DataFrame
+    :return: the same frame, using compact column types
+    :rtype: pandas.DataFrame
+    """
+    for column in [SYSTEM, ANSWERING_SYSTEM, ANSWER]:
+        if column in systems_data.columns:
+            systems_data[column] = systems_data[column].astype("category")
+    for column in [IN_PURVIEW, CORRECT]:
+        if column in systems_data.columns:
+            systems_data[column] = nullable_boolean(systems_data[column])
     return systems_data
 
-def kfold_split(df, outdir, _folds=5, _training_header=False):
+
+def concat_collated(systems_data):
+    """
+    Concatenate a list of collated frames, keeping compact column types.
+
+    Categorical columns with differing categories are concatenated as text, so re-intern them afterwards.
+
+    :param systems_data: collated results
+    :type systems_data: list of pandas.DataFrame
+    :return: a single collated frame
+    :rtype: pandas.DataFrame
+    """
+    return compact_collated(pandas.concat(systems_data))
+
+def kfold_split(df, outdir, _folds=5, _training_header=False, seed=None, stratify=None):
     """
-    
     Split the data-set into equal training and testing sets. Put training and testing set into local directory
     as csv files.
 
+    Each fold's rows are rendered as CSV once and the files are written from those, so the training files are not
+    rendered from copies of the data with the test fold dropped.
+
     :param df: data frame to be splited
     :param outdir: output directory path
     :param _folds: number of folds to be performed
     :param _training_header: header og the training file
-    :return: list of directory for training set and teting set
+    :param seed: random seed
+    :param stratify: optional column whose values are spread evenly across the folds
+    :return: fold id of each row
+    :rtype: numpy.array
     """
-    # Randomize the order of the input dataframe
-    df = df.iloc[np.random.permutation(len(df))]
-    df = df.reset_index(drop=True)
-    foldSize = int(math.ceil(len(df) / float(_folds)))
+    fold_ids = kfold_assignments(df, _folds, seed, stratify)
     logger.info("Total records: " + str(len(df)))
-    logger.info("Fold size: " + str(foldSize))
     logger.info("Results written to output folder " + outdir)
+    header = _encoded(df.iloc[:0].to_csv(encoding="utf-8", index=False))
+    folds = [_encoded(test.to_csv(encoding="utf-8", index=False, header=False))
+             for _, _, test in kfold_frames(df, fold_ids, _folds, train=False)]
+    for x in range(_folds):
+        with open(os.path.join(outdir, 'Test' + str(x) + '.csv'), "wb") as test_file:
+            test_file.write(header + folds[x])
+        with open(os.path.join(outdir, 'Train' + str(x) + '.csv'), "wb") as train_file:
+            if _training_header:
+                train_file.write(header)
+            for y in range(_folds):
+                if y != x:
+                    train_file.write(folds[y])
+        test_size = np.count_nonzero(fold_ids == x)
+        logger.info("--- Train_Fold_" + str(x) + ' size = ' + str(len(df) - test_size))
+        logger.info("--- Test_Fold_" + str(x) + ' size = ' + str(test_size))
+    return fold_ids
+
+
+def kfold_assignments(df, folds, seed=None, stratify=None):
+    """
+    Randomly assign rows to folds.
+
+    The rows are shuffled with a seeded permutation and dealt to the folds in turn, so fold sizes differ by at most one.
+    If a column to stratify by is given the shuffled rows are grouped by its values before they are dealt, so that
+    each value is spread as evenly as possible across the folds.
+
+    :param df: data to split
+    :type df: pandas.DataFrame
+    :param folds: number of folds
+    :type folds: int
+    :param seed: random seed
+    :type seed: int
+    :param stratify: optional column to stratify by, e.g. Answering System or Answer Id
+    :type stratify: str
+    :return: fold id of each row
+    :rtype: numpy.array
+    """
+    order = np.random.RandomState(seed).permutation(len(df))
+    if stratify is not None:
+        strata = pandas.factorize(df[stratify].astype(object))[0]
+        order = order[np.argsort(strata[order], kind="mergesort")]
+    fold_ids = np.empty(len(df), dtype=np.int64)
+    fold_ids[order] = np.arange(len(df)) % folds
+    return fold_ids
 
-    for x in range(0, _folds):
-        fold_low = x * foldSize
-        fold_high = (x + 1) * foldSize
 
-        if fold_high >= len(df):
-            fold_high = len(df)
+def kfold_frames(df, fold_ids, folds, train=True):
+    """
+    Generate the training and test data for each fold.
+
+    :param df: data to split
+    :type df: pandas.DataFrame
+    :param fold_ids: fold id of each row
+    :type fold_ids: numpy.array
+    :param folds: number of folds
+    :type folds: int
+    :param train: also generate the training data, otherwise it is None
+    :type train: bool
+    :return: fold id, training data, and test data
+    :rtype: iterator of (int, pandas.DataFrame, pandas.DataFrame)
+    """
+    for x in range(folds):
+        yield x, df[fold_ids != x] if train else None, df[fold_ids == x]
 
-        test_df = df.iloc[fold_low:fold_high]
-        train_df = df.drop(df.index[fold_low:fold_high])
 
-        test_df.to_csv(os.path.join(outdir, 'Test' + str(x) + '.csv'), encoding='utf-8', index=False)
-        train_df.to_csv(os.path.join(outdir, 'Train' + str(x) + '.csv'), header=_training_header, encoding='utf-8', index=False)
+def _encoded(text):
+    return text if isinstance(text, bytes) else text.encode("utf-8")
 
-        logger.info("--- Train_Fold_" + str(x) + ' size = ' + str(len(train_df)))
-        logger.info("--- Test_Fold_" + str(x) + ' size = ' + str(len(test_df)))
 
 # NLC as router functions
 
 
 # k-folding and training
-def nlc_router_train(url, username, password, oracle_out, path, all_correct):
+def nlc_router_train(url, username, password, oracle_out, path, all_correct, folds=NLC_ROUTER_FOLDS, seed=None,
+                     stratify=None):
 
     """
     NLC Training on the oracle experiment output to determine which system(NLC or Solr) should
@@ -646,41 +1358,61 @@ def nlc_router_train(url, username, password, oracle_out, path, all_correct):
     :param oracle_out: file created by oracle experiment
     :param path: directory path to save intermediate results
     :param all_correct: optional boolean parameter to train with only correct QA pairs
+    :param folds: number of folds
+    :param seed: random seed used to split the folds
+    :param stratify: optional column whose values are spread evenly across the folds
     :return: list of classifier ids by NLC training
     """
     ensure_directory_exists(path)
 
     sys_name = oracle_out[SYSTEM][0]
     oracle_out[QUESTION] = oracle_out[QUESTION].str.replace("\n", " ")
-    kfold_split(oracle_out, path, NLC_ROUTER_FOLDS, True)
-    classifier_list = []
-    list = []
-
-    for x in range(0, NLC_ROUTER_FOLDS):
-        train = pandas.read_csv(os.path.join(path, "Train{0}.csv".format(str(x))))
+    fold_ids = kfold_split(oracle_out, path, folds, True, seed, stratify)
+    trainings = []
+    for x, train, _ in kfold_frames(oracle_out, fold_ids, folds):
         if all_correct:
             logger.info("Training only on CORRECT examples.")
             # Ignore records from training which are not correct
             train = train[train[CORRECT]]
             train = train[train[IN_PURVIEW]]
-        train = train[[QUESTION, ANSWERING_SYSTEM]]
-        logger.info("Training set size = {0}".format(str(len(train))))
-        with tempfile.TemporaryFile() as training_file:
-            to_csv(training_file, train[[QUESTION, ANSWERING_SYSTEM]], header=False, index=False)
-            training_file.seek(0)
-            nlc = NaturalLanguageClassifier(url=url, username=username, password=password)
-            classifier_id = nlc.create(training_data=training_file, name="{0}_fold_{1}".format(str(sys_name), str(x)))
-            classifier_list.append(classifier_id["classifier_id"].encode("utf-8"))
-            list.append({classifier_id["name"].encode("utf-8"): classifier_id["classifier_id"].encode("utf-8")})
-            logger.info(pretty_print_json(classifier_id))
-            pretty_print_json(classifier_id)
-
-    with open(os.path.join(path, 'classifier.json'), 'wb') as f:
-        json.dump(list, f)
-    return classifier_list
+        logger.info("Fold {0} training set size = {1}".format(x, len(train)))
+        trainings.append((url, username, password, train[[QUESTION, ANSWERING_SYSTEM]],
+                          "{0}_fold_{1}".format(sys_name, x)))
+    # Submit all the folds' training data at once.
+    pool = ThreadPool(folds)
+    try:
+        classifiers = pool.map(_create_router_classifier, trainings)
+    finally:
+        pool.close()
+        pool.join()
+    for classifier in classifiers:
+        logger.info(pretty_print_json(classifier))
+
+    with open(os.path.join(path, 'classifier.json'), 'w') as f:
+        json.dump([{classifier["name"]: classifier["classifier_id"]} for classifier in classifiers], f)
+    return [classifier["classifier_id"] for classifier in classifiers]
+
+
+def _create_router_classifier(training):
+    url, username, password, train, name = training
+    with tempfile.TemporaryFile() as training_file:
+        to_csv(training_file, train, header=False, index=False)
+        training_file.seek(0)
+        nlc = NaturalLanguageClassifier(url=url, username=username, password=password)
+        return nlc.create(training_data=training_file, name=name)
+
+
+def _router_classifier_ids(path):
+    """
+    Classifier ids written by nlc_router_train, in fold order.
+    """
+    with open(os.path.join(path, 'classifier.json'), 'r') as f:
+        return [list(classifier.values())[0] for classifier in json.load(f)]
+
 
 # training status checking
-def nlc_router_status(url, username, password, path):
+def nlc_router_status(url, username, password, path, watch=False, interval=10, max_interval=300,
+                      retries=STATUS_RETRIES):
     """
     Determine the status of NLC training instance and returns whether the instance is finished training or not.
 
@@ -688,28 +1420,48 @@ def nlc_router_status(url, username, password, path):
     :param username: NLC Username
     :param password: NLC password
     :param path: directory path to save intermediate results
+    :param watch: wait for all the classifiers to finish training or fail before printing their statuses
+    :param interval: initial seconds between classifier status requests
+    :param max_interval: maximum seconds between classifier status requests
+    :param retries: number of times to request a status before giving up after an error
     :return: status of instance on stdout
     """
-    # import list of classifier from file
-    classifier_list = []
-    with open(os.path.join(path, 'classifier.json'), 'r') as f:
-        data = json.load(f)
-    for x in range(0, NLC_ROUTER_FOLDS):
-        classifier_list.append(data[x]['NLC+Solr Oracle_fold_{0}'.format(str(x))].encode("utf-8"))
-    classifier_status(url, username, password, classifier_list)
+    classifier_status(url, username, password, _router_classifier_ids(path), watch, interval, max_interval, retries)
+
+
+def nlc_router_wait(url, username, password, path, interval=10, max_interval=300, retries=STATUS_RETRIES):
+    """
+    Wait for the classifiers trained by nlc_router_train to finish training.
+
+    :param url: URL of NLC instance
+    :param username: NLC Username
+    :param password: NLC password
+    :param path: directory path to save intermediate results
+    :param interval: initial seconds between classifier status requests
+    :param max_interval: maximum seconds between classifier status requests
+    :param retries: number of times to request a status before giving up after an error
+    :return: final status of each classifier
+    :raises ValueError: if any of the classifiers failed to train
+    """
+    return wait_for_classifiers(url, username, password, _router_classifier_ids(path), interval, max_interval,
+                                retries=retries)
+
 
 # testing and merging
-def nlc_router_test(url, username, password, collate_file, path):
+def nlc_router_test(url, username, password, collate_file, path, processes=None):
     """
     Querying NLC for testing set to determine the system(NLC or Solr) and then lookup related
     fields from collated file (used as an input to the oracle experiment)
 
+    The folds are tested in parallel, each writing its answers to its own checkpoint file.
+
     :param url: URL of NLC instance
     :param username: NLC Username
     :param password: NLC password
     :param oracle_out: file created by oracle experiment
     :param collate_file: collated file created for oracle experiment as input
     :param path: directory path to save intermediate results
+    :param processes: number of folds to test at once, by default all of them
 
     :return: output file with best system NLC or Solr and relevant fields
     """
@@ -718,27 +1470,19 @@ def nlc_router_test(url, username, password, collate_file, path):
         m = sum(system_data[CORRECT])
         logger.info("%d of %d correct in %s (%0.3f%%)" % (m, n, name, 100.0 * m / n))
 
-    # import list of classifier from file
-    classifier_list = []
-    with open(os.path.join(path, 'classifier.json'), 'r') as f:
-        data = json.load(f)
-    for x in range(0, NLC_ROUTER_FOLDS):
-        classifier_list.append(data[x]['NLC+Solr Oracle_fold_{0}'.format(str(x))].encode("utf-8"))
-
-    for x in range(0, NLC_ROUTER_FOLDS):
-        test = pandas.read_csv(os.path.join(path, "Test{0}.csv".format(str(x))))
-        test = test[[QUESTION]]
-        test[QUESTION] = test[QUESTION].str.replace("\n", " ")
-        classifier_id = classifier_list[x]
-        n = NLC(url, username, password, classifier_id, test)
-        out_file = os.path.join(path, "Out{0}.csv".format(str(x)))
-        logger.info("Testing on fold {0} using NLC classifier {1}".format(str(x), str(classifier_list[x])))
-        answer_router_questions(n, set(test[QUESTION]), out_file)
+    classifier_list = _router_classifier_ids(path)
+    folds = len(classifier_list)
+    pool = ThreadPool(processes or folds)
+    try:
+        pool.map(_test_router_fold, [(url, username, password, classifier_list[x], path, x) for x in range(folds)])
+    finally:
+        pool.close()
+        pool.join()
 
     # Concatenate multiple trained output into single csv file
     dfList = []
     columns = [QUESTION, SYSTEM]
-    for x in range(0, NLC_ROUTER_FOLDS):
+    for x in range(0, folds):
         df = pandas.read_csv(os.path.join(path, "Out{0}.csv".format(str(x))), header=0)
         dfList.append(df)
 
@@ -755,6 +1499,34 @@ def nlc_router_test(url, username, password, collate_file, path):
     return result
 
 
+def _test_router_fold(fold):
+    url, username, password, classifier_id, path, x = fold
+    test = pandas.read_csv(os.path.join(path, "Test{0}.csv".format(str(x))))
+    test = test[[QUESTION]]
+    test[QUESTION] = test[QUESTION].str.replace("\n", " ")
+    n = NLC(url, username, password, classifier_id, test)
+    out_file = os.path.join(path, "Out{0}.csv".format(str(x)))
+    logger.info("Testing on fold {0} using NLC classifier {1}".format(str(x), str(classifier_id)))
+    answer_router_questions(n, set(test[QUESTION]), out_file)
+
+
+def nlc_router(url, username, password, oracle_out, collate_file, path, all_correct, folds=NLC_ROUTER_FOLDS,
+               seed=None, stratify=None, interval=10, max_interval=300, retries=STATUS_RETRIES):
+    """
+    Train the fold classifiers, wait for them to finish training, then test them.
+
+    See nlc_router_train and nlc_router_test.
+
+    :param interval: initial seconds between classifier status requests
+    :param max_interval: maximum seconds between classifier status requests
+    :param retries: number of times to request a status before giving up after an error
+    :return: output file with best system NLC or Solr and relevant fields
+    """
+    classifier_ids = nlc_router_train(url, username, password, oracle_out, path, all_correct, folds, seed, stratify)
+    wait_for_classifiers(url, username, password, classifier_ids, interval, max_interval, retries=retries)
+    return nlc_router_test(url, username, password, collate_file, path)
+
+
 def answer_router_questions(system, questions, output):
 
     """
@@ -774,23 +1546,120 @@ def answer_router_questions(system, questions, output):
         for i, question in enumerate(questions, len(answers.recovered) + 1):
             if i is 1 or i == n or i % 25 == 0:
                 logger.info(percent_complete_message("Question", i, n))
+            prefetch(system, questions, i - len(answers.recovered) - 1, 100)
             answer = system.query(question.replace("\n", " "))
             #logger.debug("%s\t%s" % (question, answer))
             answers.write(question, answer)
     finally:
         answers.close()
+        close(system)
+
+
+def local_router(oracle_out, collate_file, all_correct=False, folds=NLC_ROUTER_FOLDS, seed=None, stratify=None,
+                 processes=None, features=FEATURES, router_name="NLC-as-router"):
+    """
+    Cross-validate a local router that learns which system should answer each question from the oracle experiment
+    output, as an in-process alternative to training and testing NLC as a router.
+
+    The router is a logistic regression over hashed TF-IDF vectors of the question text and each system's percentile
+    ranked confidence in its answer to the question. The folds are assigned as in kfold_split and trained and tested
+    in parallel worker processes.
+
+    :param oracle_out: file created by oracle experiment
+    :type oracle_out: pandas.DataFrame
+    :param collate_file: collated file created for oracle experiment as input
+    :type collate_file: pandas.DataFrame
+    :param all_correct: train only with correct, in purview questions
+    :type all_correct: bool
+    :param folds: number of folds
+    :type folds: int
+    :param seed: random seed used to split the folds
+    :type seed: int
+    :param stratify: optional column whose values are spread evenly across the folds
+    :type stratify: str
+    :param processes: number of worker processes, by default the number of CPUs
+    :type processes: int
+    :param features: number of hashed question text features
+    :type features: int
+    :param router_name: the name of the router system
+    :type router_name: str
+    :return: router results in collated format, with the system chosen to answer each question
+    :rtype: pandas.DataFrame
+    """
+    if folds > len(oracle_out):
+        raise ValueError("Cannot split %d questions into %d folds" % (len(oracle_out), folds))
+    systems = sorted(oracle_out[ANSWERING_SYSTEM].unique())
+    collated = collate_file[collate_file[SYSTEM].isin(systems)].drop_duplicates([QUESTION, SYSTEM])
+    percentiles = collated.groupby(SYSTEM)[CONFIDENCE].rank(pct=True)
+    percentiles = pandas.Series(percentiles.values, index=pandas.MultiIndex.from_arrays(
+        [collated[QUESTION].values, collated[SYSTEM].values])).unstack().reindex(
+        index=oracle_out[QUESTION].values, columns=systems).values
+    # Each system contributes its confidence percentile and whether it answered the question.
+    numeric = np.hstack([np.nan_to_num(percentiles), ~np.isnan(percentiles)])
+    trainable = np.ones(len(oracle_out), dtype=bool)
+    if all_correct:
+        logger.info("Training only on CORRECT examples.")
+        trainable = ((oracle_out[CORRECT] == True) & (oracle_out[IN_PURVIEW] == True)).values
+    fold_ids = kfold_assignments(oracle_out, folds, seed, stratify)
+    questions = oracle_out[QUESTION].str.replace("\n", " ").values
+    pool = multiprocessing.Pool(processes, initializer=_initialize_router,
+                                initargs=(questions, numeric, oracle_out[ANSWERING_SYSTEM].values,
+                                          fold_ids, trainable, features))
+    try:
+        routes = pool.map(_route_fold, range(folds))
+    finally:
+        pool.close()
+        pool.join()
+    routes = pandas.concat([pandas.DataFrame({QUESTION: oracle_out[QUESTION].values[fold_ids == x], SYSTEM: route})
+                            for x, route in enumerate(routes)])
+    result = pandas.merge(routes, collate_file, on=[QUESTION, SYSTEM])
+    result = result.rename(columns={SYSTEM: ANSWERING_SYSTEM})
+    result[SYSTEM] = router_name
+    result[CONFIDENCE] = __standardize_confidence(result)
+    _log_correct(np.count_nonzero(result[CORRECT] == True), len(result), router_name)
+    return result
+
+
+_router_data = None
+
+
+def _initialize_router(*data):
+    global _router_data
+    _router_data = data
+
+
+def _route_fold(x):
+    """
+    Train the router on all but one fold and route the questions in that fold.
+
+    :param x: fold to test
+    :type x: int
+    :return: system chosen to answer each question in the fold
+    :rtype: numpy.array
+    """
+    questions, numeric, labels, fold_ids, trainable, features = _router_data
+    train = (fold_ids != x) & trainable
+    test = fold_ids == x
+    if not test.any():
+        return np.array([], dtype=object)
+    logger.info("Fold {0} training set size = {1}".format(x, np.count_nonzero(train)))
+    if not train.any():
+        raise ValueError("Fold %d has no training questions" % x)
+    router = LogisticClassifier.train(questions[train], numeric[train], labels[train], features)
+    return router.classify(questions[test], numeric[test])
 
 
 class CollatedFileType(CsvFileType):
     columns = [QUESTION, SYSTEM, ANSWER, CONFIDENCE, IN_PURVIEW, CORRECT, FREQUENCY]
 
     def __init__(self):
-        super(self.__class__, self).__init__(self.__class__.columns)
+        # Read the repetitive text columns straight into categoricals so that the full text frame is never built.
+        super(self.__class__, self).__init__(self.__class__.columns, dtype={SYSTEM: "category", ANSWER: "category"})
 
     def __call__(self, filename):
         if os.path.isfile(filename):
-            collated = super(self.__class__, self).__call__(filename)
-            m = sum(collated[collated[IN_PURVIEW] == False][CORRECT])
+            collated = compact_collated(super(self.__class__, self).__call__(filename))
+            m = sum((collated[IN_PURVIEW] == False) & (collated[CORRECT] == True))
             if m:
                 n = len(collated)
                 logger.warning(
@@ -810,3 +1679,274 @@ class CollatedFileType(CsvFileType):
 
 class OracleFileType(CollatedFileType):
     columns = CollatedFileType.columns[:2] + [ANSWERING_SYSTEM] + CollatedFileType.columns[2:]
+
+
+class TokenCountsFileType(CsvFileType):
+    """
+    Answer token counts keyed by answer hash, used to avoid tokenizing answers again when generating corpus statistics.
+
+    If the file does not exist there are no token counts.
+    """
+    columns = [ANSWER_HASH, TOKENS]
+
+    def __init__(self):
+        super(self.__class__, self).__init__(self.__class__.columns)
+
+    def __call__(self, filename):
+        if os.path.isfile(filename):
+            token_counts = super(self.__class__, self).__call__(filename)
+            logger.info("Read token counts of %d answers from %s" % (len(token_counts), filename))
+        else:
+            logger.info("{0} does not exist, starting with no token counts".format(filename))
+            token_counts = pandas.DataFrame(columns=self.columns)
+        return token_counts
+
+    @classmethod
+    def output_format(cls, token_counts):
+        return token_counts[cls.columns].set_index(ANSWER_HASH)
+
+
+class EvaluationMatrix(object):
+    """
+    Collated results pivoted into matrices with a row for each question and a column for each system.
+
+    Analyses that compare systems look up the same question in several systems' results. Pivoting the collated data
+    once lets them use aligned NumPy arrays instead of filtering the collated data by system and merging on question.
+
+    Answers are stored as integer ids into answer_text and judgments as 1 for true, 0 for false. Answers, judgments and
+    frequencies are MISSING and confidences NaN where they are missing from the collated data. The answered matrix
+    marks the cells for which the collated data has a row.
+    """
+
+    def __init__(self, questions, systems, answer_text, answers, confidence, in_purview, correct, frequency, answered):
+        self.questions = questions
+        self.systems = systems
+        self.answer_text = answer_text
+        self.answers = answers
+        self.confidence = confidence
+        self.in_purview = in_purview
+        self.correct = correct
+        self.frequency = frequency
+        self.answered = answered
+
+    def __repr__(self):
+        return "%s: %d questions, %d systems" % (self.__class__.__name__, len(self.questions), len(self.systems))
+
+    @classmethod
+    def from_collated(cls, systems_data):
+        """
+        Pivot collated data.
+
+        Rows missing a question or system are dropped, as drop_missing would drop them. If a system has more than one
+        answer to a question, a warning is logged and the last one is used.
+
+        :param systems_data: collated results for all systems
+        :type systems_data: pandas.DataFrame
+        :return: evaluation matrix
+        :rtype: EvaluationMatrix
+        """
+        rows, questions = pandas.factorize(systems_data[QUESTION].astype(object))
+        columns, systems = pandas.factorize(systems_data[SYSTEM].astype(object), sort=True)
+        answers, answer_text = pandas.factorize(systems_data[ANSWER].astype(object))
+        shape = (len(questions), len(systems))
+        # Null questions and systems have code -1, which would index the last row or column.
+        keep = (rows != -1) & (columns != -1)
+        n = len(systems_data)
+        m = n - np.count_nonzero(keep)
+        if m:
+            logger.warning("Dropping %d of %d question/answer pairs missing information (%0.3f%%)" %
+                           (m, n, 100.0 * m / n))
+        duplicated = pandas.Series(np.where(keep, rows * len(systems) + columns, -1)).duplicated(keep="last").values
+        duplicated &= keep
+        m = np.count_nonzero(duplicated)
+        if m:
+            logger.warning("%d duplicate answers from a system to the same question, using the last answer" % m)
+        keep &= ~duplicated
+        rows, columns = rows[keep], columns[keep]
+
+        def pivot(values, missing, dtype):
+            matrix = np.full(shape, missing, dtype=dtype)
+            matrix[rows, columns] = np.asarray(values)[keep] if np.ndim(values) else values
+            return matrix
+
+        def judgment_codes(judgments):
+            judgments = judgments.astype(object)
+            return np.where(judgments.isnull(), MISSING, judgments == True)
+
+        frequency = systems_data[FREQUENCY]
+        return cls(np.asarray(questions, dtype=object), list(systems), np.asarray(answer_text, dtype=object),
+                   pivot(answers, MISSING, np.int32),
+                   pivot(systems_data[CONFIDENCE].values, np.nan, np.float64),
+                   pivot(judgment_codes(systems_data[IN_PURVIEW]), MISSING, np.int8),
+                   pivot(judgment_codes(systems_data[CORRECT]), MISSING, np.int8),
+                   pivot(np.where(frequency.isnull(), MISSING, frequency.fillna(0)), MISSING, np.int64),
+                   pivot(True, False, bool))
+
+    def system_index(self, system_name):
+        try:
+            return self.systems.index(system_name)
+        except ValueError:
+            raise ValueError("No system %s in collated data" % system_name)
+
+    def judged(self):
+        """
+        The answered cells that have no missing values. These are the rows drop_missing keeps in collated data.
+
+        :return: boolean matrix with a row for each question and a column for each system
+        :rtype: numpy.array
+        """
+        judged = self.answered & (self.answers != MISSING) & ~np.isnan(self.confidence) & \
+            (self.in_purview != MISSING) & (self.correct != MISSING) & (self.frequency != MISSING)
+        n = np.count_nonzero(self.answered)
+        m = n - np.count_nonzero(judged)
+        if m:
+            logger.warning("Dropping %d of %d question/answer pairs missing information (%0.3f%%)" %
+                           (m, n, 100.0 * m / n))
+        return judged
+
+    def system_frame(self, system, rows):
+        """
+        Collated data for a single system.
+
+        :param system: index of the system
+        :type system: int
+        :param rows: boolean mask or indexes of the questions to include
+        :type rows: numpy.array
+        :return: collated results in question order
+        :rtype: pandas.DataFrame
+        """
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        return self._frame(rows, np.full(len(rows), system, dtype=np.int64))
+
+    def collated(self, cells=None):
+        """
+        Collated data for a set of cells.
+
+        :param cells: boolean matrix of the cells to include, by default all the answered cells
+        :type cells: numpy.array
+        :return: collated results ordered by question and system
+        :rtype: pandas.DataFrame
+        """
+        rows, columns = np.nonzero(self.answered if cells is None else cells)
+        return self._frame(rows, columns)
+
+    def _frame(self, rows, columns):
+        def judgments(codes):
+            column = pandas.Series(pandas.Categorical.from_codes(codes.astype(np.int64), [False, True]))
+            return column if (codes == MISSING).any() else column.astype(bool)
+
+        frequency = self.frequency[rows, columns]
+        return pandas.DataFrame({QUESTION: self.questions[rows],
+                                 SYSTEM: pandas.Categorical.from_codes(columns, self.systems),
+                                 # Missing answer ids pick out the NaN appended to the end of the answer text.
+                                 ANSWER: np.append(self.answer_text, np.nan)[self.answers[rows, columns]],
+                                 CONFIDENCE: self.confidence[rows, columns],
+                                 IN_PURVIEW: judgments(self.in_purview[rows, columns]),
+                                 CORRECT: judgments(self.correct[rows, columns]),
+                                 FREQUENCY: np.where(frequency == MISSING, np.nan, frequency)
+                                 if (frequency == MISSING).any() else frequency},
+                                columns=CollatedFileType.columns)
+
+    def save(self, filename, source=None):
+        """
+        Write the matrix to a NumPy archive.
+
+        :param filename: archive name
+        :type filename: str
+        :param source: collated file the matrix was built from, whose size and modification time are recorded so that
+            a stale archive can be detected
+        :type source: str
+        """
+        arrays = dict((name, getattr(self, name)) for name in
+                      ["answers", "confidence", "in_purview", "correct", "frequency", "answered"])
+        for name in ["questions", "systems", "answer_text"]:
+            arrays[name], arrays[name + "_offsets"] = _encode_text(getattr(self, name))
+        if source is not None:
+            arrays["source"] = np.array(_file_signature(source))
+        with open(filename, "wb") as f:
+            np.savez(f, **arrays)
+        logger.info("Wrote %s to %s" % (self, filename))
+
+    @classmethod
+    def load(cls, filename, source=None):
+        """
+        Read a matrix written by save.
+
+        :param filename: archive name
+        :type filename: str
+        :param source: collated file the matrix should have been built from
+        :type source: str
+        :return: evaluation matrix, or None if the archive was built from a different version of the source or stores
+            confidences at reduced precision
+        :rtype: EvaluationMatrix
+        """
+        with np.load(filename) as arrays:
+            if source is not None and \
+                    ("source" not in arrays or list(arrays["source"]) != list(_file_signature(source))):
+                return None
+            if arrays["confidence"].dtype != np.float64:
+                return None
+            text = dict((name, _decode_text(arrays[name], arrays[name + "_offsets"]))
+                        for name in ["questions", "systems", "answer_text"])
+            matrix = cls(text["questions"], list(text["systems"]), text["answer_text"],
+                         *[arrays[name] for name in
+                           ["answers", "confidence", "in_purview", "correct", "frequency", "answered"]])
+        logger.info("Read %s from %s" % (matrix, filename))
+        return matrix
+
+
+def evaluation_matrix(systems_data):
+    """
+    The evaluation matrix of collated data, which may already be an evaluation matrix.
+
+    :param systems_data: collated results for all systems
+    :type systems_data: pandas.DataFrame or EvaluationMatrix
+    :rtype: EvaluationMatrix
+    """
+    if isinstance(systems_data, EvaluationMatrix):
+        return systems_data
+    return EvaluationMatrix.from_collated(systems_data)
+
+
+def _encode_text(strings):
+    # Store strings as their concatenated UTF-8 bytes and end offsets, which NumPy can save without pickling.
+    encoded = [s.encode("utf-8") for s in strings]
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), np.cumsum([len(e) for e in encoded], dtype=np.int64)
+
+
+def _decode_text(data, offsets):
+    data = data.tobytes()
+    strings = np.empty(len(offsets), dtype=object)
+    strings[:] = [data[start:end].decode("utf-8") for start, end in zip(np.append(0, offsets[:-1]), offsets)]
+    return strings
+
+
+def _file_signature(filename):
+    status = os.stat(filename)
+    return [status.st_size, int(status.st_mtime * 1000000)]
+
+
+class EvaluationMatrixFileType(object):
+    """
+    Collated file read as an evaluation matrix.
+
+    The matrix is cached in a NumPy archive next to the collated file and rebuilt when the collated file changes.
+    """
+
+    def __call__(self, filename):
+        cache = os.path.splitext(filename)[0] + ".matrix.npz"
+        if os.path.isfile(cache):
+            matrix = EvaluationMatrix.load(cache, filename)
+            if matrix is not None:
+                return matrix
+            logger.info("%s is out of date" % cache)
+        collated = CollatedFileType()(filename)
+        if collated is None:
+            raise ValueError("Cannot read collated file %s" % filename)
+        matrix = EvaluationMatrix.from_collated(collated)
+        try:
+            matrix.save(cache, filename)
+        except (IOError, OSError) as e:
+            logger.warning("Cannot cache evaluation matrix: %s" % e)
+        return matrix
@@ -31,12 +31,43 @@ def answer_questions(system, questions, output_filename, checkpoint_frequency):
         for i, question in enumerate(questions, len(answers.recovered) + 1):
             if i is 1 or i == n or i % checkpoint_frequency is 0:
                 logger.info(percent_complete_message("Question", i, n))
+            prefetch(system, questions, i - len(answers.recovered) - 1, checkpoint_frequency)
             # NLC and Solr cannot handle newlines in questions.
             answer, confidence = system.ask(question.replace("\n", " "))
             logger.debug("%s\t%s\t%s" % (question, answer, confidence))
             answers.write(question, answer, confidence)
     finally:
         answers.close()
+        close(system)
+
+
+def prefetch(system, questions, i, batch_size):
+    """
+    If the system can prefetch answers, prefetch the batch of questions starting at the i-th question when i is at the
+    start of a batch.
+
+    :param system: Q&A system
+    :type system: object that exports an ask method and optionally a prefetch method
+    :param questions: questions to ask
+    :type questions: list of str
+    :param i: index of the question about to be asked
+    :type i: int
+    :param batch_size: number of questions to prefetch at a time
+    :type batch_size: int
+    """
+    if hasattr(system, "prefetch") and i % batch_size == 0:
+        system.prefetch([question.replace("\n", " ") for question in questions[i:i + batch_size]])
+
+
+def close(system):
+    """
+    Release any resources, such as threads, that the system holds.
+
+    :param system: Q&A system
+    :type system: object that exports an ask method and optionally a close method
+    """
+    if hasattr(system, "close"):
+        system.close()
 
 
 def get_answers_from_usage_log(questions, qa_pairs_from_logs):
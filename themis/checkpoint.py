@@ -98,19 +98,20 @@ def retry(function, times):
     :type function: function
     :param times: the number of times to call the function before giving up
     :type times: int
+    :return: the value returned by the function, or None if every attempt failed
     """
     if times is None:
-        function()
+        return function()
     else:
         assert times > 0
         try:
-            function()
+            return function()
         except Exception as e:
             logger.info("Error %s" % e)
             times -= 1
             if times:
                 logger.info("Retry %d more times" % times)
                 time.sleep(60)
-                retry(function, times)
+                return retry(function, times)
             else:
                 logger.info("Done retrying")
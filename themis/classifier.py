@@ -0,0 +1,333 @@
+"""
+Local text classifiers that can stand in for a Natural Language Classifier.
+
+Questions are turned into hashed TF-IDF vectors of their words and word pairs. TextClassifier represents each class by
+the normalized centroid of the vectors of its training questions and scores a question against every class with a
+single sparse matrix product, so the model trains in seconds and classifies batches of questions without any network
+calls. LogisticClassifier fits a logistic regression to the question vectors together with additional numeric
+features, and is used to route questions between systems.
+"""
+import re
+import zlib
+
+import numpy
+import pandas
+import scipy.optimize
+import scipy.sparse
+
+from themis import QUESTION, ANSWER_ID, ANSWER
+from themis import logger
+
+FEATURES = 2 ** 18
+# The Natural Language Classifier returns its ten most likely classes.
+CLASSES = 10
+
+TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+class TextClassifier(object):
+    """
+    Nearest centroid classifier over hashed TF-IDF vectors.
+
+    The confidence of a class is the cosine similarity between the question and the class centroid.
+    """
+
+    def __init__(self, classes, idf, centroids):
+        """
+        :param classes: class names
+        :type classes: numpy.array of str
+        :param idf: inverse document frequency of each hashed feature
+        :type idf: numpy.array
+        :param centroids: features by classes matrix of normalized class centroids
+        :type centroids: scipy.sparse.csc_matrix
+        """
+        self.classes = classes
+        self.idf = idf
+        self.centroids = centroids
+
+    def __repr__(self):
+        return "%s: %d classes, %d features" % (self.__class__.__name__, len(self.classes), len(self.idf))
+
+    @classmethod
+    def train(cls, questions, labels, features=FEATURES):
+        """
+        Train a classifier.
+
+        :param questions: training questions
+        :type questions: sequence of str
+        :param labels: class of each question
+        :type labels: sequence
+        :param features: number of hashed features
+        :type features: int
+        :return: trained classifier
+        :rtype: TextClassifier
+        """
+        counts = _hashed_counts(questions, features)
+        document_frequency = numpy.bincount(counts.indices, minlength=features)
+        idf = numpy.log((1.0 + counts.shape[0]) / (1.0 + document_frequency)) + 1
+        codes, classes = pandas.factorize(pandas.Series(labels).astype(str))
+        membership = scipy.sparse.csr_matrix((numpy.ones(len(codes)), (numpy.arange(len(codes)), codes)),
+                                             shape=(len(codes), len(classes)))
+        centroids = scipy.sparse.csc_matrix(_tf_idf(counts, idf).T.dot(membership))
+        norms = numpy.sqrt(numpy.asarray(centroids.multiply(centroids).sum(axis=0))).ravel()
+        centroids = centroids.dot(scipy.sparse.diags(1.0 / numpy.where(norms == 0, 1, norms)))
+        classifier = cls(numpy.asarray(classes, dtype=object), idf, scipy.sparse.csc_matrix(centroids))
+        logger.info("Trained %s on %d questions" % (classifier, len(codes)))
+        return classifier
+
+    def scores(self, questions):
+        """
+        Score questions against every class.
+
+        :param questions: questions to classify
+        :type questions: sequence of str
+        :return: questions by classes matrix of confidences
+        :rtype: numpy.array
+        """
+        vectors = _tf_idf(_hashed_counts(questions, len(self.idf)), self.idf)
+        return vectors.dot(self.centroids).toarray()
+
+    def classify(self, questions):
+        """
+        Classify questions, returning responses in the format of the Natural Language Classifier classify method.
+
+        :param questions: questions to classify
+        :type questions: sequence of str
+        :return: classification of each question, with its most likely classes in order of descending confidence
+        :rtype: list of dict
+        """
+        scores = self.scores(questions)
+        # A stable sort breaks ties in class order.
+        order = numpy.argsort(-scores, axis=1, kind="mergesort")[:, :CLASSES]
+        classifications = []
+        for question, ranks, row in zip(questions, order, scores):
+            classes = [{"class_name": self.classes[j], "confidence": float(row[j])} for j in ranks]
+            classifications.append({"text": question, "top_class": classes[0]["class_name"], "classes": classes})
+        return classifications
+
+    def save(self, filename):
+        """
+        Write the classifier to a NumPy archive.
+
+        :param filename: archive name
+        :type filename: str
+        """
+        classes = numpy.array([name.encode("utf-8") for name in self.classes])
+        with open(filename, "wb") as f:
+            numpy.savez(f, classes=classes, idf=self.idf, data=self.centroids.data, indices=self.centroids.indices,
+                        indptr=self.centroids.indptr)
+        logger.info("Wrote %s to %s" % (self, filename))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read a classifier written by save.
+
+        :param filename: archive name
+        :type filename: str
+        :rtype: TextClassifier
+        """
+        with numpy.load(filename) as arrays:
+            classes = numpy.array([name.decode("utf-8") for name in arrays["classes"]], dtype=object)
+            idf = arrays["idf"]
+            centroids = scipy.sparse.csc_matrix((arrays["data"], arrays["indices"], arrays["indptr"]),
+                                                shape=(len(idf), len(classes)))
+        classifier = cls(classes, idf, centroids)
+        logger.info("Read %s from %s" % (classifier, filename))
+        return classifier
+
+
+def train_text_classifier(truth, filename, features=FEATURES):
+    """
+    Train a local classifier on a truth file and save it.
+
+    :param truth: truth file created by the 'xmgr truth' command
+    :type truth: pandas.DataFrame
+    :param filename: name of the archive to write the classifier to
+    :type filename: str
+    :param features: number of hashed features
+    :type features: int
+    :return: trained classifier
+    :rtype: TextClassifier
+    """
+    classifier = TextClassifier.train(truth[QUESTION].str.replace("\n", " "), truth[ANSWER_ID], features)
+    classifier.save(filename)
+    return classifier
+
+
+class LocalNLC(object):
+    """
+    Q&A system that answers questions with a local text classifier the way the NLC system answers them with a Natural
+    Language Classifier.
+    """
+
+    def __init__(self, classifier, corpus):
+        self.classifier = classifier
+        self.corpus = corpus
+        self.cache = {}
+
+    def __repr__(self):
+        return "Local NLC: %s" % self.classifier
+
+    def classify(self, question):
+        if question not in self.cache:
+            self.prefetch([question])
+        return self.cache[question]
+
+    def prefetch(self, questions):
+        """
+        Classify the questions that are not already cached as a single batch.
+
+        :param questions: questions to classify
+        :type questions: iterable of str
+        """
+        questions = [question for question in set(questions) if question not in self.cache]
+        if questions:
+            self.cache.update(zip(questions, self.classifier.classify(questions)))
+
+    def ask(self, question):
+        classification = self.classify(question)
+        class_name = classification["classes"][0]["class_name"]
+        confidence = classification["classes"][0]["confidence"]
+        return self.corpus.loc[class_name][ANSWER], confidence
+
+    def query(self, question):
+        classification = self.classify(question)
+        class_name = classification["classes"][1]["class_name"]
+        return class_name
+
+
+class LogisticClassifier(object):
+    """
+    Multinomial logistic regression over hashed TF-IDF vectors of question text and additional numeric features.
+
+    The weights are fitted by minimizing the L2 regularized cross entropy with L-BFGS.
+    """
+
+    def __init__(self, classes, idf, weights):
+        """
+        :param classes: class names
+        :type classes: numpy.array
+        :param idf: inverse document frequency of each hashed feature
+        :type idf: numpy.array
+        :param weights: weight of each hashed feature, numeric feature, and bias for each class
+        :type weights: numpy.array
+        """
+        self.classes = classes
+        self.idf = idf
+        self.weights = weights
+
+    def __repr__(self):
+        return "%s: %d classes, %d features" % (self.__class__.__name__, len(self.classes), len(self.weights) - 1)
+
+    @classmethod
+    def train(cls, questions, numeric, labels, features=FEATURES, regularization=1.0):
+        """
+        Train a classifier.
+
+        :param questions: training questions
+        :type questions: sequence of str
+        :param numeric: questions by numeric features matrix
+        :type numeric: numpy.array
+        :param labels: class of each question
+        :type labels: sequence
+        :param features: number of hashed features
+        :type features: int
+        :param regularization: weight of the L2 penalty
+        :type regularization: float
+        :return: trained classifier
+        :rtype: LogisticClassifier
+        """
+        counts = _hashed_counts(questions, features)
+        document_frequency = numpy.bincount(counts.indices, minlength=features)
+        idf = numpy.log((1.0 + counts.shape[0]) / (1.0 + document_frequency)) + 1
+        codes, classes = pandas.factorize(pandas.Series(labels))
+        x = _design_matrix(_tf_idf(counts, idf), numeric)
+        # Weights of hashed features that do not occur in the training questions stay zero, so only fit the others.
+        width = x.shape[1]
+        active = numpy.union1d(counts.indices, numpy.arange(features, width))
+        x = x[:, active]
+        n, m = x.shape
+        truth = scipy.sparse.csr_matrix((numpy.ones(n), (numpy.arange(n), codes)), shape=(n, len(classes))).toarray()
+        # The bias is not penalized.
+        penalty = numpy.ones((m, 1))
+        penalty[-1] = 0
+
+        def loss(w):
+            w = w.reshape(m, len(classes))
+            probabilities = _softmax(x.dot(w))
+            cross_entropy = -numpy.log(numpy.maximum(probabilities[truth == 1], 1e-300)).sum()
+            gradient = x.T.dot(probabilities - truth) + regularization * penalty * w
+            return (cross_entropy + 0.5 * regularization * (penalty * w * w).sum()) / n, gradient.ravel() / n
+
+        fit = scipy.optimize.minimize(loss, numpy.zeros(m * len(classes)), jac=True, method="L-BFGS-B")
+        weights = numpy.zeros((width, len(classes)))
+        weights[active] = fit.x.reshape(m, len(classes))
+        classifier = cls(numpy.asarray(classes, dtype=object), idf, weights)
+        logger.info("Trained %s on %d questions" % (classifier, n))
+        return classifier
+
+    def probabilities(self, questions, numeric):
+        """
+        Probability of each class.
+
+        :param questions: questions to classify
+        :type questions: sequence of str
+        :param numeric: questions by numeric features matrix
+        :type numeric: numpy.array
+        :return: questions by classes matrix of probabilities
+        :rtype: numpy.array
+        """
+        vectors = _tf_idf(_hashed_counts(questions, len(self.idf)), self.idf)
+        return _softmax(_design_matrix(vectors, numeric).dot(self.weights))
+
+    def classify(self, questions, numeric):
+        """
+        Most likely class of each question.
+
+        :param questions: questions to classify
+        :type questions: sequence of str
+        :param numeric: questions by numeric features matrix
+        :type numeric: numpy.array
+        :return: class of each question
+        :rtype: numpy.array
+        """
+        return self.classes[self.probabilities(questions, numeric).argmax(axis=1)]
+
+
+def _design_matrix(vectors, numeric):
+    # Text vectors followed by the numeric features and a constant bias feature.
+    numeric = numpy.asarray(numeric, dtype=float)
+    if numeric.ndim == 1:
+        numeric = numeric.reshape(-1, 1)
+    return scipy.sparse.hstack([vectors, numeric, numpy.ones((vectors.shape[0], 1))]).tocsr()
+
+
+def _softmax(logits):
+    exponentials = numpy.exp(logits - logits.max(axis=1, keepdims=True))
+    return exponentials / exponentials.sum(axis=1, keepdims=True)
+
+
+def _hashed_counts(questions, features):
+    # Count the lower-cased words and adjacent word pairs of each question, hashing each distinct term once.
+    rows, terms = [], []
+    for i, question in enumerate(questions):
+        words = TOKEN.findall(question.lower())
+        question_terms = words + [a + " " + b for a, b in zip(words, words[1:])]
+        rows.extend([i] * len(question_terms))
+        terms.extend(question_terms)
+    codes, distinct = pandas.factorize(pandas.Series(terms, dtype=object))
+    hashes = numpy.array([zlib.crc32(term.encode("utf-8")) & 0xffffffff for term in distinct], dtype=numpy.int64)
+    columns = hashes[codes] % features if len(codes) else numpy.zeros(0, dtype=numpy.int64)
+    counts = scipy.sparse.csr_matrix((numpy.ones(len(rows)), (numpy.array(rows, dtype=numpy.int64), columns)),
+                                     shape=(len(questions), features))
+    counts.sum_duplicates()
+    return counts
+
+
+def _tf_idf(counts, idf):
+    # Sublinear term frequency times inverse document frequency, with each row scaled to unit length.
+    vectors = counts.copy()
+    vectors.data = (1 + numpy.log(vectors.data)) * idf[vectors.indices]
+    norms = numpy.sqrt(numpy.asarray(vectors.multiply(vectors).sum(axis=1))).ravel()
+    return scipy.sparse.diags(1.0 / numpy.where(norms == 0, 1, norms)).dot(vectors).tocsr()
@@ -0,0 +1,153 @@
+"""
+A persistent dictionary that maps answer text to stable integer keys.
+
+Answers are multi-kilobyte HTML strings, so joining question/answer pairs on answer text means hashing and comparing
+those strings over and over. Instead, look each distinct answer up in the dictionary once, join on the integer keys,
+and only use the answer text when writing output.
+"""
+import os
+
+import numpy
+import pandas
+
+from themis import ANSWER, CsvFileType, from_csv, logger, to_csv
+
+ANSWER_KEY = "Answer Key"
+MISSING = -1
+
+
+class AnswerDictionary(object):
+    """
+    Mapping of normalized answer text to integer keys.
+
+    Keys are assigned in the order in which answers are first seen, so a key never changes once it has been assigned
+    and the dictionary can be extended as new answers appear.
+    """
+
+    def __init__(self, answers=()):
+        self.index = pandas.Index(normalize_answers(pandas.Series(list(answers), dtype=object)).unique())
+        self.filename = None
+
+    def __repr__(self):
+        return "%s: %d answers" % (self.__class__.__name__, len(self))
+
+    def __len__(self):
+        return len(self.index)
+
+    @classmethod
+    def from_corpus(cls, corpus):
+        return cls(corpus[ANSWER].dropna())
+
+    def keys(self, answers):
+        """
+        Get the keys of a column of answers, adding any answers not yet in the dictionary.
+
+        Only distinct answers are looked up, so this is cheap for categorical columns and columns with many repeated
+        answers.
+
+        :param answers: answer text
+        :type answers: pandas.Series
+        :return: key for each answer, MISSING where the answer is null
+        :rtype: numpy.array
+        """
+        if answers.dtype.name == "category":
+            codes = answers.cat.codes.values
+            distinct_keys = self.keys(pandas.Series(answers.cat.categories, dtype=object))
+        else:
+            codes, distinct = pandas.factorize(answers)
+            distinct_keys = self._distinct_keys(pandas.Series(distinct, dtype=object))
+        # Null answers have code -1, which picks out the MISSING value appended to the end.
+        return numpy.append(distinct_keys, MISSING)[codes]
+
+    def _distinct_keys(self, distinct):
+        distinct = normalize_answers(distinct)
+        keys = self.index.get_indexer(distinct)
+        new = keys == -1
+        if new.any():
+            added = pandas.Index(distinct[new].unique())
+            logger.debug("Add %d answers to %s" % (len(added), self))
+            self.index = self.index.append(added)
+            keys = self.index.get_indexer(distinct)
+        return keys
+
+    def text(self, keys):
+        """
+        Materialize the normalized answer text for a set of keys.
+
+        :param keys: answer keys
+        :type keys: numpy.array
+        :return: answer text, None where the key is MISSING
+        :rtype: numpy.array
+        """
+        keys = numpy.asarray(keys)
+        return numpy.where(keys == MISSING, None, self.index.values[keys])
+
+    def add_keys(self, frame, column=ANSWER):
+        """
+        Return a copy of a frame with an Answer Key column for its answers.
+
+        :param frame: data with an answer column
+        :type frame: pandas.DataFrame
+        :param column: name of the column containing answer text
+        :type column: str
+        :return: data with an additional Answer Key column
+        :rtype: pandas.DataFrame
+        """
+        frame = frame.copy()
+        frame[ANSWER_KEY] = self.keys(frame[column])
+        return frame
+
+    def save(self, filename=None):
+        if filename is None:
+            filename = self.filename
+        to_csv(filename, AnswerDictionaryFileType.output_format(self))
+        logger.info("Wrote %d answers to %s" % (len(self), filename))
+
+
+def normalize_answers(answers):
+    """
+    Normalize answer text for lookup in the answer dictionary.
+
+    Windows line endings are converted and leading and trailing whitespace is removed. Non-string values are left as
+    they are.
+
+    :param answers: answer text
+    :type answers: pandas.Series
+    :return: normalized answer text
+    :rtype: pandas.Series
+    """
+    normalized = answers.str.replace("\r\n", "\n").str.strip()
+    return normalized.where(normalized.notnull(), answers)
+
+
+class AnswerDictionaryFileType(CsvFileType):
+    """
+    Answer dictionary file.
+
+    If the file does not exist an empty dictionary is returned, which may be saved to that file once it has been
+    extended.
+    """
+    columns = [ANSWER_KEY, ANSWER]
+
+    def __init__(self):
+        super(self.__class__, self).__init__(self.__class__.columns)
+
+    def __call__(self, filename):
+        if os.path.isfile(filename):
+            # Read empty and "NA" answers as text so that every key maps to an answer.
+            answers = from_csv(filename, usecols=self.columns, keep_default_na=False).sort_values(ANSWER_KEY)
+            if not (answers[ANSWER_KEY].values == numpy.arange(len(answers))).all():
+                raise ValueError("Answer keys in %s are not contiguous" % filename)
+            dictionary = AnswerDictionary()
+            dictionary.index = pandas.Index(answers[ANSWER].values.astype(object))
+            logger.info("Read %d answers from %s" % (len(dictionary), filename))
+        else:
+            logger.info("{0} does not exist, starting an empty answer dictionary".format(filename))
+            dictionary = AnswerDictionary()
+        dictionary.filename = filename
+        return dictionary
+
+    @classmethod
+    def output_format(cls, dictionary):
+        answers = pandas.DataFrame({ANSWER_KEY: numpy.arange(len(dictionary)), ANSWER: dictionary.index.values})
+        return answers[cls.columns].set_index(ANSWER_KEY)
@@ -1,9 +1,15 @@
 import json
+import multiprocessing
+import re
+import sqlite3
+from collections import OrderedDict
 
+import numpy
 import pandas
 
 from themis import ANSWER, ANSWER_ID, TITLE, FILENAME, QUESTION, CONFIDENCE, IN_PURVIEW, CORRECT
-from themis import logger, CsvFileType, pretty_print_json
+from themis import logger, CsvFileType, nullable_boolean
+from themis.dictionary import ANSWER_KEY, AnswerDictionary
 from themis.question import QUESTION_TEXT, TOP_ANSWER_TEXT
 
 QUESTION_TEXT_INPUT = "QuestionText"  # Column header for input file required by Annotation Assist
@@ -18,7 +24,7 @@ ANS_SHORT = "ANS_SHORT"
 IS_ON_TOPIC = "IS_ON_TOPIC"
 
 
-def annotation_assist_qa_input(answers, questions, judgments):
+def annotation_assist_qa_input(answers, questions, judgments, answer_dictionary=None, judgment_store=None):
     """
     Create list of Q&A pairs for judgment by Annotation Assist.
 
@@ -31,19 +37,34 @@ def annotation_assist_qa_input(answers, questions, judgments):
     :type questions: pandas.DataFrame
     :param judgments: optional judgments, look up a judgment here before sending the Q&A pair to Annotation Assist
     :type judgments: pandas.DataFrame
+    :param answer_dictionary: dictionary used to join on answer keys instead of answer text
+    :type answer_dictionary: AnswerDictionary
+    :param judgment_store: optional store of previous judgments, look up a judgment here as well
+    :type judgment_store: JudgmentStore
     :return: Q&A pairs to pass to Annotation Assist for judgment
     :rtype: pandas.DataFrame
     """
-    qa_pairs = pandas.concat(answers)
-    qa_pairs = qa_pairs.drop_duplicates([QUESTION, ANSWER])
+    if judgment_store is not None:
+        answer_dictionary = judgment_store.answer_dictionary
+    elif answer_dictionary is None:
+        answer_dictionary = AnswerDictionary()
+    qa_pairs = answer_dictionary.add_keys(pandas.concat(answers))
+    qa_pairs = qa_pairs.drop_duplicates([QUESTION, ANSWER_KEY])
     logger.info("%d Q&A pairs" % len(qa_pairs))
     if questions is not None:
         qa_pairs = pandas.merge(qa_pairs, questions)
         logger.info("%d Q&A pairs for %d unique questions" % (len(qa_pairs), len(questions)))
+    judged = []
     if judgments:
-        judged_qa_pairs = pandas.concat(judgments)
+        judged_qa_pairs = keyed_judgments(pandas.concat(judgments), answer_dictionary)
         assert not any(judged_qa_pairs.duplicated()), "There are Q&A pairs with multiple judgements"
-        qa_pairs = pandas.merge(qa_pairs, judged_qa_pairs, on=(QUESTION, ANSWER), how="left")
+        judged.append(judged_qa_pairs)
+    if judgment_store is not None:
+        judged.append(judgment_store.lookup(qa_pairs[QUESTION], qa_pairs[ANSWER]))
+    if judged:
+        # Judgments from files take precedence over those in the store.
+        judged_qa_pairs = pandas.concat(judged).drop_duplicates([QUESTION, ANSWER_KEY])
+        qa_pairs = pandas.merge(qa_pairs, judged_qa_pairs, on=(QUESTION, ANSWER_KEY), how="left")
         not_judged = qa_pairs[qa_pairs[CORRECT].isnull()]
         n = len(not_judged)
         logger.info("%d unjudged Q&A pairs (%0.3f%%)" % (n, 100.0 * n / len(qa_pairs)))
@@ -56,18 +77,38 @@ def annotation_assist_qa_input(answers, questions, judgments):
     return not_judged
 
 
-def create_annotation_assist_corpus(corpus):
+def create_annotation_assist_corpus(corpus, output):
     """
     Create the JSON corpus file used by the Annotation Assist tool.
 
+    Records are written one at a time as they are read from the corpus rows, so no serialized copy of the whole corpus
+    is held in memory. The output is formatted the same way as pretty_print_json.
+
     :param corpus: corpus generated by 'xmgr corpus' command
     :type corpus: pandas.DataFrame
-    :return: JSON representation of the corpus used by Annotation Assist
-    :rtype: str
+    :param output: file to which to write the JSON representation of the corpus used by Annotation Assist
+    :type output: file
     """
-    corpus["splitPauTitle"] = corpus[TITLE].apply(lambda title: title.split(":"))
     corpus = corpus.rename(columns={ANSWER: "text", ANSWER_ID: "pauId", TITLE: "title", FILENAME: "fileName"})
-    return pretty_print_json(json.loads(corpus.to_json(orient="records"), encoding="utf-8"))
+    corpus["splitPauTitle"] = corpus["title"].str.split(":")
+    columns = list(corpus.columns)
+    output.write("[")
+    for i, values in enumerate(corpus.itertuples(index=False)):
+        record = json.dumps(OrderedDict(zip(columns, [_json_value(value) for value in values])), indent=2)
+        output.write("\n" if i == 0 else ",\n")
+        output.write("\n".join("  " + line for line in record.split("\n")))
+    output.write("]\n" if corpus.empty else "\n]\n")
+
+
+def _json_value(value):
+    # JSON has no NaN, so write missing values as null as pandas.DataFrame.to_json does.
+    if isinstance(value, list):
+        return value
+    if pandas.isnull(value):
+        return None
+    if hasattr(value, "item"):
+        return value.item()
+    return value
 
 
 def interpret_annotation_assist(annotation_assist, judgment_threshold):
@@ -98,6 +139,198 @@ def interpret_annotation_assist(annotation_assist, judgment_threshold):
     return annotation_assist.drop(ANNOTATION_SCORE, axis="columns")
 
 
+HTML_TOKEN = re.compile(r"<!--.*?-->|<[^>]*>|&#?\w+;|[^<&]+|[<&]", re.DOTALL)
+HTML_TAG = re.compile(r"<\s*(/)?\s*([a-zA-Z][\w:-]*)[^>]*?(/)?\s*>$", re.DOTALL)
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track",
+                 "wbr"}
+
+
+def truncate_html(html, allowed_length):
+    """
+    Truncate HTML to at most a given number of characters, closing any tags that are open at the cut point.
+
+    The string is scanned once, keeping track of the open tags and the length of the closing tags they would need. The
+    cut is made at the last point where the text so far plus those closing tags fits in the allowed length. Tags,
+    comments, and character entities are never split.
+
+    :param html: HTML text
+    :type html: str
+    :param allowed_length: maximum length of the truncated text
+    :type allowed_length: int
+    :return: truncated HTML
+    :rtype: str
+    """
+    if len(html) <= allowed_length:
+        return html
+    # The open tags are a linked list of (name, closing tags length, parent) tuples so that the state at the best cut
+    # point can be kept without copying.
+    open_tags = None
+    cut, cut_tags = 0, None
+    for token in HTML_TOKEN.finditer(html):
+        start, end = token.span()
+        closing = open_tags[1] if open_tags else 0
+        if start + closing > allowed_length:
+            # Closing a tag in the source takes at least as much room as appending its closing tag, so no later cut
+            # point can fit.
+            break
+        if token.group().startswith("<") and len(token.group()) > 1:
+            tag = HTML_TAG.match(token.group())
+            if tag is not None:
+                closing_tag, name, self_closing = tag.groups()
+                name = name.lower()
+                if closing_tag:
+                    node = open_tags
+                    while node is not None and node[0] != name:
+                        node = node[2]
+                    if node is not None:
+                        open_tags = node[2]
+                elif not self_closing and name not in VOID_ELEMENTS:
+                    open_tags = (name, closing + len(name) + 3, open_tags)
+        elif token.group()[0] not in "<&":
+            # Plain text may be cut anywhere.
+            end = min(end, allowed_length - closing)
+        closing = open_tags[1] if open_tags else 0
+        if end + closing <= allowed_length:
+            cut, cut_tags = end, open_tags
+    closing_tags = []
+    while cut_tags is not None:
+        closing_tags.append("</%s>" % cut_tags[0])
+        cut_tags = cut_tags[2]
+    return html[:cut] + "".join(closing_tags)
+
+
+def truncate_answers(answers, allowed_length, processes=None, chunk_size=10000):
+    """
+    Truncate a column of HTML answers, splitting it into chunks that are truncated in parallel worker processes.
+
+    :param answers: HTML answers
+    :type answers: pandas.Series
+    :param allowed_length: maximum length of the truncated answers
+    :type allowed_length: int
+    :param processes: number of worker processes, by default the number of CPUs
+    :type processes: int
+    :param chunk_size: number of answers per chunk
+    :type chunk_size: int
+    :return: truncated answers
+    :rtype: pandas.Series
+    """
+    chunks = [(chunk, allowed_length) for chunk in
+              numpy.array_split(answers.values, max(1, int(numpy.ceil(len(answers) / float(chunk_size)))))]
+    if len(chunks) == 1:
+        truncated = [_truncate_chunk(chunks[0])]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            truncated = pool.map(_truncate_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    return pandas.Series(numpy.concatenate(truncated), index=answers.index, name=answers.name)
+
+
+def _truncate_chunk(chunk_and_length):
+    chunk, allowed_length = chunk_and_length
+    return numpy.array([html if pandas.isnull(html) else truncate_html(html, allowed_length) for html in chunk],
+                       dtype=object)
+
+
+class JudgmentStore(object):
+    """
+    Judgments accumulated over multiple Annotation Assist rounds, stored in an SQLite database indexed by question and
+    answer key.
+
+    Answers are identified by their keys in an answer dictionary, so the same dictionary must be used every time the
+    store is opened. New judgments replace existing judgments of the same question/answer pair. Looking up the
+    judgments for a set of Q&A pairs only touches those pairs, so its cost does not grow with the number of judgments
+    in the store.
+    """
+
+    def __init__(self, filename, answer_dictionary):
+        self.filename = filename
+        self.answer_dictionary = answer_dictionary
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS judgments (
+                                   question TEXT NOT NULL,
+                                   answer_key INTEGER NOT NULL,
+                                   in_purview INTEGER NOT NULL,
+                                   correct INTEGER NOT NULL,
+                                   PRIMARY KEY (question, answer_key))""")
+
+    def __repr__(self):
+        return "%s: %s, %d judgments" % (self.__class__.__name__, self.filename, len(self))
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM judgments").fetchone()[0]
+
+    def upsert(self, judgments):
+        """
+        Add judgments to the store, replacing any previous judgments of the same question/answer pairs.
+
+        :param judgments: judgments with Question, Answer, In Purview, and Correct columns
+        :type judgments: pandas.DataFrame
+        """
+        judgments = judgments.dropna(subset=[IN_PURVIEW, CORRECT])
+        keys = self.answer_dictionary.keys(judgments[ANSWER])
+        rows = zip(judgments[QUESTION], (int(key) for key in keys),
+                   (int(j) for j in judgments[IN_PURVIEW]), (int(j) for j in judgments[CORRECT]))
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO judgments VALUES (?, ?, ?, ?)", rows)
+        logger.info("Stored %d judgments in %s" % (len(judgments), self))
+
+    def lookup(self, questions, answers):
+        """
+        Get the stored judgments for a set of question/answer pairs.
+
+        :param questions: question text
+        :type questions: pandas.Series
+        :param answers: answer text for each question
+        :type answers: pandas.Series
+        :return: Question, Answer Key, In Purview, and Correct for the pairs that have been judged
+        :rtype: pandas.DataFrame
+        """
+        keys = self.answer_dictionary.keys(answers)
+        pairs = set(zip(questions, (int(key) for key in keys)))
+        with self.connection:
+            self.connection.execute("CREATE TEMPORARY TABLE IF NOT EXISTS pairs (question TEXT, answer_key INTEGER)")
+            self.connection.execute("DELETE FROM pairs")
+            self.connection.executemany("INSERT INTO pairs VALUES (?, ?)", pairs)
+            rows = self.connection.execute("""SELECT j.question, j.answer_key, j.in_purview, j.correct
+                                              FROM pairs p JOIN judgments j
+                                              ON j.question = p.question AND j.answer_key = p.answer_key""").fetchall()
+        judgments = pandas.DataFrame.from_records(rows, columns=[QUESTION, ANSWER_KEY, IN_PURVIEW, CORRECT])
+        judgments[[IN_PURVIEW, CORRECT]] = judgments[[IN_PURVIEW, CORRECT]].astype("bool")
+        logger.info("Found %d judgments for %d Q&A pairs in %s" % (len(judgments), len(pairs), self.filename))
+        return judgments
+
+    def close(self):
+        self.connection.close()
+
+
+def keyed_judgments(judgments, answer_dictionary, remove_newlines=False):
+    """
+    Replace the answer text in a set of judgments with answer keys.
+
+    Judgments looked up in a judgment store are already keyed and are returned unchanged.
+
+    :param judgments: judgments with either an Answer or an Answer Key column
+    :type judgments: pandas.DataFrame
+    :param answer_dictionary: dictionary used to key the answers
+    :type answer_dictionary: AnswerDictionary
+    :param remove_newlines: key the answers with newlines removed
+    :type remove_newlines: bool
+    :return: judgments with an Answer Key column instead of an Answer column
+    :rtype: pandas.DataFrame
+    """
+    if ANSWER_KEY in judgments.columns:
+        return judgments
+    answers = judgments[ANSWER]
+    if remove_newlines:
+        answers = answers.str.replace("\n", "")
+    judgments = judgments.drop(ANSWER, axis="columns")
+    judgments[ANSWER_KEY] = answer_dictionary.keys(answers)
+    return judgments
+
+
 class AnnotationAssistFileType(CsvFileType):
     """
     Read the file produced by the `Annotation Assist <https://github.com/cognitive-catalyst/annotation-assist>` tool.
@@ -117,13 +350,21 @@ class JudgmentFileType(CsvFileType):
     def __init__(self):
         super(self.__class__, self).__init__([QUESTION, ANSWER, IN_PURVIEW, CORRECT])
 
+    def __call__(self, filename):
+        judgments = super(self.__class__, self).__call__(filename)
+        # The same answer is judged for many questions, so intern the answer text.
+        judgments[ANSWER] = judgments[ANSWER].astype("category")
+        for column in [IN_PURVIEW, CORRECT]:
+            judgments[column] = nullable_boolean(judgments[column])
+        return judgments
+
     @staticmethod
     def output_format(judgments):
         judgments = judgments.sort_values([QUESTION, ANSWER])
         return judgments.set_index([QUESTION, ANSWER])
 
 
-def augment_usage_log(usage_log, judgments):
+def augment_usage_log(usage_log, judgments, answer_dictionary=None):
     """
     Add In Purview and Annotation Score information to system usage log.
 
@@ -131,13 +372,20 @@ def augment_usage_log(usage_log, judgments):
     :type usage_log: pandas.DataFrame
     :param judgments: judgments
     :type judgments: pandas.DataFrame
+    :param answer_dictionary: dictionary used to join on answer keys instead of answer text
+    :type answer_dictionary: AnswerDictionary
     :return: user interaction logs with additional columns
     :rtype: pandas.DataFrame
     """
+    if answer_dictionary is None:
+        answer_dictionary = AnswerDictionary()
     usage_log = usage_log.rename(columns={QUESTION_TEXT: QUESTION, TOP_ANSWER_TEXT: ANSWER})
-    augmented = pandas.merge(usage_log, judgments, on=(QUESTION, ANSWER), how="left")
-    n = len(usage_log[[QUESTION, ANSWER]].drop_duplicates())
+    usage_log = answer_dictionary.add_keys(usage_log)
+    judgments = keyed_judgments(judgments, answer_dictionary)
+    augmented = pandas.merge(usage_log, judgments, on=(QUESTION, ANSWER_KEY), how="left")
+    n = len(usage_log[[QUESTION, ANSWER_KEY]].drop_duplicates())
     if n:
         m = len(judgments)
         logger.info("%d unique question/answer pairs, %d judgments (%0.3f%%)" % (n, m, 100.0 * m / n))
+    augmented = augmented.drop(ANSWER_KEY, axis="columns")
     return augmented.rename(columns={QUESTION: QUESTION_TEXT, ANSWER: TOP_ANSWER_TEXT})
@@ -5,42 +5,53 @@ various Q&A systems, annotate the answers and analyze the results.
 
 import argparse
 import os
+import re
+import sys
 import textwrap
 from argparse import RawDescriptionHelpFormatter as Raw
 from collections import Counter
 from random import shuffle
 
 import pandas
-from BeautifulSoup import BeautifulSoup
 
 from themis import configure_logger, CsvFileType, to_csv, QUESTION, ANSWER_ID, pretty_print_json, logger, print_csv, \
-    __version__, FREQUENCY, ANSWER, IN_PURVIEW, CORRECT, DOCUMENT_ID, ensure_directory_exists, CONFIDENCE
+    __version__, FREQUENCY, ANSWER, IN_PURVIEW, CORRECT, DOCUMENT_ID, ensure_directory_exists, CONFIDENCE, from_csv
 
 from themis.analyze import SYSTEM, CollatedFileType, add_judgments_and_frequencies_to_qa_pairs, system_similarity, \
     compare_systems, oracle_combination, filter_judged_answers, corpus_statistics, truth_statistics, \
     in_purview_disagreement, analyze_answers, truth_coverage, OracleFileType, long_tail_fat_head, kfold_split, \
 nlc_router_train,nlc_router_status, nlc_router_test
 
-from themis.analyze import (SYSTEM, CollatedFileType, OracleFileType,
-                            add_judgments_and_frequencies_to_qa_pairs,
-                            analyze_answers, compare_systems,
-                            corpus_statistics, fallback_combination,
-                            filter_judged_answers, in_purview_disagreement,
-                            in_purview_disagreement_evaluate, kfold_split,
-                            long_tail_fat_head, oracle_combination,
+from themis.analyze import (NLC_ROUTER_FOLDS, SYSTEM, CollatedFileType,
+                            EvaluationMatrixFileType, OracleFileType,
+                            TokenCountsFileType, analyze_answers,
+                            collate_systems, compare_all_systems,
+                            compare_all_systems_questions, compare_systems,
+                            concat_collated, corpus_statistics,
+                            fallback_combination, filter_judged_answers,
+                            in_purview_disagreement,
+                            in_purview_disagreement_evaluate,
+                            in_purview_disagreement_rates, kfold_split,
+                            local_router, long_tail_fat_head, long_tail_sweep,
+                            nlc_router, nlc_router_wait, oracle_combination,
+                            oracle_sweep, system_significance,
                             system_similarity, truth_coverage,
                             truth_statistics, voting_router)
 from themis.answer import (AnswersFileType, Solr, answer_questions,
                            get_answers_from_usage_log)
 from themis.checkpoint import retry
+from themis.classifier import (FEATURES, LocalNLC, TextClassifier,
+                               train_text_classifier)
+from themis.dictionary import AnswerDictionaryFileType
 from themis.fixup import (deakin, filter_corpus, filter_usage_log_by_date,
                           filter_usage_log_by_user_experience)
 from themis.judge import (AnnotationAssistFileType, JudgmentFileType,
-                          annotation_assist_qa_input, augment_usage_log,
-                          create_annotation_assist_corpus,
-                          interpret_annotation_assist)
-from themis.nlc import (NLC, classifier_list, classifier_status,
-                        remove_classifiers, train_nlc)
+                          JudgmentStore, annotation_assist_qa_input,
+                          augment_usage_log, create_annotation_assist_corpus,
+                          interpret_annotation_assist, truncate_answers)
+from themis.nlc import (NLC, STATUS_RETRIES, classifier_list,
+                        classifier_status, remove_classifiers, train_nlc,
+                        wait_for_classifiers)
 from themis.plot import generate_curves, plot_curves
 from themis.question import (DATE_TIME, QAPairFileType,
                              QuestionFrequencyFileType, UsageLogFileType,
@@ -178,6 +189,7 @@ def xmgr_command(subparsers):
                                  help="corpus file created by the 'download-corpus' or 'trec-corpus' command")
     augment_answers.add_argument("qa_pairs", metavar="qa-pairs", type=QAPairFileType(),
                                  help="question/answer pairs produced by the 'question extract' command")
+    add_answer_dictionary_argument(augment_answers)
     augment_answers.set_defaults(func=augment_answers_handler)
     # Augment corpus with answer IDs pulled from truth.
     augment_truth = subparsers.add_parser("augment-truth",
@@ -226,6 +238,7 @@ def xmgr_command(subparsers):
                                        help="corpus file created by the 'download corpus' command")
     xmgr_validate_answers.add_argument("qa_pairs", metavar="qa-pairs", type=QAPairFileType(),
                                        help="Q&A pair file generated by 'question extract'")
+    add_answer_dictionary_argument(xmgr_validate_answers)
     xmgr_validate_answers.set_defaults(func=validate_answers_handler)
     # Write questions and answers in truth to an HTML file.
     xmgr_examine = subparsers.add_parser("examine-truth", parents=[verify_arguments],
@@ -237,6 +250,21 @@ def xmgr_command(subparsers):
                                          help="create human-readable truth file with answers and their " +
                                               "associated questions")
     xmgr_examine.set_defaults(func=examine_handler)
+    # Build an answer dictionary from the corpus.
+    xmgr_dictionary = subparsers.add_parser("answer-dictionary",
+                                            formatter_class=Raw,
+                                            description=textwrap.dedent("""
+    Build a dictionary that maps answer text to stable integer keys from the corpus.
+
+    If the dictionary file already exists, answers in the corpus that are not in it are added with new keys. Commands
+    that join on answer text take an optional --answer-dictionary argument and join on these keys instead, adding any
+    new answers they encounter."""),
+                                            help="build answer dictionary from corpus")
+    xmgr_dictionary.add_argument("corpus", type=CorpusFileType(),
+                                 help="corpus file created by the 'download-corpus' or 'trec-corpus' command")
+    xmgr_dictionary.add_argument("answer_dictionary", metavar="answer-dictionary", type=AnswerDictionaryFileType(),
+                                 help="answer dictionary file to create or extend")
+    xmgr_dictionary.set_defaults(func=answer_dictionary_handler)
 
 
 def download_handler(args):
@@ -269,8 +297,9 @@ def document_handler(args):
 
 
 def augment_answers_handler(args):
-    augmented_corpus = augment_corpus_answers(args.corpus, args.qa_pairs)
+    augmented_corpus = augment_corpus_answers(args.corpus, args.qa_pairs, args.answer_dictionary)
     print_csv(CorpusFileType.output_format(augmented_corpus))
+    save_answer_dictionary(args)
 
 
 def augment_truth_handler(args):
@@ -289,13 +318,32 @@ def validate_truth_handler(args):
 
 
 def validate_answers_handler(args):
-    validate_answers_with_corpus(args.corpus, args.qa_pairs, args.output_directory)
+    validate_answers_with_corpus(args.corpus, args.qa_pairs, args.output_directory, args.answer_dictionary)
+    save_answer_dictionary(args)
 
 
 def examine_handler(args):
     examine_truth(args.corpus, args.truth)
 
 
+def answer_dictionary_handler(args):
+    n = len(args.answer_dictionary)
+    args.answer_dictionary.keys(args.corpus[ANSWER])
+    logger.info("Added %d answers from the corpus" % (len(args.answer_dictionary) - n))
+    args.answer_dictionary.save()
+
+
+def add_answer_dictionary_argument(parser):
+    parser.add_argument("--answer-dictionary", metavar="ANSWER-DICTIONARY", type=AnswerDictionaryFileType(),
+                        help="join on keys from this answer dictionary instead of on answer text, " +
+                             "adding any new answers to it")
+
+
+def save_answer_dictionary(args):
+    if args.answer_dictionary is not None:
+        args.answer_dictionary.save()
+
+
 def question_command(subparsers):
     question_parser = subparsers.add_parser("question", help="get questions to ask a Q&A system")
     subparsers = question_parser.add_subparsers(description="get questions to ask a Q&A system")
@@ -373,6 +421,21 @@ def sample_handler(args):
     print_csv(QuestionFrequencyFileType.output_format(sample))
 
 
+def classifier_watch_arguments():
+    """
+    Arguments that control how often classifier statuses are requested while waiting for them to finish training.
+    """
+    watch_arguments = argparse.ArgumentParser(add_help=False)
+    watch_arguments.add_argument("--interval", type=float, default=10,
+                                 help="initial seconds between classifier status requests, default 10")
+    watch_arguments.add_argument("--max-interval", type=float, default=300,
+                                 help="maximum seconds between classifier status requests, default 300")
+    watch_arguments.add_argument("--retries", type=int, default=STATUS_RETRIES,
+                                 help="number of times to request a classifier status before giving up after an error, "
+                                      "default %d" % STATUS_RETRIES)
+    return watch_arguments
+
+
 def answer_command(subparsers):
     """
     Get answers to questions from various Q&A systems.
@@ -390,6 +453,11 @@ def answer_command(subparsers):
         3. list
         4. status
         5. delete
+
+    Local NLC
+        Train a local classifier on the truth file and use it in place of an NLC model.
+        1. train
+        2. use
     """
     qa_shared_arguments = argparse.ArgumentParser(add_help=False)
     qa_shared_arguments.add_argument("questions", type=QuestionSetFileType(),
@@ -435,6 +503,7 @@ def answer_command(subparsers):
     nlc_shared_arguments.add_argument("url", help="NLC url")
     nlc_shared_arguments.add_argument("username", help="NLC username")
     nlc_shared_arguments.add_argument("password", help="NLC password")
+    watch_arguments = classifier_watch_arguments()
 
     nlc_parser = subparsers.add_parser("nlc",
                                        help="answer questions with NLC")
@@ -446,31 +515,69 @@ def answer_command(subparsers):
     nlc_train.add_argument("name", help="classifier name")
     nlc_train.set_defaults(func=nlc_train_handler)
     # Use an NLC model.
-    nlc_use = nlc_subparsers.add_parser("use", parents=[nlc_shared_arguments, qa_shared_arguments, checkpoint_argument],
+    nlc_use = nlc_subparsers.add_parser("use", parents=[nlc_shared_arguments, qa_shared_arguments, checkpoint_argument,
+                                                        watch_arguments],
                                         formatter_class=Raw,
                                         description=textwrap.dedent("""
     Use an NLC model to classify questions. The answer corresponding to the most likely class is treated as the answer
     to the question.
 
+    With --wait, wait for the model to finish training before classifying questions, so that this can be run as soon
+    as training has been started.
+
     Results are saved to an intermediary file. If the process fails in the middle it can be restarted and will pick up
     where it left off."""),
                                         help="use NLC model")
     nlc_use.add_argument("classifier", help="classifier id")
     nlc_use.add_argument("corpus", type=CorpusFileType(),
                          help="corpus file created by the 'download-corpus' or 'trec-corpus' command")
+    nlc_use.add_argument("--threads", type=int, default=10,
+                         help="number of questions to classify at once, default 10")
+    nlc_use.add_argument("--wait", action="store_true", help="wait for the model to finish training")
     nlc_use.set_defaults(func=nlc_use_handler)
     # List all NLC models.
     nlc_list = nlc_subparsers.add_parser("list", parents=[nlc_shared_arguments], help="list NLC models")
     nlc_list.set_defaults(func=nlc_list_handler)
     # Get status of NLC models.
-    nlc_status = nlc_subparsers.add_parser("status", parents=[nlc_shared_arguments], help="status of NLC model")
+    nlc_status = nlc_subparsers.add_parser("status", parents=[nlc_shared_arguments, watch_arguments],
+                                           help="status of NLC model")
     nlc_status.add_argument("classifiers", nargs="+", help="classifier ids")
+    nlc_status.add_argument("--watch", action="store_true",
+                            help="poll the models until they have all finished training or failed")
     nlc_status.set_defaults(func=nlc_status_handler)
     # Delete NLC models.
     nlc_delete = nlc_subparsers.add_parser("delete", parents=[nlc_shared_arguments], help="delete an NLC model")
     nlc_delete.add_argument("classifiers", nargs="+", help="classifier ids")
     nlc_delete.set_defaults(func=nlc_delete_handler)
 
+    # Train and use a local classifier in place of an NLC model.
+    local_nlc_parser = subparsers.add_parser("local-nlc", help="answer questions with a local classifier")
+    local_nlc_subparsers = local_nlc_parser.add_subparsers(title="Local classifier",
+                                                           description="train and use a local stand-in for NLC",
+                                                           help="local classifier actions")
+    local_nlc_train = local_nlc_subparsers.add_parser("train", formatter_class=Raw, description=textwrap.dedent("""
+    Train a local classifier on the truth file. Questions are represented as hashed TF-IDF vectors of their words and
+    word pairs and are assigned to the answer whose training questions they are closest to."""),
+                                                      help="train a local classifier")
+    local_nlc_train.add_argument("truth", type=TruthFileType(), help="truth file created by the 'xmgr truth' command")
+    local_nlc_train.add_argument("model", help="file to which to write the classifier")
+    local_nlc_train.add_argument("--features", type=int, default=FEATURES,
+                                 help="number of hashed features, default %d" % FEATURES)
+    local_nlc_train.set_defaults(func=local_nlc_train_handler)
+    local_nlc_use = local_nlc_subparsers.add_parser("use", parents=[qa_shared_arguments, checkpoint_argument],
+                                                    formatter_class=Raw,
+                                                    description=textwrap.dedent("""
+    Use a local classifier to classify questions in the same way as the 'nlc use' command.
+
+    Results are saved to an intermediary file. If the process fails in the middle it can be restarted and will pick up
+    where it left off."""),
+                                                    help="use a local classifier")
+    local_nlc_use.add_argument("model", type=TextClassifier.load,
+                               help="classifier created by the 'local-nlc train' command")
+    local_nlc_use.add_argument("corpus", type=CorpusFileType(),
+                               help="corpus file created by the 'download-corpus' or 'trec-corpus' command")
+    local_nlc_use.set_defaults(func=local_nlc_use_handler)
+
 
 def wea_handler(args):
     wea_answers = get_answers_from_usage_log(args.questions, args.qa_pairs)
@@ -485,27 +592,59 @@ def nlc_train_handler(args):
     print(train_nlc(args.url, args.username, args.password, args.truth, args.name))
 
 def nlc_router_train_handler(args):
-    print(nlc_router_train(args.url, args.username, args.password, args.oracle_out, args.path, args.all_correct))
+    print(nlc_router_train(args.url, args.username, args.password, args.oracle_out, args.path, args.all_correct,
+                           args.folds, args.seed, args.stratify))
 
 def nlc_router_status_handler(args):
-    print(nlc_router_status(args.url, args.username, args.password,args.path))
+    nlc_router_status(args.url, args.username, args.password, args.path, args.watch, args.interval, args.max_interval,
+                      args.retries)
 
 def nlc_router_test_handler(args):
-   res = nlc_router_test(args.url, args.username, args.password, args.collate_file, args.path)
+   if args.wait:
+       nlc_router_wait(args.url, args.username, args.password, args.path, args.interval, args.max_interval,
+                       args.retries)
+   res = nlc_router_test(args.url, args.username, args.password, args.collate_file, args.path, args.processes)
    print_csv(OracleFileType.output_format(res))
 
+def nlc_router_run_handler(args):
+    res = nlc_router(args.url, args.username, args.password, args.oracle_out, args.collate_file, args.path,
+                     args.all_correct, args.folds, args.seed, args.stratify, args.interval, args.max_interval,
+                     args.retries)
+    print_csv(OracleFileType.output_format(res))
+
+def nlc_router_local_handler(args):
+    res = local_router(args.oracle_out, args.collate_file, args.all_correct, args.folds, args.seed, args.stratify,
+                       args.processes, args.features, args.name)
+    print_csv(OracleFileType.output_format(res))
+
 def nlc_use_handler(args):
+    if args.wait:
+        wait_for_classifiers(args.url, args.username, args.password, [args.classifier], args.interval,
+                             args.max_interval, retries=args.retries)
     corpus = args.corpus.set_index(ANSWER_ID)
-    n = NLC(args.url, args.username, args.password, args.classifier, corpus)
+    n = NLC(args.url, args.username, args.password, args.classifier, corpus, args.threads)
     answer_questions(n, set(args.questions[QUESTION]), args.output, args.checkpoint_frequency)
 
 
+def local_nlc_train_handler(args):
+    train_text_classifier(args.truth, args.model, args.features)
+
+
+def local_nlc_use_handler(args):
+    corpus = args.corpus.set_index(ANSWER_ID)
+    # The classifier's class names are Answer Id strings, but numeric Answer Ids are read from the corpus as integers.
+    corpus.index = corpus.index.astype(str)
+    answer_questions(LocalNLC(args.model, corpus), set(args.questions[QUESTION]), args.output,
+                     args.checkpoint_frequency)
+
+
 def nlc_list_handler(args):
     print(pretty_print_json(classifier_list(args.url, args.username, args.password)))
 
 
 def nlc_status_handler(args):
-    classifier_status(args.url, args.username, args.password, args.classifiers)
+    classifier_status(args.url, args.username, args.password, args.classifiers, args.watch, args.interval,
+                      args.max_interval, args.retries)
 
 
 def nlc_delete_handler(args):
@@ -545,7 +684,8 @@ def judge_command(subparsers):
     Create list of Q&A pairs for judgment by Annotation Assist.
 
     The Q&A pairs to be judged are compiled from sets of answers generated by Q&A systems. These may be filtered by an
-    optional list of questions. Judgements may be taken from optional sets of previously judged Q&A pairs."""),
+    optional list of questions. Judgements may be taken from optional sets of previously judged Q&A pairs or from a
+    judgment store."""),
                                         help="generate question and answer pairs for judgment by Annotation Assistant")
     judge_pairs.add_argument("answers", type=CsvFileType(), nargs="+",
                              help="answers generated by one of the 'answer' commands")
@@ -553,7 +693,9 @@ def judge_command(subparsers):
                              help="limit Q&A pairs to just these questions")
     judge_pairs.add_argument("--judgments", type=JudgmentFileType(), nargs="+",
                              help="Q&A pair judgments generated by the 'judge interpret' command")
-    judge_pairs.set_defaults(func=annotation_pairs_handler)
+    add_answer_dictionary_argument(judge_pairs)
+    add_judgment_store_argument(judge_pairs)
+    judge_pairs.set_defaults(func=HandlerClosure(annotation_pairs_handler, judge_pairs))
     # Annotation Assistant corpus.
     judge_corpus = subparsers.add_parser("corpus",
                                          description="Create the JSON corpus file used by the Annotation Assist tool.",
@@ -569,13 +711,18 @@ def judge_command(subparsers):
 
     Convert the in purview column from an integer value to a boolean. Convert the annotation score column to a boolean
     correct column by applying a threshold. An answer can only be correct if the question is in purview. Drop any Q&A
-    pairs that have multiple annotations."""),
+    pairs that have multiple annotations.
+
+    If a judgment store is specified, the judgments are also added to it, replacing any earlier judgments of the same
+    Q&A pairs."""),
                                             help="interpret Annotation Assistant judgments")
     judge_interpret.add_argument("judgments", type=AnnotationAssistFileType(),
                                  help="judgments file downloaded from Annotation Assistant")
     judge_interpret.add_argument("--judgment-threshold", metavar="JUDGMENT-THRESHOLD", type=float, default=50,
                                  help="cutoff value for a correct score, default 50")
-    judge_interpret.set_defaults(func=annotation_interpret_handler)
+    add_answer_dictionary_argument(judge_interpret)
+    add_judgment_store_argument(judge_interpret)
+    judge_interpret.set_defaults(func=HandlerClosure(annotation_interpret_handler, judge_interpret))
     # Create sample of already judged questions.
     judge_sample = subparsers.add_parser("sample",
                                          formatter_class=Raw,
@@ -599,21 +746,54 @@ def judge_command(subparsers):
                                help="QuestionsData.csv usage log file from XMGR")
     judge_augment.add_argument("judgments", type=JudgmentFileType(),
                                help="judgments file created by 'judge interpret' command")
+    add_answer_dictionary_argument(judge_augment)
     judge_augment.set_defaults(func=augment_handler)
 
 
-def annotation_pairs_handler(args):
-    qa_pairs = annotation_assist_qa_input(args.answers, args.questions, args.judgments)
+def annotation_pairs_handler(parser, args):
+    judgment_store = open_judgment_store(parser, args)
+    try:
+        qa_pairs = annotation_assist_qa_input(args.answers, args.questions, args.judgments, args.answer_dictionary,
+                                              judgment_store)
+    finally:
+        close_judgment_store(judgment_store)
     print_csv(qa_pairs, index=False)
+    save_answer_dictionary(args)
 
 
 def annotation_corpus_handler(args):
-    print(create_annotation_assist_corpus(args.corpus))
+    create_annotation_assist_corpus(args.corpus, sys.stdout)
 
 
-def annotation_interpret_handler(args):
+def annotation_interpret_handler(parser, args):
+    judgment_store = open_judgment_store(parser, args)
     judgments = interpret_annotation_assist(args.judgments, args.judgment_threshold)
     print_csv(JudgmentFileType.output_format(judgments))
+    if judgment_store is not None:
+        try:
+            judgment_store.upsert(judgments)
+        finally:
+            close_judgment_store(judgment_store)
+        save_answer_dictionary(args)
+
+
+def add_judgment_store_argument(parser):
+    parser.add_argument("--judgment-store", metavar="JUDGMENT-STORE",
+                        help="SQLite judgment store accumulated by 'judge interpret', requires --answer-dictionary")
+
+
+def open_judgment_store(parser, args):
+    if args.judgment_store is None:
+        return None
+    if args.answer_dictionary is None:
+        parser.print_usage()
+        parser.error("A judgment store requires an answer dictionary.")
+    return JudgmentStore(args.judgment_store, args.answer_dictionary)
+
+
+def close_judgment_store(judgment_store):
+    if judgment_store is not None:
+        judgment_store.close()
 
 
 def judge_sample_handler(args):
@@ -630,8 +810,9 @@ def judge_sample_handler(args):
 def augment_handler(args):
     usage_log = pandas.concat(args.usage_log)
     # noinspection PyTypeChecker
-    augmented = augment_usage_log(usage_log, args.judments)
+    augmented = augment_usage_log(usage_log, args.judgments, args.answer_dictionary)
     print_csv(augmented)
+    save_answer_dictionary(args)
 
 
 def analyze_command(parser, subparsers):
@@ -658,7 +839,12 @@ def analyze_command(parser, subparsers):
     judgements that don't appear in the system answers.
 
     Some versions of Annotation Assist strip newlines from the answers they return in the judgement files, so
-    optionally take this into account when joining on question/answer pairs."""),
+    optionally take this into account when joining on question/answer pairs.
+
+    Judgments are taken from judgment files, a judgment store, or both.
+
+    Use --append to add new systems to an existing collated file. Rows for the new systems are appended to the file and
+    the rows of the systems already in it are not recomputed or rewritten."""),
                                     help="combine Q&A pairs and judgments across systems")
     collate.add_argument("frequency", type=QuestionFrequencyFileType(),
                          help="question frequency file " +
@@ -666,9 +852,14 @@ def analyze_command(parser, subparsers):
     collate.add_argument("answers", type=AnswersFileType(), nargs="+",
                          help="answers generated by one of the 'answer' commands")
     collate.add_argument("--labels", nargs="+", help="names of the Q&A systems")
-    collate.add_argument("--judgments", required=True, nargs="+", type=JudgmentFileType(),
+    collate.add_argument("--judgments", nargs="+", type=JudgmentFileType(),
                          help="Q&A pair judgments generated by the 'judge interpret' command")
     collate.add_argument("--remove-newlines", action="store_true", help="join on answers with newlines removed")
+    collate.add_argument("--append", metavar="COLLATED",
+                         help="add the collated answers to this collated file instead of printing them, leaving the "
+                              "systems already in it untouched")
+    add_answer_dictionary_argument(collate)
+    add_judgment_store_argument(collate)
     collate.set_defaults(func=HandlerClosure(collate_handler, parser))
     # Plot collated results.
     plot_parser = subparsers.add_parser("plot",
@@ -683,6 +874,11 @@ def analyze_command(parser, subparsers):
                              help="combined system answers and judgments created by 'analyze collate'")
     plot_parser.add_argument("--output", default=".", help="output directory")
     plot_parser.add_argument("--draw", action="store_true", help="draw plots")
+    plot_parser.add_argument("--bootstrap", metavar="N", type=int,
+                             help="add 95%% confidence bands estimated from N bootstrap replicates")
+    plot_parser.add_argument("--processes", type=int,
+                             help="number of worker processes used for bootstrapping, by default the number of CPUs")
+    plot_parser.add_argument("--seed", type=int, help="random seed used for bootstrapping")
     plot_parser.set_defaults(func=plot_handler)
     # Print in-purview correct answers.
     correct_parser = subparsers.add_parser("correct", parents=[filter_arguments],
@@ -704,8 +900,11 @@ def analyze_command(parser, subparsers):
                                               description=textwrap.dedent("""
     For each system pair, return the number of questions they answered the same."""),
                                               help="measure similarity of different systems' answers")
-    similarity_parser.add_argument("collated", type=CollatedFileType(),
+    similarity_parser.add_argument("collated", type=EvaluationMatrixFileType(),
                                    help="combined system answers and judgments created by 'analyze collate'")
+    similarity_parser.add_argument("--matrix", metavar="FILENAME",
+                                   help="also write the percentage of same answers for every pair of systems to this "
+                                        "file as a square matrix")
     similarity_parser.set_defaults(func=similarity_handler)
     # Comparison of system pairs.
     comparison_parser = subparsers.add_parser("compare",
@@ -719,9 +918,45 @@ def analyze_command(parser, subparsers):
                                    help="relative performance of first to second system")
     comparison_parser.add_argument("system_1", metavar="system-1", help="first system")
     comparison_parser.add_argument("system_2", metavar="system-2", help="second system")
-    comparison_parser.add_argument("collated", type=CollatedFileType(),
+    comparison_parser.add_argument("collated", type=EvaluationMatrixFileType(),
                                    help="combined system answers and judgments created by 'analyze collate'")
     comparison_parser.set_defaults(func=comparison_handler)
+    # Comparison of all system pairs.
+    compare_all_parser = subparsers.add_parser("compare-all",
+                                               formatter_class=Raw,
+                                               description=textwrap.dedent("""
+    For every pair of systems, how often did the first system do better, worse, or the same as the second?
+
+    Counts are weighted by question frequency and only include in-purview questions answered by both systems."""),
+                                               help="compare the performance of all pairs of systems")
+    compare_all_parser.add_argument("collated", type=EvaluationMatrixFileType(),
+                                    help="combined system answers and judgments created by 'analyze collate'")
+    compare_all_parser.add_argument("--questions", metavar="DIRECTORY",
+                                    help="write the questions on which each system did better than each other system "
+                                         "to files in this directory")
+    compare_all_parser.set_defaults(func=compare_all_handler)
+    # Significance of differences between all system pairs.
+    significance_parser = subparsers.add_parser("significance",
+                                                formatter_class=Raw,
+                                                description=textwrap.dedent("""
+    For every pair of systems, is the difference in their accuracy significant?
+
+    Accuracy is the frequency of correctly answered questions divided by the frequency of in-purview questions, over
+    the in-purview questions answered by both systems. This runs a paired permutation test, which randomly swaps the
+    two systems' judgments of each question, and a paired bootstrap test, which resamples the questions and gives a 95%
+    confidence interval for the difference."""),
+                                                help="test the significance of differences in accuracy between all "
+                                                     "pairs of systems")
+    significance_parser.add_argument("collated", type=EvaluationMatrixFileType(),
+                                     help="combined system answers and judgments created by 'analyze collate'")
+    significance_parser.add_argument("--permutations", type=int, default=10000,
+                                     help="number of permutations, default 10000")
+    significance_parser.add_argument("--bootstrap", type=int, default=1000,
+                                     help="number of bootstrap replicates, default 1000")
+    significance_parser.add_argument("--processes", type=int,
+                                     help="number of worker processes, by default the number of CPUs")
+    significance_parser.add_argument("--seed", type=int, help="random seed")
+    significance_parser.set_defaults(func=significance_handler)
     # Create multi-system oracle.
     oracle_parser = subparsers.add_parser("oracle",
                                           formatter_class=Raw,
@@ -734,19 +969,36 @@ def analyze_command(parser, subparsers):
     unanimous. The 'themis analyze purview' command finds when this is not the case.)"""),
                                           help="combine multiple systems into a single oracle system " +
                                                "that is correct when any one of them is correct")
-    oracle_parser.add_argument("collated", type=CollatedFileType(),
+    oracle_parser.add_argument("collated", type=EvaluationMatrixFileType(),
                                help="combined system answers and judgments created by 'analyze collate'")
     oracle_parser.add_argument("system_names", metavar="system", nargs="+", help="name of systems to combine")
     oracle_parser.set_defaults(func=oracle_handler)
+    # Sweep over oracles of sets of systems.
+    oracle_sweep_parser = subparsers.add_parser("oracle-sweep",
+                                                formatter_class=Raw,
+                                                description=textwrap.dedent("""
+    Compute the accuracy of the oracle combination of every set of systems up to a given size, ordered from most to
+    least accurate. Accuracy is the frequency of correctly answered questions divided by the frequency of in-purview
+    questions among the questions answered by all the systems in the set."""),
+                                                help="find the sets of systems with the most accurate oracles")
+    oracle_sweep_parser.add_argument("collated", type=EvaluationMatrixFileType(),
+                                     help="combined system answers and judgments created by 'analyze collate'")
+    oracle_sweep_parser.add_argument("--size", type=int, default=3,
+                                     help="largest number of systems to combine, default 3")
+    oracle_sweep_parser.add_argument("--systems", metavar="SYSTEM", nargs="+",
+                                     help="systems to combine, by default all of them")
+    oracle_sweep_parser.set_defaults(func=oracle_sweep_handler)
 
     # Create combined fallback system
     fallback_parser = subparsers.add_parser("fallback",
                                             formatter_class=Raw,
                                             help="Combine results from two systems into a single fallback system.")
-    fallback_parser.add_argument("collated", type=CollatedFileType(),
+    fallback_parser.add_argument("collated", type=EvaluationMatrixFileType(),
                                  help="combined system answers and judgments created by 'analyze collate'")
     fallback_parser.add_argument("default_system", help="the default system to query")
     fallback_parser.add_argument("secondary_system", help="the system to query if the default system confidence falls below the threshold")
+    fallback_parser.add_argument("--curve", metavar="FILENAME",
+                                 help="write the combined precision at each default system threshold to this file")
     fallback_parser.set_defaults(func=fallback_handler)
     # Corpus statistics.
     corpus_parser = subparsers.add_parser("corpus",
@@ -757,6 +1009,11 @@ def analyze_command(parser, subparsers):
     corpus_parser.add_argument("corpus", type=CorpusFileType(),
                                help="corpus file created by the 'download corpus' command")
     corpus_parser.add_argument("--histogram", help="token frequency per answer histogram")
+    corpus_parser.add_argument("--token-counts", metavar="FILENAME",
+                               help="cache of answer token counts, only answers not already in it are tokenized and "
+                                    "their counts are added to it")
+    corpus_parser.add_argument("--processes", type=int,
+                               help="number of worker processes used to count tokens, by default the number of CPUs")
     corpus_parser.set_defaults(func=analyze_corpus_handler)
     # Truth statistics.
     truth_parser = subparsers.add_parser("truth",
@@ -806,6 +1063,7 @@ def analyze_command(parser, subparsers):
                                        help="truth file created by the 'xmgr truth' command")
     truth_coverage_parser.add_argument("collated", nargs="+", type=CollatedFileType(),
                                        help="combined system answers and judgments created by 'analyze collate'")
+    add_answer_dictionary_argument(truth_coverage_parser)
     truth_coverage_parser.set_defaults(func=truth_coverage_handler)
     # Fat-head vs. long-tail analysis.
     long_tail_parser = subparsers.add_parser("long-tail",
@@ -819,6 +1077,8 @@ def analyze_command(parser, subparsers):
                                   help="long-tail frequency cutoff, default 1")
     long_tail_parser.add_argument("collated", nargs="+", type=CollatedFileType(),
                                   help="combined system answers and judgments created by 'analyze collate'")
+    long_tail_parser.add_argument("--sweep", action="store_true",
+                                  help="print fat head and long tail statistics for every frequency cutoff instead")
     long_tail_parser.set_defaults(func=long_tail_handler)
 
     # Find disagreement in purview judgments.
@@ -834,8 +1094,10 @@ def analyze_command(parser, subparsers):
     These questions' purview should be rejudged to make them consistent."""),
                                                                         help="find non-unanimous in-purview judgments")
 
-    purview_inspect_parser.add_argument("collated", type=CollatedFileType(),
+    purview_inspect_parser.add_argument("collated", type=EvaluationMatrixFileType(),
                                         help="combined system answers and judgments created by 'analyze collate'")
+    purview_inspect_parser.add_argument("--rates", metavar="FILENAME",
+                                        help="write the in-purview disagreement rate of each pair of systems to this file")
     purview_inspect_parser.set_defaults(func=purview_disagreement_handler)
 
     purview_evaluate_parser = purview_disagreement_subparsers.add_parser("evaluate",
@@ -844,14 +1106,21 @@ def analyze_command(parser, subparsers):
     Return collated data where in-purview judgments are not unanimous for a question.
 
     Will interactively query user via the command line to resolve purview judgements for questions that were not unanimous,
-    and when question goes from "out of purview" to "in purview" will also present answer for correctness judgment."""),
+    and when question goes from "out of purview" to "in purview" will also present answer for correctness judgment.
+
+    Judgments are written to a journal as they are made. Run the command again with the same journal to resume an
+    interrupted assessment. The output file is written once all the questions have been judged."""),
                                                                          help="evaluate non-unanimous in-purview judgments")
 
     purview_evaluate_parser.add_argument("collated", type=CollatedFileType(),
                                          help="combined system answers and judgments created by 'analyze collate'")
 
     purview_evaluate_parser.add_argument("-o", "--output", dest="output", default='collate.eval.csv',
-                                         help="output file for this command, will also store intermediate results")
+                                         help="output file for this command")
+    purview_evaluate_parser.add_argument("--journal", metavar="FILENAME",
+                                         help="journal of judgments made so far, replayed to resume an interrupted "
+                                              "assessment, by default the output file name with a .journal.csv "
+                                              "extension")
 
     purview_evaluate_parser.set_defaults(func=purview_disagreement_evaluate_handler)
 
@@ -859,7 +1128,7 @@ def analyze_command(parser, subparsers):
                                                  description=textwrap.dedent("""
     TODO"""),
                                                  help="answered questions statistics")
-    voting_router_parser.add_argument("collated", type=CollatedFileType(),
+    voting_router_parser.add_argument("collated", type=EvaluationMatrixFileType(),
                                       help="combined system answers and judgments created by 'analyze collate'")
     voting_router_parser.add_argument("system_names", metavar="system", nargs="+", help="name of systems to combine")
     voting_router_parser.set_defaults(func=voting_router_handler)
@@ -871,6 +1140,7 @@ def analyze_command(parser, subparsers):
     nlc_common_arguments.add_argument("url", help="NLC url")
     nlc_common_arguments.add_argument("username", help="NLC username")
     nlc_common_arguments.add_argument("password", help="NLC password")
+    watch_arguments = classifier_watch_arguments()
     nlc_router = subparsers.add_parser("nlc-as-router", formatter_class=Raw, description=textwrap.dedent("""
         Takes two files collated.csv and result file generated by oracle experiment.
         Generates k-fold cross validated datasets and train each of them by NLC
@@ -884,33 +1154,94 @@ def analyze_command(parser, subparsers):
     nlc_router_train.add_argument("oracle_out", type=CsvFileType(), help="file created by oracle experiment")
     nlc_router_train.add_argument("path", help="directory path to save intermediate results")
     nlc_router_train.add_argument("--all_correct", action ='store_true', default=False, help= "train with only correct QA pairs.")
+    nlc_router_train.add_argument("--folds", type=int, default=NLC_ROUTER_FOLDS,
+                                  help="number of folds, default %d" % NLC_ROUTER_FOLDS)
+    nlc_router_train.add_argument("--seed", type=int, help="random seed used to split the folds")
+    nlc_router_train.add_argument("--stratify", metavar="COLUMN",
+                                  help="spread the values of this column, e.g. 'Answering System', evenly across the folds")
     nlc_router_train.set_defaults(func=nlc_router_train_handler)
 
     # training status
-    nlc_router_status = nlc_router_subparsers.add_parser("status", parents=[nlc_common_arguments], help="status of classifier ids")
+    nlc_router_status = nlc_router_subparsers.add_parser("status", parents=[nlc_common_arguments, watch_arguments],
+                                                         help="status of classifier ids")
     nlc_router_status.add_argument("path", help="local directory path")
+    nlc_router_status.add_argument("--watch", action="store_true",
+                                   help="poll the classifiers until they have all finished training or failed")
     nlc_router_status.set_defaults(func=nlc_router_status_handler)
 
    #test
 
-    nlc_router_test = nlc_router_subparsers.add_parser("test", parents=[nlc_common_arguments], help="test NLC model")
+    nlc_router_test = nlc_router_subparsers.add_parser("test", parents=[nlc_common_arguments, watch_arguments],
+                                                       help="test NLC model")
     nlc_router_test.add_argument("collate_file", type=CsvFileType(), help="collated file created for oracle input")
     nlc_router_test.add_argument("path", help="directory path to save intermediate results")
+    nlc_router_test.add_argument("--processes", type=int, help="number of folds to test at once, by default all of them")
+    nlc_router_test.add_argument("--wait", action="store_true",
+                                 help="wait for the classifiers to finish training before testing them")
     nlc_router_test.set_defaults(func=nlc_router_test_handler)
 
+    # train, wait for training to finish, and test
+    nlc_router_run = nlc_router_subparsers.add_parser("run", parents=[nlc_common_arguments, watch_arguments],
+                                                      help="train NLC models, wait for them to be available, "
+                                                           "and test them")
+    nlc_router_run.add_argument("oracle_out", type=CsvFileType(), help="file created by oracle experiment")
+    nlc_router_run.add_argument("collate_file", type=CsvFileType(), help="collated file created for oracle input")
+    nlc_router_run.add_argument("path", help="directory path to save intermediate results")
+    nlc_router_run.add_argument("--all_correct", action='store_true', default=False,
+                                help="train with only correct QA pairs.")
+    nlc_router_run.add_argument("--folds", type=int, default=NLC_ROUTER_FOLDS,
+                                help="number of folds, default %d" % NLC_ROUTER_FOLDS)
+    nlc_router_run.add_argument("--seed", type=int, help="random seed used to split the folds")
+    nlc_router_run.add_argument("--stratify", metavar="COLUMN",
+                                help="spread the values of this column, e.g. 'Answering System', evenly across the folds")
+    nlc_router_run.set_defaults(func=nlc_router_run_handler)
+
+    # cross-validate a local router instead of NLC
+    nlc_router_local = nlc_router_subparsers.add_parser("local", formatter_class=Raw, description=textwrap.dedent("""
+        Cross-validate a local router in place of NLC. The router is a logistic regression over the question text and
+        each system's confidence that is trained and tested on all the folds in parallel worker processes. The output
+        has the same format as the 'test' command."""),
+                                                        help="cross-validate a local router")
+    nlc_router_local.add_argument("oracle_out", type=CsvFileType(), help="file created by oracle experiment")
+    nlc_router_local.add_argument("collate_file", type=CsvFileType(), help="collated file created for oracle input")
+    nlc_router_local.add_argument("--all_correct", action='store_true', default=False,
+                                  help="train with only correct QA pairs.")
+    nlc_router_local.add_argument("--folds", type=int, default=NLC_ROUTER_FOLDS,
+                                  help="number of folds, default %d" % NLC_ROUTER_FOLDS)
+    nlc_router_local.add_argument("--seed", type=int, help="random seed used to split the folds")
+    nlc_router_local.add_argument("--stratify", metavar="COLUMN",
+                                  help="spread the values of this column, e.g. 'Answering System', evenly across the folds")
+    nlc_router_local.add_argument("--processes", type=int,
+                                  help="number of worker processes, by default the number of CPUs")
+    nlc_router_local.add_argument("--features", type=int, default=FEATURES,
+                                  help="number of hashed question text features, default %d" % FEATURES)
+    nlc_router_local.add_argument("--name", default="NLC-as-router", help="name of the router system")
+    nlc_router_local.set_defaults(func=nlc_router_local_handler)
+
 
 
 def collate_handler(parser, args):
     labeled_qa_pairs = answer_labels(parser, args)
-    judgments = pandas.concat(args.judgments)
-    all_systems = []
-    for label, qa_pairs in labeled_qa_pairs:
-        # Only consider the questions listed in the frequency file.
-        qa_pairs = qa_pairs[qa_pairs[QUESTION].isin(args.frequency[QUESTION])]
-        collated = add_judgments_and_frequencies_to_qa_pairs(qa_pairs, judgments, args.frequency, args.remove_newlines)
-        collated[SYSTEM] = label
-        all_systems.append(collated)
-    collated = pandas.concat(all_systems)
+    judgment_store = open_judgment_store(parser, args)
+    try:
+        if args.judgments is None and judgment_store is None:
+            parser.print_usage()
+            parser.error("Specify judgments with --judgments or --judgment-store.")
+        existing = None
+        if args.append is not None:
+            existing = CollatedFileType()(args.append)
+            if existing is not None:
+                collated_systems = set(args.labels) & set(existing[SYSTEM])
+                if collated_systems:
+                    parser.print_usage()
+                    parser.error("%s already collated in %s." % (", ".join(sorted(collated_systems)), args.append))
+        judgments = None
+        if args.judgments is not None:
+            judgments = pandas.concat(args.judgments)
+        collated = collate_systems(labeled_qa_pairs, judgments, args.frequency, args.remove_newlines,
+                                   args.answer_dictionary, judgment_store)
+    finally:
+        close_judgment_store(judgment_store)
     logger.info("%d question/answer pairs" % len(collated))
     n = len(collated)
     for column, s in [(ANSWER, "answers"), (IN_PURVIEW, "in purview judgments"), (CORRECT, "correctness judgments")]:
@@ -918,8 +1249,22 @@ def collate_handler(parser, args):
         if m:
             logger.warning("%d question/answer pairs out of %d missing %s (%0.3f%%)" % (m, n, s, 100.0 * m / n))
     # This will print a warning if any in-purview judgments are not unanimous for a given question.
-    in_purview_disagreement(collated)
-    print_csv(CollatedFileType.output_format(collated))
+    if existing is None:
+        in_purview_disagreement(collated)
+    else:
+        in_purview_disagreement(concat_collated([existing, collated]))
+    if args.append is None:
+        print_csv(CollatedFileType.output_format(collated))
+    elif existing is None:
+        to_csv(args.append, CollatedFileType.output_format(collated))
+        logger.info("Wrote %d question/answer pairs to %s" % (n, args.append))
+    else:
+        # Write the new rows in the column order of the existing file.
+        header = from_csv(args.append, nrows=0).columns
+        to_csv(args.append, CollatedFileType.output_format(collated).reset_index()[header], mode="a", header=False,
+               index=False)
+        logger.info("Appended %d question/answer pairs to %s" % (n, args.append))
+    save_answer_dictionary(args)
 
 
 def answer_labels(parser, args):
@@ -942,7 +1287,7 @@ def incorrect_handler(args):
 
 
 def plot_handler(args):
-    curves = generate_curves(args.type, args.collated)
+    curves = generate_curves(args.type, args.collated, args.bootstrap, args.processes, args.seed)
     # Write curves data.
     ensure_directory_exists(args.output)
     for label, curve in curves.items():
@@ -954,7 +1299,11 @@ def plot_handler(args):
 
 
 def similarity_handler(args):
-    similarity = system_similarity(args.collated)
+    if args.matrix is not None:
+        similarity, matrix = system_similarity(args.collated, matrix=True)
+        to_csv(args.matrix, matrix)
+    else:
+        similarity = system_similarity(args.collated)
     print_csv(similarity)
 
 
@@ -963,14 +1312,47 @@ def comparison_handler(args):
     print_csv(comparison)
 
 
+def significance_handler(args):
+    print_csv(system_significance(args.collated, args.permutations, args.bootstrap, args.processes, args.seed))
+
+
+def compare_all_handler(args):
+    comparison = compare_all_systems(args.collated)
+    if args.questions is not None:
+        ensure_directory_exists(args.questions)
+        for x, y, questions in compare_all_systems_questions(args.collated):
+            filename = "%s.better.%s.csv" % (safe_filename(x), safe_filename(y))
+            to_csv(os.path.join(args.questions, filename), questions)
+    print_csv(comparison)
+
+
+def safe_filename(name):
+    """
+    System names default to the names of their answer files, so replace path separators and any other characters that
+    are not safe in a filename.
+
+    :param name: system name
+    :type name: str
+    :return: name usable as part of a filename
+    :rtype: str
+    """
+    return re.sub(r"[^\w.-]+", "_", name, flags=re.UNICODE).strip("._") or "_"
+
+
 def oracle_handler(args):
     oracle_name = "%s Oracle" % "+".join(args.system_names)
     oracle = oracle_combination(args.collated, args.system_names, oracle_name)
     print_csv(OracleFileType.output_format(oracle))
 
 
+def oracle_sweep_handler(args):
+    print_csv(oracle_sweep(args.collated, args.size, args.systems))
+
+
 def fallback_handler(args):
-    fallback = fallback_combination(args.collated, args.default_system, args.secondary_system)
+    fallback, curve = fallback_combination(args.collated, args.default_system, args.secondary_system)
+    if args.curve is not None:
+        to_csv(args.curve, curve, index=False)
     print_csv(OracleFileType.output_format(fallback))
 
 
@@ -981,7 +1363,12 @@ def voting_router_handler(args):
 
 
 def analyze_corpus_handler(args):
-    answers, tokens, histogram = corpus_statistics(args.corpus)
+    token_counts = None
+    if args.token_counts is not None:
+        token_counts = TokenCountsFileType()(args.token_counts)
+    answers, tokens, histogram, token_counts = corpus_statistics(args.corpus, token_counts, args.processes)
+    if args.token_counts is not None:
+        to_csv(args.token_counts, TokenCountsFileType.output_format(token_counts))
     print("%d answers, %d tokens, average %0.3f tokens per answer" % (answers, tokens, tokens / float(answers)))
     if args.histogram:
         r = pandas.DataFrame(list(histogram.items()), columns=("Tokens", "Count")).set_index("Tokens").sort_index()
@@ -1021,11 +1408,15 @@ def analyze_answers_handler(args):
 
 
 def truth_coverage_handler(args):
-    coverage = truth_coverage(args.corpus, args.truth, args.collated)
+    coverage = truth_coverage(args.corpus, args.truth, args.collated, args.answer_dictionary)
     print_csv(coverage)
+    save_answer_dictionary(args)
 
 
 def long_tail_handler(args):
+    if args.sweep:
+        print_csv(long_tail_sweep(args.collated))
+        return
     fat_head, long_tail = long_tail_fat_head(args.frequency_cutoff, args.collated)
     print("Fat Head (frequency > %d)" % args.frequency_cutoff)
     print_csv(fat_head)
@@ -1036,31 +1427,19 @@ def long_tail_handler(args):
 
 def purview_disagreement_handler(args):
     purview_disagreement = in_purview_disagreement(args.collated)
+    if args.rates is not None:
+        to_csv(args.rates, in_purview_disagreement_rates(args.collated))
     print_csv(CollatedFileType.output_format(purview_disagreement))
 
 
 def purview_disagreement_evaluate_handler(args):
-    collated = args.collated
-    output_file = args.output
-    collate_file_type = CollatedFileType()
-    output_system_data = collate_file_type(output_file)
-    if output_system_data is not None:
-        if output_system_data[[QUESTION, SYSTEM, ANSWER, CONFIDENCE, FREQUENCY]].equals(collated[[QUESTION, SYSTEM, ANSWER, CONFIDENCE, FREQUENCY]]):
-            logger.info('Output file ({0}) is intermediate. Continuing purview assessment.'.format(output_file))
-            evaluate_input = output_system_data
-        else:
-            logger.info('Output file ({0}) is not a match to collated input. Starting purview assessment.'.format(output_file))
-            evaluate_input = collated
-    else:
-        print 'else here'
-
-        logger.info('Output file ({0}) does not currently exist. Starting purview assessment.'.format(output_file))
-        evaluate_input = collated
-
-    evaluated = in_purview_disagreement_evaluate(evaluate_input, output_file)
+    journal = args.journal
+    if journal is None:
+        journal = os.path.splitext(args.output)[0] + ".journal.csv"
+    evaluated = in_purview_disagreement_evaluate(args.collated, journal)
     logger.info("All question purviews are in agreement")
-    to_csv(output_file, evaluated, index=False)
-    logger.info("Output written to {0}".format(output_file))
+    to_csv(args.output, evaluated, index=False)
+    logger.info("Output written to {0}".format(args.output))
 
 
 def util_command(subparsers):
@@ -1075,11 +1454,16 @@ def util_command(subparsers):
     truncate = subparsers.add_parser("truncate-answers", help="Truncates the answer text field of an Annotation Assist file to the specified length.")
     truncate.add_argument("file", type=CsvFileType(), help="Annotation Assist file")
     truncate.add_argument("length", type=int, help="The length to shorten the TopAnswerText field to")
+    truncate.add_argument("--processes", type=int, help="number of worker processes, by default the number of CPUs")
     truncate.set_defaults(func=truncate_answers_handler)
-    kfold_split = subparsers.add_parser("kfold-split", help="split a CSV file into K (= 5) Test and Train folds.")
+    kfold_split = subparsers.add_parser("kfold-split", help="split a CSV file into K (default 5) Test and Train folds.")
     kfold_split.add_argument("file", type=CsvFileType(), help="CSV file")
     kfold_split.add_argument("--training-headers", action='store_true', default=False, dest="training_headers",
                              help="flag: should training file headers be used? (default = False)")
+    kfold_split.add_argument("--folds", type=int, default=5, help="number of folds, default 5")
+    kfold_split.add_argument("--seed", type=int, help="random seed")
+    kfold_split.add_argument("--stratify", metavar="COLUMN",
+                             help="spread the values of this column, e.g. 'Answering System', evenly across the folds")
     kfold_split.add_argument("output_directory", metavar="OUTPUT_DIRECTORY", type=str, default=".",
                              help="output directory")
     kfold_split.set_defaults(func=kfold_split_handler)
@@ -1099,25 +1483,9 @@ def drop_null_handler(args):
     print_csv(non_null, index=False)
 
 
-def _truncate_html(string, allowed_length, cut_length=None):
-    if cut_length is None:
-        cut_length = allowed_length
-    if len(string) <= allowed_length:
-        return string
-    else:
-        new_string = str(BeautifulSoup(string[0:cut_length]))
-
-        if len(new_string) <= allowed_length:
-            return new_string
-
-        return _truncate_html(string, allowed_length, cut_length - 1)
-
-
 def truncate_answers_handler(args):
     aa_file = args.file
-
-    aa_file.TopAnswerText = aa_file.TopAnswerText.apply(lambda x: _truncate_html(str(x), args.length))
-
+    aa_file.TopAnswerText = truncate_answers(aa_file.TopAnswerText, args.length, args.processes)
     print_csv(aa_file, index=False)
 
 
@@ -1131,7 +1499,7 @@ def version_handler(_):
 
 
 def kfold_split_handler(args):
-    kfold_split(args.file, args.output_directory, 5, args.training_headers)
+    kfold_split(args.file, args.output_directory, args.folds, args.training_headers, args.seed, args.stratify)
 
 
 class HandlerClosure(object):
@@ -1,4 +1,5 @@
 import numpy
+import pandas
 
 from themis import CONFIDENCE, CORRECT, FREQUENCY, IN_PURVIEW, logger
 
@@ -32,36 +33,122 @@ def confidence_thresholds(judgments, add_max):
     return ts
 
 
+def attempted_frequencies(judgments, ts):
+    """
+    Total frequencies of the correct, in-purview, and out-of-purview questions attempted at each of a set of confidence
+    thresholds.
+
+    The judgments are sorted by confidence once and the frequencies accumulated, so that the totals at every threshold
+    are looked up with a binary search instead of filtering the judgments again for each threshold.
+
+    :param judgments: confidence, in purview, correct, and frequency information
+    :type judgments: pandas.DataFrame
+    :param ts: confidence thresholds
+    :type ts: numpy.array
+    :return: correct, in-purview, and out-of-purview frequencies with confidence greater than or equal to each threshold
+    :rtype: (numpy.array, numpy.array, numpy.array)
+    """
+    order = numpy.argsort(judgments[CONFIDENCE].values, kind="mergesort")
+    confidences = judgments[CONFIDENCE].values[order]
+    # Judgments without a confidence are never attempted.
+    frequencies = numpy.where(numpy.isnan(confidences), 0, judgments[FREQUENCY].values[order].astype(numpy.int64))
+    # Index of the first judgment attempted at each threshold in ascending confidence order
+    attempted = numpy.searchsorted(confidences, ts, side="left")
+    totals = []
+    for column, value in [(CORRECT, True), (IN_PURVIEW, True), (IN_PURVIEW, False)]:
+        weighted = numpy.where(judgments[column].values[order] == value, frequencies, 0)
+        # Sums of the weighted frequencies from each position to the end
+        suffix_sums = numpy.append(numpy.cumsum(weighted[::-1])[::-1], 0)
+        totals.append(suffix_sums[attempted])
+    return tuple(totals)
+
+
+def precision_and_attempted(judgments, ts):
+    """
+    Precision and the fraction of in-purview questions attempted at each of a set of confidence thresholds.
+
+    This is equivalent to calling precision and questions_attempted for each threshold, but runs in time proportional
+    to N log N for N judgments.
+
+    :param judgments: confidence, in purview, correct, and frequency information
+    :type judgments: pandas.DataFrame
+    :param ts: confidence thresholds
+    :type ts: numpy.array
+    :return: precision and questions attempted at each threshold, NaN where they are undefined
+    :rtype: (numpy.array, numpy.array)
+    """
+    correct, in_purview, _ = attempted_frequencies(judgments, ts)
+    total_in_purview = judgments[FREQUENCY].values[(judgments[IN_PURVIEW] == True).values].astype(numpy.int64).sum()
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        ps = numpy.where(in_purview > 0, correct / in_purview.astype(numpy.float64), numpy.nan)
+        qas = numpy.where(total_in_purview > 0, in_purview / numpy.float64(total_in_purview), numpy.nan)
+    undefined = numpy.count_nonzero(in_purview == 0)
+    if undefined:
+        logger.warning("No in-purview questions at %d threshold levels" % undefined)
+    return ps, qas
+
+
 def precision_grounded_confidence(ts, ps, qas, confidence, method='precision_only'):
-    # lookup the associated precision & QA for the confidence using the closest threshold value (in case of mismatches)
-    t_index = (numpy.abs(ts - confidence)).argmin()
-    precision_t = ps[t_index]
-    qa_t = qas[t_index]
+    """
+    Look up the precision and questions attempted at the threshold closest to a confidence and combine them into a
+    precision grounded confidence.
+
+    The confidence may be a single value or an array of them. The thresholds are searched with a binary search, and
+    when a confidence falls halfway between two thresholds the higher one is used.
+
+    :param ts: confidence thresholds in descending order
+    :type ts: numpy.array
+    :param ps: precision at each threshold
+    :type ps: numpy.array
+    :param qas: questions attempted at each threshold
+    :type qas: numpy.array
+    :param confidence: confidence values
+    :type confidence: float or numpy.array
+    :param method: 'precision_only', 'inverse_qa', or 'inverse_qa_p_corrected'
+    :type method: str
+    :return: precision grounded confidence
+    :rtype: float or numpy.array
+    """
+    if method not in ['inverse_qa_p_corrected', 'inverse_qa', 'precision_only']:
+        raise ValueError("Invalid method choice for precision_grounded_confidence.")
+    ascending = numpy.asarray(ts, dtype=numpy.float64)[::-1]
+    confidence = numpy.asarray(confidence, dtype=numpy.float64)
+    # Lookup the associated precision & QA for the confidence using the closest threshold value (in case of mismatches).
+    above = numpy.clip(numpy.searchsorted(ascending, confidence), 0, len(ascending) - 1)
+    below = numpy.clip(above - 1, 0, len(ascending) - 1)
+    closest = numpy.where(numpy.abs(ascending[above] - confidence) <= numpy.abs(confidence - ascending[below]),
+                          above, below)
+    t_index = len(ascending) - 1 - closest
+    precision_t = numpy.asarray(ps, dtype=numpy.float64)[t_index]
+    qa_t = numpy.asarray(qas, dtype=numpy.float64)[t_index]
     if method == 'inverse_qa_p_corrected':
         return (1 - qa_t) * precision_t
     elif method == 'inverse_qa':
         return (1 - qa_t)
-    elif method == 'precision_only':
-        return precision_t
     else:
-        raise ValueError("Invalid method choice for precision_grounded_confidence.")
+        return precision_t
 
 
-def __standardize_confidence(system, method='rank'):
+def __standardize_confidence(system, method='rank', grounding='precision_only'):
     """
     Takes a dataframe of a SINGLE SYSTEM with associated CONFIDENCE scores and standardizes the confidence
     values using the percentile in the list as the new confidence.
 
+    With the 'precision' method the confidence is replaced by a precision grounded confidence instead. The precision
+    and questions attempted at every threshold are computed in a single pass and every confidence is mapped to its
+    threshold with one binary search.
+
     :param system: dataframe containing rows of a single system that has a CONFIDENCE column present.
+    :param method: 'rank' or 'precision'
+    :param grounding: precision_grounded_confidence method used by the 'precision' method
     :return: a Series containing the standardized confidence.
     :rtype pandas.Series
     """
     if method == 'precision':
         ts = confidence_thresholds(system, False)
-        ps = [precision(system, t) for t in ts]
-        qas = [questions_attempted(system, t) for t in ts]
-        return system.apply(lambda x: precision_grounded_confidence(ts, ps, qas, x[CONFIDENCE],
-                                                                   method='precision_only'), axis=1)
+        ps, qas = precision_and_attempted(system, ts)
+        return pandas.Series(precision_grounded_confidence(ts, ps, qas, system[CONFIDENCE].values, method=grounding),
+                             index=system.index)
     elif method == 'rank':
         return system[CONFIDENCE].rank(pct=True)
     else:
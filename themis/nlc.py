@@ -1,9 +1,15 @@
 import tempfile
+import time
+from multiprocessing.pool import ThreadPool
 
 from watson_developer_cloud import NaturalLanguageClassifierV1 as NaturalLanguageClassifier
 
 from themis import QUESTION, ANSWER_ID, ANSWER
 from themis import logger, to_csv, pretty_print_json
+from themis.checkpoint import retry
+
+# Number of times to request a classifier's status before giving up after an error
+STATUS_RETRIES = 5
 
 
 def classifier_list(url, username, password):
@@ -11,11 +17,128 @@ def classifier_list(url, username, password):
     return connection.list()["classifiers"]
 
 
-def classifier_status(url, username, password, classifier_ids):
+def classifier_status(url, username, password, classifier_ids, watch=False, interval=10, max_interval=300,
+                      retries=None):
+    """
+    Print the statuses of classifiers.
+
+    :param url: NLC url
+    :type url: str
+    :param username: NLC username
+    :type username: str
+    :param password: NLC password
+    :type password: str
+    :param classifier_ids: classifiers
+    :type classifier_ids: list of str
+    :param watch: wait until all the classifiers have finished training or failed and print their final statuses
+    :type watch: bool
+    :param interval: initial seconds between status requests when watching
+    :type interval: float
+    :param max_interval: maximum seconds between status requests when watching
+    :type max_interval: float
+    :param retries: number of times to request a status before giving up after an error, by default just once, or
+        STATUS_RETRIES when watching
+    :type retries: int
+    """
+    if watch:
+        statuses = wait_for_classifiers(url, username, password, classifier_ids, interval, max_interval,
+                                        retries=retries or STATUS_RETRIES, fail=False)
+    else:
+        statuses = classifier_statuses(url, username, password, classifier_ids, retries)
+    for status in statuses:
+        print(_status_message(status))
+
+
+def classifier_statuses(url, username, password, classifier_ids, retries=None):
+    """
+    Request the statuses of classifiers concurrently.
+
+    A request that fails is retried as described in themis.checkpoint.retry.
+
+    :param url: NLC url
+    :type url: str
+    :param username: NLC username
+    :type username: str
+    :param password: NLC password
+    :type password: str
+    :param classifier_ids: classifiers
+    :type classifier_ids: list of str
+    :param retries: number of times to request each status before giving up after an error, by default just once
+    :type retries: int
+    :return: status of each classifier
+    :rtype: list of dict
+    """
     n = NaturalLanguageClassifier(url=url, username=username, password=password)
-    for classifier_id in classifier_ids:
-        status = n.status(classifier_id)
-        print(" Instance name: %s with classifier id %s is %s; Description: %s" % (status["name"],status["classifier_id"],status["status"], status["status_description"]))
+
+    def request_status(classifier_id):
+        status = retry(lambda: n.status(classifier_id), retries)
+        if status is None:
+            raise ValueError("Cannot get the status of classifier %s" % classifier_id)
+        return status
+
+    pool = ThreadPool(len(classifier_ids) or 1)
+    try:
+        return pool.map(request_status, classifier_ids)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def wait_for_classifiers(url, username, password, classifier_ids, interval=10, max_interval=300, backoff=2,
+                         retries=STATUS_RETRIES, fail=True):
+    """
+    Wait until all the classifiers have either finished training or failed.
+
+    The statuses of all the classifiers that are still training are requested concurrently. The time between requests
+    starts at interval seconds and is multiplied by backoff after each request, up to max_interval seconds. Changes in
+    status are logged as they are seen. Requests that fail are retried so that a transient error does not end a long
+    wait.
+
+    :param url: NLC url
+    :type url: str
+    :param username: NLC username
+    :type username: str
+    :param password: NLC password
+    :type password: str
+    :param classifier_ids: classifiers to wait for
+    :type classifier_ids: list of str
+    :param interval: initial seconds between status requests
+    :type interval: float
+    :param max_interval: maximum seconds between status requests
+    :type max_interval: float
+    :param backoff: factor by which the time between status requests grows
+    :type backoff: float
+    :param retries: number of times to request a status before giving up after an error
+    :type retries: int
+    :param fail: raise an error if any of the classifiers failed, for callers that go on to use them
+    :type fail: bool
+    :return: final status of each classifier
+    :rtype: list of dict
+    """
+    statuses = {}
+    pending = list(classifier_ids)
+    while pending:
+        for classifier_id, status in zip(pending, classifier_statuses(url, username, password, pending, retries)):
+            if classifier_id not in statuses or statuses[classifier_id]["status"] != status["status"]:
+                logger.info(_status_message(status))
+            statuses[classifier_id] = status
+        pending = [classifier_id for classifier_id in pending
+                   if statuses[classifier_id]["status"] not in ["Available", "Failed"]]
+        if pending:
+            logger.info("%d of %d classifiers finished training, next status request in %0.0f seconds" %
+                        (len(classifier_ids) - len(pending), len(classifier_ids), interval))
+            time.sleep(interval)
+            interval = min(interval * backoff, max_interval)
+    failed = [classifier_id for classifier_id in classifier_ids if statuses[classifier_id]["status"] == "Failed"]
+    if failed and fail:
+        raise ValueError("Classifiers failed: %s" % ", ".join(failed))
+    logger.info("%d of %d classifiers available" % (len(classifier_ids) - len(failed), len(classifier_ids)))
+    return [statuses[classifier_id] for classifier_id in classifier_ids]
+
+
+def _status_message(status):
+    return " Instance name: %s with classifier id %s is %s; Description: %s" % \
+           (status["name"], status["classifier_id"], status["status"], status["status_description"])
 
 
 def remove_classifiers(url, username, password, classifier_ids):
@@ -40,25 +163,55 @@ class NLC(object):
     """
     Wrapper to a Natural Language Classifier via the
     `Watson developer cloud Python SDK <https://github.com/watson-developer-cloud/python-sdk>`.
+
+    Classification responses are cached by question, so asking for the top answer and querying the router classes of
+    the same question only calls the classifier once. Call prefetch to classify a batch of questions concurrently
+    before asking them one at a time, and close to stop the threads used to do so.
     """
 
-    def __init__(self, url, username, password, classifier_id, corpus):
+    def __init__(self, url, username, password, classifier_id, corpus, threads=10, cache=None):
         self.nlc = NaturalLanguageClassifier(url=url, username=username, password=password)
         self.classifier_id = classifier_id
         self.corpus = corpus
+        self.threads = threads
+        self.cache = {} if cache is None else cache
+        self.pool = None
 
     def __repr__(self):
         return "NLC: %s" % self.classifier_id
 
+    def classify(self, question):
+        if question not in self.cache:
+            self.cache[question] = self.nlc.classify(self.classifier_id, question)
+        return self.cache[question]
+
+    def prefetch(self, questions):
+        """
+        Classify the questions that are not already cached using this classifier's pool of threads.
+
+        :param questions: questions to classify
+        :type questions: iterable of str
+        """
+        questions = [question for question in set(questions) if question not in self.cache]
+        if questions:
+            if self.pool is None:
+                self.pool = ThreadPool(self.threads)
+            self.pool.map(self.classify, questions)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
     def ask(self, question):
-        classification = self.nlc.classify(self.classifier_id, question)
+        classification = self.classify(question)
         class_name = classification["classes"][0]["class_name"]
         confidence = classification["classes"][0]["confidence"]
         return self.corpus.loc[class_name][ANSWER], confidence
 
     def query(self, question):
-        classification = self.nlc.classify(self.classifier_id, question)
+        classification = self.classify(question)
         class_name = classification["classes"][1]["class_name"]
         #confidence = classification["classes"][1]["confidence"]
         return class_name#, confidence
-
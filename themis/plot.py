@@ -1,3 +1,6 @@
+import multiprocessing
+import warnings
+
 import matplotlib.pyplot as plt
 import numpy
 import pandas
@@ -5,25 +8,34 @@ from matplotlib.font_manager import FontProperties
 
 from themis import (CONFIDENCE, CORRECT, FREQUENCY, IN_PURVIEW, QUESTION,
                     CsvFileType, logger)
-from themis.analyze import SYSTEM, drop_missing
-from themis.metrics import (confidence_thresholds, precision,
-                            questions_attempted)
+from themis.analyze import PRECISION, SYSTEM, THRESHOLD, drop_missing
+from themis.metrics import (attempted_frequencies, confidence_thresholds,
+                            precision_and_attempted)
 
-THRESHOLD = "Threshold"
 TRUE_POSITIVE_RATE = "True Positive Rate"
 FALSE_POSITIVE_RATE = "False Positive Rate"
-PRECISION = "Precision"
 ATTEMPTED = "Attempted"
 
 
-def generate_curves(curve_type, collated):
+def generate_curves(curve_type, collated, bootstrap=None, processes=None, seed=None):
     """
     Generate curves of the same type for multiple systems.
 
+    Optionally estimate the variance of the curves by bootstrap resampling the questions. Each replicate draws as many
+    distinct questions as there are with replacement and weights each drawn question by its frequency, as the
+    bootstrap test in themis.analyze.system_significance does. The 2.5th and 97.5th percentiles of the curve values
+    across replicates at each threshold are added to the curves as Lower and Upper columns.
+
     :param collated: questions, answers, judgments, confidences, and frequencies across systems
     :type collated: list of pandas.DataFrame
     :param curve_type: 'precision' or 'roc'
     :type curve_type: str
+    :param bootstrap: number of bootstrap replicates
+    :type bootstrap: int
+    :param processes: number of worker processes used for bootstrapping, by default the number of CPUs
+    :type processes: int
+    :param seed: random seed used for bootstrapping
+    :type seed: int
     :return: mapping of system labels to curve data
     :rtype: {str : pandas.DataFrame}
     """
@@ -37,10 +49,20 @@ def generate_curves(curve_type, collated):
         curve = {"precision": precision_curve, "roc": roc_curve}[curve_type]
     except KeyError:
         raise ValueError("Invalid curve type %s" % curve_type)
-    curves = {}
-    for label, data in collated.groupby(SYSTEM):
-        curves[label] = {"precision": PrecisionCurveFileType,
-                         "roc": ROCCurveFileType}[curve_type].output_format(curve(data))
+    pool = multiprocessing.Pool(processes) if bootstrap else None
+    try:
+        curves = {}
+        for label, data in collated.groupby(SYSTEM):
+            system_curve = curve(data)
+            if bootstrap:
+                logger.info("Bootstrap %d %s curve replicates for %s" % (bootstrap, curve_type, label))
+                system_curve = bootstrap_bands(curve_type, data, system_curve, bootstrap, pool, seed=seed)
+            curves[label] = {"precision": PrecisionCurveFileType,
+                             "roc": ROCCurveFileType}[curve_type].output_format(system_curve)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     return curves
 
 
@@ -54,28 +76,15 @@ def roc_curve(judgments):
     :rtype: pandas.DataFrame
     """
     ts = confidence_thresholds(judgments, True)
-    true_positive_rates = [true_positive_rate(judgments, t) for t in ts]
-    false_positive_rates = [false_positive_rate(judgments, t) for t in ts]
+    true_positives, _, false_positives = attempted_frequencies(judgments, ts)
+    in_purview = judgments[FREQUENCY][judgments[IN_PURVIEW] == True].astype(numpy.int64).sum()
+    out_of_purview = judgments[FREQUENCY][judgments[IN_PURVIEW] == False].astype(numpy.int64).sum()
     curve = pandas.DataFrame.from_dict({THRESHOLD: ts,
-                                        TRUE_POSITIVE_RATE: true_positive_rates,
-                                        FALSE_POSITIVE_RATE: false_positive_rates})
+                                        TRUE_POSITIVE_RATE: true_positives / float(in_purview),
+                                        FALSE_POSITIVE_RATE: false_positives / float(out_of_purview)})
     return curve
 
 
-def true_positive_rate(judgments, t):
-    correct = judgments[judgments[CORRECT]]
-    true_positive = sum(correct[correct[CONFIDENCE] >= t][FREQUENCY])
-    in_purview = sum(judgments[judgments[IN_PURVIEW]][FREQUENCY])
-    return true_positive / float(in_purview)
-
-
-def false_positive_rate(judgments, t):
-    out_of_purview_questions = judgments[judgments[IN_PURVIEW] == False]
-    false_positive = sum(out_of_purview_questions[out_of_purview_questions[CONFIDENCE] >= t][FREQUENCY])
-    out_of_purview = sum(out_of_purview_questions[FREQUENCY])
-    return false_positive / float(out_of_purview)
-
-
 def precision_curve(judgments):
     """
     Generate points for a precision curve.
@@ -86,21 +95,103 @@ def precision_curve(judgments):
     :rtype: pandas.DataFrame
     """
     ts = confidence_thresholds(judgments, False)
-    precision_values = [(t, precision(judgments, t)) for t in ts]
-    attempted_values = [(t, questions_attempted(judgments, t)) for t in ts]
+    precision_values, attempted_values = precision_and_attempted(judgments, ts)
     # Plot those threshold values that have both x and y values.
-    xs = [(pv[0], pv[1], av[1]) for pv, av in zip(precision_values, attempted_values)
-          if pv[1] is not None and av[1] is not None]
-    ts, precision_values, attempted_values = zip(*xs)  # zip(*x) is the inverse of zip(x)
-    curve = pandas.DataFrame.from_dict({THRESHOLD: ts, PRECISION: precision_values, ATTEMPTED: attempted_values})
+    defined = ~(numpy.isnan(precision_values) | numpy.isnan(attempted_values))
+    curve = pandas.DataFrame.from_dict({THRESHOLD: ts[defined],
+                                        PRECISION: precision_values[defined],
+                                        ATTEMPTED: attempted_values[defined]})
+    return curve
+
+
+def bootstrap_bands(curve_type, judgments, curve, replicates, pool, chunk_size=50, seed=None):
+    """
+    Add 95% bootstrap percentile bands to a curve.
+
+    Each replicate draws the questions with replacement and weights each drawn question by its frequency. Replicates
+    are generated in chunks that are spread across a process pool.
+
+    :param curve_type: 'precision' or 'roc'
+    :type curve_type: str
+    :param judgments: confidence, in purview, correct, and frequency information
+    :type judgments: pandas.DataFrame
+    :param curve: curve generated from the judgments
+    :type curve: pandas.DataFrame
+    :param replicates: number of bootstrap replicates
+    :type replicates: int
+    :param pool: worker processes
+    :type pool: multiprocessing.Pool
+    :param chunk_size: number of replicates per chunk
+    :type chunk_size: int
+    :param seed: random seed
+    :type seed: int
+    :return: the curve with lower and upper band columns for its values
+    :rtype: pandas.DataFrame
+    """
+    order = numpy.argsort(judgments[CONFIDENCE].values, kind="mergesort")
+    confidences = judgments[CONFIDENCE].values[order]
+    frequency = judgments[FREQUENCY].values[order].astype(numpy.int64)
+    judgment_masks = numpy.vstack([judgments[CORRECT].values[order] == True,
+                                   judgments[IN_PURVIEW].values[order] == True,
+                                   judgments[IN_PURVIEW].values[order] == False])
+    # Index of the first judgment attempted at each threshold in ascending confidence order
+    attempted = numpy.searchsorted(confidences, curve[THRESHOLD].values, side="left")
+    seeds = numpy.random.RandomState(seed).randint(0, 2 ** 31 - 1, size=(replicates + chunk_size - 1) // chunk_size)
+    sizes = [min(chunk_size, replicates - i * chunk_size) for i in range(len(seeds))]
+    chunks = pool.map(_bootstrap_attempted_frequencies,
+                      [(frequency, judgment_masks, attempted, size, chunk_seed) for size, chunk_seed in zip(sizes, seeds)])
+    correct, in_purview, out_of_purview, total_in_purview, total_out_of_purview = \
+        [numpy.concatenate(parts) for parts in zip(*chunks)]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        if curve_type == "precision":
+            values = [(ATTEMPTED, in_purview / total_in_purview[:, numpy.newaxis].astype(float)),
+                      (PRECISION, correct / in_purview.astype(float))]
+        else:
+            values = [(FALSE_POSITIVE_RATE, out_of_purview / total_out_of_purview[:, numpy.newaxis].astype(float)),
+                      (TRUE_POSITIVE_RATE, correct / total_in_purview[:, numpy.newaxis].astype(float))]
+    curve = curve.copy()
+    for column, replicate_values in values:
+        with warnings.catch_warnings():
+            # Thresholds where a value is undefined in every replicate have NaN bands.
+            warnings.simplefilter("ignore", RuntimeWarning)
+            lower, upper = numpy.nanpercentile(replicate_values, [2.5, 97.5], axis=0)
+        curve[column + " Lower"] = lower
+        curve[column + " Upper"] = upper
     return curve
 
 
+def _bootstrap_attempted_frequencies(args):
+    """
+    Attempted frequencies at each threshold for a chunk of bootstrap replicates.
+
+    :return: correct, in-purview, and out-of-purview frequencies attempted at each threshold with a row for each
+        replicate, and total in-purview and out-of-purview frequencies of each replicate
+    :rtype: (numpy.array, numpy.array, numpy.array, numpy.array, numpy.array)
+    """
+    frequency, judgment_masks, attempted, size, seed = args
+    n = len(frequency)
+    # Number of times each question is drawn in each replicate, weighted by its frequency
+    draws = numpy.random.RandomState(seed).randint(0, n, size=(size, n)) + n * numpy.arange(size)[:, numpy.newaxis]
+    counts = numpy.bincount(draws.ravel(), minlength=size * n).reshape(size, n) * frequency
+    results = []
+    for mask in judgment_masks:
+        weighted = numpy.where(mask, counts, 0)
+        # Sums of the weighted counts from each position to the end
+        suffix_sums = numpy.hstack([numpy.cumsum(weighted[:, ::-1], axis=1)[:, ::-1],
+                                    numpy.zeros((size, 1), dtype=weighted.dtype)])
+        results.append(suffix_sums[:, attempted])
+    results.append(numpy.where(judgment_masks[1], counts, 0).sum(axis=1))
+    results.append(numpy.where(judgment_masks[2], counts, 0).sum(axis=1))
+    return tuple(results)
+
+
 def plot_curves(curves, curve_type):
     x_label = curves.values()[0].columns[0]
     y_label = curves.values()[0].columns[1]
     for label, curve in curves.items():
         plt.plot(curve[x_label], curve[y_label], label=label)
+        if y_label + " Lower" in curve.columns:
+            plt.fill_between(curve[x_label], curve[y_label + " Lower"], curve[y_label + " Upper"], alpha=0.2)
     fontP = FontProperties()
     fontP.set_size('smaller')
     plt.legend(loc={"precision": 3, "roc": 1}[curve_type], prop=fontP)
@@ -117,7 +208,7 @@ class PrecisionCurveFileType(CsvFileType):
 
     @classmethod
     def output_format(cls, curve):
-        curve = curve[cls.columns]
+        curve = curve[cls.columns + [column for column in curve.columns if column not in cls.columns]]
         curve = curve.sort_values(THRESHOLD)
         return curve.set_index(THRESHOLD)
 
@@ -130,6 +221,6 @@ class ROCCurveFileType(CsvFileType):
 
     @classmethod
     def output_format(cls, curve):
-        curve = curve[cls.columns]
+        curve = curve[cls.columns + [column for column in curve.columns if column not in cls.columns]]
         curve = curve.sort_values(THRESHOLD)
         return curve.set_index(THRESHOLD)
@@ -2,14 +2,15 @@
 import json
 import os
 
+import numpy
 import pandas
 import requests
 
-from themis import QUESTION, ANSWER_ID, ANSWER, TITLE, FILENAME, QUESTION_ID, from_csv, DOCUMENT_ID, CONFIDENCE, \
-    FREQUENCY
+from themis import QUESTION, ANSWER_ID, ANSWER, TITLE, FILENAME, QUESTION_ID, from_csv, DOCUMENT_ID
 from themis import logger, to_csv, ensure_directory_exists, percent_complete_message, CsvFileType
 from themis.checkpoint import DataFrameCheckpoint, get_items
-from themis.question import QAPairFileType, USER_EXPERIENCE, DATE_TIME
+from themis.dictionary import ANSWER_KEY, AnswerDictionary
+from themis.question import QAPairFileType
 
 
 def download_truth_from_xmgr(xmgr, output_directory):
@@ -134,7 +135,7 @@ def download_corpus_from_xmgr(xmgr, output_directory, checkpoint_frequency, max_
     logger.info("%d documents and %d PAUs in corpus" % (docs, len(corpus)))
 
 
-def augment_corpus_answers(corpus, qa_pairs):
+def augment_corpus_answers(corpus, qa_pairs, answer_dictionary=None):
     """
     Create a set of answers culled from both the corpus and the usage logs.
 
@@ -147,12 +148,19 @@ def augment_corpus_answers(corpus, qa_pairs):
     :type corpus: pandas.DataFrame
     :param qa_pairs: question answer pairs from usage logs
     :type qa_pairs: pandas.DataFrame
+    :param answer_dictionary: dictionary used to match answers by key instead of by text
+    :type answer_dictionary: AnswerDictionary
     :return: comprehensive set of answers
     :rtype: pandas.DataFrame
     """
-    qa_pairs = qa_pairs.drop([QUESTION, CONFIDENCE, USER_EXPERIENCE, FREQUENCY, DATE_TIME], axis="columns")
+    if answer_dictionary is None:
+        answer_dictionary = AnswerDictionary()
+    corpus = answer_dictionary.add_keys(corpus)
+    qa_pairs = answer_dictionary.add_keys(qa_pairs[[ANSWER]]).drop_duplicates(ANSWER_KEY)
+    new_answers = qa_pairs[~qa_pairs[ANSWER_KEY].isin(corpus[ANSWER_KEY])]
     # The corpus may contain multiple PAUs with the same text but different titles.
-    answer_set = pandas.merge(corpus, qa_pairs, on=ANSWER, how="outer").drop_duplicates([ANSWER, TITLE])
+    answer_set = pandas.concat([corpus, new_answers]).drop_duplicates([ANSWER_KEY, TITLE])
+    answer_set = answer_set.drop(ANSWER_KEY, axis="columns")
     n = len(answer_set)
     m = n - len(corpus)
     if m:
@@ -259,7 +267,7 @@ def missing_truth_in_corpus(corpus, truth):
     return ~truth[ANSWER_ID].isin(corpus[ANSWER_ID])
 
 
-def validate_answers_with_corpus(corpus, qa_pairs, output_directory):
+def validate_answers_with_corpus(corpus, qa_pairs, output_directory, answer_dictionary=None):
     """
     Verify that all the answers in the Q&A pairs are present in the corpus.
 
@@ -272,13 +280,18 @@ def validate_answers_with_corpus(corpus, qa_pairs, output_directory):
     :type qa_pairs: pandas.DataFrame
     :param output_directory: directory in which to create files
     :type output_directory: str
+    :param answer_dictionary: dictionary used to match answers by key instead of by text
+    :type answer_dictionary: AnswerDictionary
     """
-    missing_answers = ~qa_pairs[ANSWER].isin(corpus[ANSWER])
+    if answer_dictionary is None:
+        answer_dictionary = AnswerDictionary()
+    answer_keys = answer_dictionary.keys(qa_pairs[ANSWER])
+    missing_answers = ~numpy.in1d(answer_keys, answer_dictionary.keys(corpus[ANSWER]))
     if any(missing_answers):
         ensure_directory_exists(output_directory)
         missing_answer_qa_pairs = qa_pairs[missing_answers]
-        n = len(qa_pairs.drop_duplicates(ANSWER))
-        m = len(missing_answer_qa_pairs.drop_duplicates(ANSWER))
+        n = len(numpy.unique(answer_keys))
+        m = len(numpy.unique(answer_keys[missing_answers]))
         print("%d usage log answers of %d (%0.3f%%) not in the corpus" % (m, n, 100.0 * m / n))
         answers_in_corpus_csv = os.path.join(output_directory, "answers.in-corpus.csv")
         answers_not_in_corpus_csv = os.path.join(output_directory, "answers.not-in-corpus.csv")